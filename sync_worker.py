@@ -1,6 +1,10 @@
-from tapiriik.sync import Sync
-from tapiriik.sync.requests_lib import patch_requests_with_default_timeout
+from tapiriik.sync import Sync, SyncStep, SyncScheduler
 from tapiriik.database import db
+from tapiriik.database.tz import TZCache
+from tapiriik.services.render_cache import RenderCache
+from tapiriik.services.download_cache import DownloadCache
+from tapiriik.settings import SYNC_WORKER_CONCURRENCY
+import threading
 import time
 import datetime
 import os
@@ -10,7 +14,7 @@ import subprocess
 import socket
 
 Run = True
-RecycleInterval = 10 # Number of users processed before the worker is recycled. Meh.
+RecycleInterval = 10 * SYNC_WORKER_CONCURRENCY # Number of users processed before the worker is recycled. Meh.
 
 oldCwd = os.getcwd()
 WorkerVersion = subprocess.Popen(["git", "rev-parse", "HEAD"], stdout=subprocess.PIPE, cwd=os.path.dirname(__file__)).communicate()[0].strip()
@@ -22,18 +26,28 @@ def sync_interrupt(signal, frame):
 
 signal.signal(signal.SIGINT, sync_interrupt)
 
+HeartbeatStates = {}
+HeartbeatLock = threading.Lock()
+
 def sync_heartbeat(state):
-    db.sync_workers.update({"Process": os.getpid()}, {"$set": {"Heartbeat": datetime.datetime.utcnow(), "State": state}})
+    # Each sync thread reports its own state - the watchdog gives the list step more leeway, so it wins if any thread is in it.
+    with HeartbeatLock:
+        if state == "idle":
+            HeartbeatStates.clear()
+        else:
+            HeartbeatStates[threading.current_thread().ident] = state
+        reportedState = SyncStep.List if SyncStep.List in HeartbeatStates.values() else state
+        db.sync_workers.update({"Process": os.getpid()}, {"$set": {"Heartbeat": datetime.datetime.utcnow(), "State": reportedState, "ThreadStates": list(HeartbeatStates.values()), "TZCache": TZCache.Stats(), "RenderCache": RenderCache.Stats(), "DownloadCache": DownloadCache.Stats()}})
 
 print("Sync worker starting at " + datetime.datetime.now().ctime() + " pid " + str(os.getpid()))
 db.sync_workers.update({"Process": os.getpid()}, {"Process": os.getpid(), "Heartbeat": datetime.datetime.utcnow(), "Startup":  datetime.datetime.utcnow(),  "Version": WorkerVersion, "Host": socket.gethostname(), "State": "startup"}, upsert=True)
 sys.stdout.flush()
 
-patch_requests_with_default_timeout(timeout=60)
+SyncScheduler.EnsureIndexes()
 
 while Run:
     cycleStart = datetime.datetime.utcnow()
-    RecycleInterval -= Sync.PerformGlobalSync(heartbeat_callback=sync_heartbeat)
+    RecycleInterval -= Sync.PerformGlobalSync(heartbeat_callback=sync_heartbeat, concurrency=SYNC_WORKER_CONCURRENCY, limit=RecycleInterval, stop=lambda: not Run)
     if RecycleInterval <= 0:
     	break
     if (datetime.datetime.utcnow() - cycleStart).total_seconds() < 1:
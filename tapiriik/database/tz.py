@@ -1,12 +1,287 @@
-from tapiriik.database import tzdb
+from tapiriik.database import tzdb, cachedb
+from tapiriik.settings import TZ_INDEX_PATH, TZ_CACHE_SIZE, TZ_CACHE_TTL
 from bson.son import SON
+from array import array
+from bisect import bisect_left
+from collections import defaultdict, OrderedDict
+from datetime import datetime
+import threading
+import logging
+import struct
+import mmap
+import math
+import sys
+import os
+
+logger = logging.getLogger(__name__)
+
+class TZIndex:
+	""" An in-process index over the timezone boundary polygons, so finding the TZ of a point doesn't need a round trip to tzdb.
+		The world is divided into a grid: each cell lists the polygons that reach into it, whether the cell's reference point falls inside each of them, and the edges of each that pass through the cell.
+		A point is then inside a polygon if the segment between it and its cell's reference point crosses an odd number of those edges (or an even number, if the reference point is outside it).
+		Snapshots are flat arrays of little-endian int32s, so workers can mmap them rather than reading them in.
+	"""
+	Magic = b"TZIX"
+	Version = 1
+	Scale = 10 ** 7  # coordinates are stored as integer 1e-7 degrees (~1cm)
+	MetresPerDegree = 111320
+	_header = struct.Struct("<4sIIIIII")  # magic, version, cells per degree, TZID table length, polygon count, cell entry count, edge count
+	_referenceNudge = 37  # keep the reference points off the grid lines, since plenty of boundaries follow them exactly
+
+	def __init__(self, buffer):
+		magic, version, self.CellsPerDegree, tzidsLength, polygonCount, entryCount, edgeCount = TZIndex._header.unpack_from(buffer, 0)
+		if magic != TZIndex.Magic or version != TZIndex.Version:
+			raise ValueError("Not a TZ index snapshot")
+		self._buffer = buffer  # the views below keep pointing into it
+		self._width = 360 * self.CellsPerDegree
+		self._height = 180 * self.CellsPerDegree
+		view = memoryview(buffer)
+		offset = TZIndex._header.size
+		self.TZIDs = bytes(view[offset:offset + tzidsLength]).decode("UTF-8").split("\0")
+		offset += tzidsLength + (-tzidsLength % 4)
+
+		def section(count):
+			nonlocal offset
+			if sys.byteorder == "little":
+				data = view[offset:offset + count * 4].cast("i")
+			else:
+				data = array("i", view[offset:offset + count * 4])
+				data.byteswap()
+			offset += count * 4
+			return data
+
+		self._polygonTZIDs = section(polygonCount)
+		self._cellStarts = section(self._width * self._height + 1)
+		self._entries = section(entryCount * 4)  # polygon, whether the cell's reference point is inside it, first edge, edge count
+		self._edges = section(edgeCount * 4)  # x1, y1, x2, y2
+
+	def Load(path):
+		with open(path, "rb") as snapshot:
+			return TZIndex(mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ))
+
+	def Lookup(self, lat, lng, maxDistance=200000):
+		""" Returns the TZID of the boundary containing the point - or failing that, the nearest boundary within maxDistance metres - or None """
+		x, y = round(lng * TZIndex.Scale), round(lat * TZIndex.Scale)
+		col, row = self._cellOf(x, y)
+		refX, refY = TZIndex._referencePoint(col, row, self.CellsPerDegree)
+		cell = row * self._width + col
+		entries, edges = self._entries, self._edges
+		for entry in range(self._cellStarts[cell], self._cellStarts[cell + 1]):
+			inside = entries[entry * 4 + 1] == 1
+			firstEdge = entries[entry * 4 + 2]
+			for edge in range(firstEdge, firstEdge + entries[entry * 4 + 3]):
+				if TZIndex._crosses(x, y, refX, refY, edges[edge * 4], edges[edge * 4 + 1], edges[edge * 4 + 2], edges[edge * 4 + 3]):
+					inside = not inside
+			if inside:
+				return self.TZIDs[self._polygonTZIDs[entries[entry * 4]]]
+		return self._nearest(x, y, maxDistance)
+
+	def _nearest(self, x, y, maxDistance):
+		# Like $near - the boundary with the closest edge, measured on a local flat projection (which is fine at these distances).
+		metresPerX = TZIndex.MetresPerDegree / TZIndex.Scale * max(math.cos(math.radians(y / TZIndex.Scale)), 0.01)
+		metresPerY = TZIndex.MetresPerDegree / TZIndex.Scale
+		spanX, spanY = math.ceil(maxDistance / metresPerX), math.ceil(maxDistance / metresPerY)
+		minCol, minRow = self._cellOf(x - spanX, y - spanY)
+		maxCol, maxRow = self._cellOf(x + spanX, y + spanY)
+		entries, edges = self._entries, self._edges
+		best = None
+		bestDistance = maxDistance
+		for row in range(minRow, maxRow + 1):
+			for cell in range(row * self._width + minCol, row * self._width + maxCol + 1):
+				for entry in range(self._cellStarts[cell], self._cellStarts[cell + 1]):
+					firstEdge = entries[entry * 4 + 2]
+					for edge in range(firstEdge, firstEdge + entries[entry * 4 + 3]):
+						distance = TZIndex._segmentDistance((edges[edge * 4] - x) * metresPerX, (edges[edge * 4 + 1] - y) * metresPerY, (edges[edge * 4 + 2] - x) * metresPerX, (edges[edge * 4 + 3] - y) * metresPerY)
+						if distance <= bestDistance:
+							best = entries[entry * 4]
+							bestDistance = distance
+		return self.TZIDs[self._polygonTZIDs[best]] if best is not None else None
+
+	def _segmentDistance(x1, y1, x2, y2):
+		# From the origin
+		dx, dy = x2 - x1, y2 - y1
+		lengthSq = dx * dx + dy * dy
+		t = max(0, min(1, -(x1 * dx + y1 * dy) / lengthSq)) if lengthSq else 0
+		return math.hypot(x1 + t * dx, y1 + t * dy)
+
+	def _crosses(px, py, rx, ry, x1, y1, x2, y2):
+		# Whether segment p-r crosses segment 1-2 - all integers, so there's no rounding to worry about.
+		# Where p-r runs through a vertex, that vertex goes with the edges on the negative side of it, so of the two edges meeting there, only one counts if the boundary really is crossed - and both or neither if it's just touched.
+		side1 = (x2 - x1) * (py - y1) - (y2 - y1) * (px - x1)
+		side2 = (x2 - x1) * (ry - y1) - (y2 - y1) * (rx - x1)
+		if side1 == 0 or side2 == 0 or (side1 > 0) == (side2 > 0):
+			return False
+		side3 = (rx - px) * (y1 - py) - (ry - py) * (x1 - px)
+		side4 = (rx - px) * (y2 - py) - (ry - py) * (x2 - px)
+		return (side3 > 0) != (side4 > 0)
+
+	def _cellOf(self, x, y):
+		col = (x + 180 * TZIndex.Scale) * self.CellsPerDegree // TZIndex.Scale
+		row = (y + 90 * TZIndex.Scale) * self.CellsPerDegree // TZIndex.Scale
+		return min(max(col, 0), self._width - 1), min(max(row, 0), self._height - 1)
+
+	def _referencePoint(col, row, cellsPerDegree):
+		return ((2 * col + 1) * TZIndex.Scale // (2 * cellsPerDegree) - 180 * TZIndex.Scale + TZIndex._referenceNudge,
+				(2 * row + 1) * TZIndex.Scale // (2 * cellsPerDegree) - 90 * TZIndex.Scale + TZIndex._referenceNudge)
+
+	def Build(polygons, path, cellsPerDegree=4):
+		""" Writes a snapshot - polygons is a sequence of (TZID, rings), where each ring (holes included) is a sequence of (lng, lat) points """
+		width, height = 360 * cellsPerDegree, 180 * cellsPerDegree
+		tzids = []
+		tzidIndices = {}
+		polygonTZIDs = array("i")
+		cellEdges = defaultdict(lambda: defaultdict(list))  # cell -> polygon -> edges in that cell
+		referenceCrossings = defaultdict(list)  # (polygon, row) -> x of the edges crossing the row's reference latitude
+		polygonCols = []
+		refXs = [TZIndex._referencePoint(col, 0, cellsPerDegree)[0] for col in range(width)]
+		refYs = [TZIndex._referencePoint(0, row, cellsPerDegree)[1] for row in range(height)]
+
+		def cellOf(x, y):
+			col = (x + 180 * TZIndex.Scale) * cellsPerDegree // TZIndex.Scale
+			row = (y + 90 * TZIndex.Scale) * cellsPerDegree // TZIndex.Scale
+			return min(max(col, 0), width - 1), min(max(row, 0), height - 1)
+
+		for polygon, (tzid, rings) in enumerate(polygons):
+			if tzid not in tzidIndices:
+				tzidIndices[tzid] = len(tzids)
+				tzids.append(tzid)
+			polygonTZIDs.append(tzidIndices[tzid])
+			minCol, maxCol = width, -1
+			for ring in rings:
+				points = [(round(lng * TZIndex.Scale), round(lat * TZIndex.Scale)) for lng, lat in ring]
+				if points and points[0] != points[-1]:
+					points.append(points[0])
+				for (x1, y1), (x2, y2) in zip(points, points[1:]):
+					if (x1, y1) == (x2, y2):
+						continue
+					col1, row1 = cellOf(min(x1, x2), min(y1, y2))
+					col2, row2 = cellOf(max(x1, x2), max(y1, y2))
+					minCol, maxCol = min(minCol, col1), max(maxCol, col2)
+					for row in range(row1, row2 + 1):
+						for col in range(col1, col2 + 1):
+							cellEdges[row * width + col][polygon].append((x1, y1, x2, y2))
+						refY = refYs[row]
+						if (y1 > refY) != (y2 > refY):
+							referenceCrossings[(polygon, row)].append(x1 + (refY - y1) * (x2 - x1) / (y2 - y1))
+			polygonCols.append((minCol, maxCol))
+
+		# Even-odd rule along each row's reference latitude - a reference point is inside if there are an odd number of crossings to its west.
+		insideCells = defaultdict(set)  # cell -> polygons containing its reference point
+		for (polygon, row), crossings in referenceCrossings.items():
+			crossings.sort()
+			minCol, maxCol = polygonCols[polygon]
+			for col in range(minCol, maxCol + 1):
+				if bisect_left(crossings, refXs[col]) % 2:
+					insideCells[row * width + col].add(polygon)
+
+		cellStarts = array("i")
+		entries = array("i")
+		edges = array("i")
+		for cell in range(width * height):
+			cellStarts.append(len(entries) // 4)
+			cellPolygons = set(insideCells.get(cell, ()))
+			if cell in cellEdges:
+				cellPolygons.update(cellEdges[cell].keys())
+			for polygon in sorted(cellPolygons):
+				polygonEdges = cellEdges[cell][polygon] if cell in cellEdges else []
+				entries.extend([polygon, 1 if polygon in insideCells.get(cell, ()) else 0, len(edges) // 4, len(polygonEdges)])
+				for edge in polygonEdges:
+					edges.extend(edge)
+		cellStarts.append(len(entries) // 4)
+
+		tzidTable = "\0".join(tzids).encode("UTF-8")
+		with open(path, "wb") as snapshot:
+			snapshot.write(TZIndex._header.pack(TZIndex.Magic, TZIndex.Version, cellsPerDegree, len(tzidTable), len(polygonTZIDs), len(entries) // 4, len(edges) // 4))
+			snapshot.write(tzidTable + b"\0" * (-len(tzidTable) % 4))
+			for section in [polygonTZIDs, cellStarts, entries, edges]:
+				if sys.byteorder != "little":
+					section.byteswap()
+				section.tofile(snapshot)
+
+_index = None
+_indexLoaded = False
+_indexLock = threading.Lock()
+
+def _getIndex():
+	global _index, _indexLoaded
+	if not _indexLoaded:
+		with _indexLock:
+			if not _indexLoaded:
+				if os.path.exists(TZ_INDEX_PATH):
+					try:
+						_index = TZIndex.Load(TZ_INDEX_PATH)
+					except Exception:
+						logger.exception("Could not load TZ index from %s, falling back to tzdb" % TZ_INDEX_PATH)
+				_indexLoaded = True
+	return _index
 
 def TZLookup(lat, lng):
-	pt = [lng, lat]
-	res = tzdb.boundaries.find_one({"Boundary": {"$geoIntersects": {"$geometry": {"type":"Point", "coordinates": pt}}}}, {"TZID": True})
-	if not res:
-		res = tzdb.boundaries.find_one({"Boundary": SON([("$near", {"$geometry": {"type": "Point", "coordinates": pt}}), ("$maxDistance", 200000)])}, {"TZID": True})
-	res = res["TZID"] if res else None
+	index = _getIndex()
+	if index:
+		res = index.Lookup(lat, lng)
+	else:
+		pt = [lng, lat]
+		res = tzdb.boundaries.find_one({"Boundary": {"$geoIntersects": {"$geometry": {"type":"Point", "coordinates": pt}}}}, {"TZID": True})
+		if not res:
+			res = tzdb.boundaries.find_one({"Boundary": SON([("$near", {"$geometry": {"type": "Point", "coordinates": pt}}), ("$maxDistance", 200000)])}, {"TZID": True})
+		res = res["TZID"] if res else None
 	if not res or res == "uninhabited":
 		res = round(lng / 15)
 	return res
+
+class TZLookupCache:
+	""" Remembers TZLookup results by grid cell (0.01 degrees, ~1km) - first in an in-process LRU, then in cachedb.tz_cache, which expires them after TZ_CACHE_TTL seconds.
+		Most activities start from the same few places, which this catches where caching the exact coordinates didn't.
+		A point within a cell of a boundary can get its neighbour's TZ, which is close enough for working out an activity's offset.
+	"""
+	CellSize = 0.01
+
+	def __init__(self, size=TZ_CACHE_SIZE, ttl=TZ_CACHE_TTL):
+		self._size = size
+		self._ttl = ttl
+		self._entries = OrderedDict()
+		self._lock = threading.Lock()
+		self._dbIndexEnsured = False
+		self.Hits = self.DBHits = self.Misses = 0
+
+	def Lookup(self, lat, lng):
+		cell = [round(lat / TZLookupCache.CellSize), round(lng / TZLookupCache.CellSize)]
+		key = tuple(cell)
+		with self._lock:
+			if key in self._entries:
+				self._entries.move_to_end(key)
+				self.Hits += 1
+				return self._entries[key]
+
+		self._ensureIndexes()
+		cachedTzData = cachedb.tz_cache.find_one({"Cell": cell})
+		if cachedTzData:
+			res = cachedTzData["TZ"]
+		else:
+			res = TZLookup(lat, lng)
+			cachedb.tz_cache.update({"Cell": cell}, {"Cell": cell, "TZ": res, "Timestamp": datetime.utcnow()}, upsert=True)
+
+		with self._lock:
+			if cachedTzData:
+				self.DBHits += 1
+			else:
+				self.Misses += 1
+			self._entries[key] = res
+			while len(self._entries) > self._size:
+				self._entries.popitem(last=False)
+		return res
+
+	def Stats(self):
+		with self._lock:
+			return {"Hits": self.Hits, "DBHits": self.DBHits, "Misses": self.Misses, "Size": len(self._entries)}
+
+	def _ensureIndexes(self):
+		if self._dbIndexEnsured:
+			return
+		cachedb.tz_cache.ensure_index("Cell")
+		cachedb.tz_cache.ensure_index("Timestamp", expireAfterSeconds=self._ttl)
+		# Entries from before the cache went by cell were keyed on exact coordinates, with no Timestamp - they'd never be read, nor expire.
+		cachedb.tz_cache.remove({"Cell": {"$exists": False}})
+		self._dbIndexEnsured = True
+
+TZCache = TZLookupCache()
@@ -4,15 +4,89 @@ from tapiriik.services.api import APIException, ServiceExceptionScope, UserExcep
 from tapiriik.services.interchange import ActivityType, UploadedActivity
 from tapiriik.services.gpx import GPXIO
 from tapiriik.services.tcx import TCXIO
+from tapiriik.services.render_cache import RenderCache
 from tapiriik.database import cachedb
 from dropbox import client, rest, session
 from django.core.urlresolvers import reverse
 import re
 import lxml
 from datetime import datetime
+from collections import OrderedDict
 import logging
 logger = logging.getLogger(__name__)
 
+
+def _parentPath(path):
+    return path.rsplit("/", 1)[0] or "/"
+
+
+class _DropboxStructure:
+    """ The folders last seen in a user's Dropbox, each with the GPX/TCX files in it - indexed by (lower-case, as Dropbox is case-insensitive) path, and by parent folder.
+        Each folder's files are indexed by path too, so adding or removing one doesn't mean going through all the others - go through Files() rather than the records' own Files lists, which are only brought up to date by Records().
+        Stored as the list of folder records from Records().
+    """
+    def __init__(self, records):
+        self._folders = {}
+        self._children = {}
+        self._files = {}  # folder path -> OrderedDict of file path -> file
+        for record in records:
+            self.AddFolder(record)
+
+    def Records(self):
+        for key, folder in self._folders.items():
+            folder["Files"] = list(self._files[key].values())
+        return list(self._folders.values())
+
+    def GetFolder(self, path):
+        return self._folders.get(path.lower())
+
+    def AddFolder(self, record):
+        key = record["Path"].lower()
+        self._folders[key] = record
+        self._files[key] = OrderedDict((file["Path"].lower(), file) for file in record.get("Files", []))
+        parent = _parentPath(key)
+        if parent != key:
+            self._children.setdefault(parent, set()).add(key)
+        return record
+
+    def EnsureFolder(self, path):
+        return self.GetFolder(path) or self.AddFolder({"Path": path, "Files": []})
+
+    def ChildFolders(self, path):
+        return [self._folders[key] for key in self._children.get(path.lower(), ())]
+
+    def RemoveFolder(self, path):
+        key = path.lower()
+        for child in self.ChildFolders(key):
+            self.RemoveFolder(child["Path"])
+        self._folders.pop(key, None)
+        self._children.pop(key, None)
+        self._files.pop(key, None)
+        if _parentPath(key) in self._children:
+            self._children[_parentPath(key)].discard(key)
+
+    def Files(self, path):
+        return list(self._files.get(path.lower(), {}).values())
+
+    def ClearFiles(self, path):
+        self._files[path.lower()] = OrderedDict()
+
+    def PutFile(self, file):
+        key = file["Path"].lower()
+        self.EnsureFolder(_parentPath(file["Path"]))
+        files = self._files[_parentPath(key)]
+        files.pop(key, None)  # so it ends up last, as if it were new
+        files[key] = file
+
+    def RemovePath(self, path):
+        key = path.lower()
+        if key in self._folders:
+            self.RemoveFolder(path)
+            return
+        if _parentPath(key) in self._files:
+            self._files[_parentPath(key)].pop(key, None)
+
+
 class DropboxService(ServiceBase):
     ID = "dropbox"
     DisplayName = "Dropbox"
@@ -39,6 +113,7 @@ class DropboxService(ServiceBase):
     ConfigurationDefaults = {"SyncRoot": "/", "UploadUntagged": False, "Format":"gpx", "Filename":"%Y-%m-%d_#NAME"}
 
     SupportsHR = SupportsCadence = True
+    DeltaListing = True  # list what's changed through /delta, rather than crawling every folder for changes
 
     SupportedActivities = ActivityTaggingTable.keys()
 
@@ -99,7 +174,7 @@ class DropboxService(ServiceBase):
         from tapiriik.auth import User
         if newConfig["SyncRoot"] != oldConfig["SyncRoot"]:
             Sync.ScheduleImmediateSync(User.AuthByService(svcRec), True)
-            cachedb.dropbox_cache.update({"ExternalID": svcRec.ExternalID}, {"$unset": {"Structure": None}})
+            cachedb.dropbox_cache.update({"ExternalID": svcRec.ExternalID}, {"$unset": {"Structure": None, "DeltaCursor": None}})
 
     def _raiseDbException(self, e):
         if e.status == 401:
@@ -108,41 +183,73 @@ class DropboxService(ServiceBase):
             raise APIException("Dropbox quota error", block=True, user_exception=UserException(UserExceptionType.AccountFull, intervention_required=True))
         raise APIException("API failure - status " + str(e.status) + " reason " + str(e.reason) + " body " + str(e.error_msg))
 
-    def _folderRecurse(self, structCache, dbcl, path):
-        hash = None
-        existingRecord = [x for x in structCache if x["Path"] == path]
-        children = [x for x in structCache if x["Path"].startswith(path) and x["Path"] != path]
-        existingRecord = existingRecord[0] if len(existingRecord) else None
-        if existingRecord:
-            hash = existingRecord["Hash"]
+    def _syncRoot(self, svcRec):
+        return svcRec.Config["SyncRoot"] if svcRec.Authorization["Full"] else "/"
+
+    def _isActivityFile(self, path):
+        return path.lower().endswith(".gpx") or path.lower().endswith(".tcx")
+
+    def _folderRecurse(self, structure, dbcl, path):
+        existingRecord = structure.GetFolder(path)
+        hash = existingRecord["Hash"] if existingRecord and "Hash" in existingRecord else None
         try:
             dirmetadata = dbcl.metadata(path, hash=hash)
         except rest.ErrorResponse as e:
             if e.status == 304:
-                for child in children:
-                    self._folderRecurse(structCache, dbcl, child["Path"])  # still need to recurse for children
+                for child in structure.ChildFolders(path):
+                    self._folderRecurse(structure, dbcl, child["Path"])  # still need to recurse for children
                 return  # nothing new to update here
             if e.status == 404:
                 # dir doesn't exist any more, delete it and all children
-                structCache[:] = (x for x in structCache if x != existingRecord and x not in children)
+                structure.RemoveFolder(path)
                 return
             self._raiseDbException(e)
         if not existingRecord:
-            existingRecord = {"Files": [], "Path": dirmetadata["path"]}
-            structCache.append(existingRecord)
+            existingRecord = structure.AddFolder({"Files": [], "Path": dirmetadata["path"]})
 
         existingRecord["Hash"] = dirmetadata["hash"]
-        existingRecord["Files"] = []
-        curDirs = []
+        structure.ClearFiles(path)
+        curDirs = set()
         for file in dirmetadata["contents"]:
             if file["is_dir"]:
-                curDirs.append(file["path"])
-                self._folderRecurse(structCache, dbcl, file["path"])
+                curDirs.add(file["path"].lower())
+                self._folderRecurse(structure, dbcl, file["path"])
             else:
-                if not file["path"].lower().endswith(".gpx") and not file["path"].lower().endswith(".tcx"):
+                if not self._isActivityFile(file["path"]):
                     continue  # another kind of file
-                existingRecord["Files"].append({"Rev": file["rev"], "Path": file["path"]})
-        structCache[:] = (x for x in structCache if x["Path"] in curDirs or x not in children)  # delete ones that don't exist
+                structure.PutFile({"Rev": file["rev"], "Path": file["path"]})
+        for child in structure.ChildFolders(path):
+            if child["Path"].lower() not in curDirs:
+                structure.RemoveFolder(child["Path"])  # delete ones that don't exist
+
+    def _delta(self, dbcl, cursor, syncRoot):
+        try:
+            return dbcl.delta(cursor, path_prefix=syncRoot if syncRoot != "/" else None)
+        except rest.ErrorResponse as e:
+            self._raiseDbException(e)
+
+    def _listDelta(self, cache, dbcl, syncRoot, exhaustive):
+        # Brings the structure up to date with whatever's changed since the cursor - or rebuilds it from scratch, if there's no cursor yet, Dropbox says to, or it's an exhaustive sync.
+        cursor = cache["DeltaCursor"] if "DeltaCursor" in cache and not exhaustive else None
+        structure = _DropboxStructure(cache["Structure"] if cursor else [])
+        while True:
+            delta = self._delta(dbcl, cursor, syncRoot)
+            if delta["reset"]:
+                structure = _DropboxStructure([])
+            for path, metadata in delta["entries"]:
+                if metadata is None:
+                    structure.RemovePath(path)
+                elif metadata["is_dir"]:
+                    structure.EnsureFolder(metadata["path"])
+                else:
+                    structure.RemovePath(metadata["path"])  # in case it's taken a folder's place
+                    if self._isActivityFile(metadata["path"]):
+                        structure.PutFile({"Rev": metadata["rev"], "Path": metadata["path"]})
+            cursor = delta["cursor"]
+            if not delta["has_more"]:
+                break
+        cache["Structure"] = structure.Records()
+        cache["DeltaCursor"] = cursor
 
     def _tagActivity(self, text):
         for act, pattern in self.ActivityTaggingTable.items():
@@ -150,34 +257,20 @@ class DropboxService(ServiceBase):
                 return act
         return None
 
-    def _getActivity(self, serviceRecord, dbcl, path):
-        activityData = None
-
-        try:
-            f, metadata = dbcl.get_file_and_metadata(path)
-        except rest.ErrorResponse as e:
-            self._raiseDbException(e)
-
-        cachedActivityRecord = cachedb.dropbox_activity_cache.find_one({"ExternalID":serviceRecord.ExternalID, "Path": path})
-        if cachedActivityRecord:
-            if cachedActivityRecord["Rev"] != metadata["rev"]:
-                logger.debug("Outdated cache hit on %s" % path)
-                cachedb.dropbox_activity_cache.remove(cachedActivityRecord)
-            else:
-                logger.debug("Cache hit on %s" % path)
-                activityData = cachedActivityRecord["Data"]
-                cachedb.dropbox_activity_cache.update(cachedActivityRecord, {"$set":{"Valid": datetime.utcnow()}})
-
-        if not activityData:
-            activityData = f.read()
-            cachedb.dropbox_activity_cache.insert({"ExternalID": serviceRecord.ExternalID, "Rev": metadata["rev"], "Data": activityData, "Path": path, "Valid": datetime.utcnow()})
+    def _getActivity(self, serviceRecord, dbcl, path, rev, minimumWaypoints=False):
+        def download():
+            try:
+                return dbcl.get_file(path, rev=rev).read()
+            except rest.ErrorResponse as e:
+                self._raiseDbException(e)
 
+        activityData = self.CachedDownload(serviceRecord, path, download, revision=rev)
 
         try:
             if path.lower().endswith(".tcx"):
-                act = TCXIO.Parse(activityData)
+                act = TCXIO.Parse(activityData, minimumWaypoints=minimumWaypoints)
             else:
-                act = GPXIO.Parse(activityData)
+                act = GPXIO.Parse(activityData, minimumWaypoints=minimumWaypoints)
         except ValueError as e:
             raise APIExcludeActivity("Invalid GPX/TCX " + str(e), activityId=path)
         except lxml.etree.XMLSyntaxError as e:
@@ -185,23 +278,29 @@ class DropboxService(ServiceBase):
         if not act.GetFirstWaypointWithLocation():
             raise APIExcludeActivity("TCX/GPX without any waypoint with location", activityId=path)
         act.EnsureTZ()  # activity comes out of GPXIO with TZ=utc, this will recalculate it
-        return act, metadata["rev"]
+        return act
 
-    def DownloadActivityList(self, svcRec, exhaustive=False):
+    def DownloadActivityList(self, svcRec, exhaustive=False, since=None):
         dbcl = self._getClient(svcRec)
-        if not svcRec.Authorization["Full"]:
-            syncRoot = "/"
-        else:
-            syncRoot = svcRec.Config["SyncRoot"]
+        syncRoot = self._syncRoot(svcRec)
         cache = cachedb.dropbox_cache.find_one({"ExternalID": svcRec.ExternalID})
         if cache is None:
             cache = {"ExternalID": svcRec.ExternalID, "Structure": [], "Activities": {}}
         if "Structure" not in cache:
             cache["Structure"] = []
-        self._folderRecurse(cache["Structure"], dbcl, syncRoot)
+            cache.pop("DeltaCursor", None)
+        if self.DeltaListing:
+            self._listDelta(cache, dbcl, syncRoot, exhaustive)
+        else:
+            structure = _DropboxStructure(cache["Structure"])
+            self._folderRecurse(structure, dbcl, syncRoot)
+            cache["Structure"] = structure.Records()
 
         activities = []
         exclusions = []
+        existingByPath = {}
+        for uid, existing in cache["Activities"].items():
+            existingByPath.setdefault(existing["Path"], (uid, existing))
 
         for dir in cache["Structure"]:
             for file in dir["Files"]:
@@ -211,8 +310,7 @@ class DropboxService(ServiceBase):
                 else:
                     relPath = path.replace("/Apps/tapiriik/", "", 1)  # dropbox api is meh api
 
-                existing = [(k, x) for k, x in cache["Activities"].items() if x["Path"] == relPath]  # path is relative to syncroot to reduce churn if they relocate it
-                existing = existing[0] if existing else None
+                existing = existingByPath.get(relPath)  # path is relative to syncroot to reduce churn if they relocate it
                 if existing is not None:
                     existUID, existing = existing
                 if existing and existing["Rev"] == file["Rev"]:
@@ -223,18 +321,20 @@ class DropboxService(ServiceBase):
                     if "EndTime" in existing:  # some cached activities may not have this, it is not essential
                         act.EndTime = datetime.strptime(existing["EndTime"], "%H:%M:%S %d %m %Y %z")
                 else:
-                    # get the full activity
+                    # get enough of the activity to identify it
                     try:
-                        act, rev = self._getActivity(svcRec, dbcl, path)
+                        act = self._getActivity(svcRec, dbcl, path, file["Rev"], minimumWaypoints=True)
                     except APIExcludeActivity as e:
                         logger.info("Encountered APIExcludeActivity %s" % str(e))
                         exclusions.append(e)
                         continue
                     del act.Waypoints
                     act.Waypoints = []  # Yeah, I'll process the activity twice, but at this point CPU time is more plentiful than RAM.
-                    cache["Activities"][act.UID] = {"Rev": rev, "Path": relPath, "StartTime": act.StartTime.strftime("%H:%M:%S %d %m %Y %z"), "EndTime": act.EndTime.strftime("%H:%M:%S %d %m %Y %z")}
+                    cache["Activities"][act.UID] = {"Rev": file["Rev"], "Path": relPath, "StartTime": act.StartTime.strftime("%H:%M:%S %d %m %Y %z")}
+                    if act.EndTime:  # not known when the file was only partially read
+                        cache["Activities"][act.UID]["EndTime"] = act.EndTime.strftime("%H:%M:%S %d %m %Y %z")
                 tagRes = self._tagActivity(relPath)
-                act.UploadedTo = [{"Connection": svcRec, "Path": path, "Tagged":tagRes is not None}]
+                act.UploadedTo = [{"Connection": svcRec, "Path": path, "Rev": file["Rev"], "Tagged":tagRes is not None}]
 
                 act.Type = tagRes if tagRes is not None else ActivityType.Other
 
@@ -245,6 +345,30 @@ class DropboxService(ServiceBase):
         cachedb.dropbox_cache.update({"ExternalID": svcRec.ExternalID}, cache, upsert=True)
         return activities, exclusions
 
+    def HasNewActivities(self, svcRec, since):
+        # Start times don't come into it here - just whether anything's changed since the last listing.
+        cache = cachedb.dropbox_cache.find_one({"ExternalID": svcRec.ExternalID}, {"Structure": True, "DeltaCursor": True})
+        if not cache:
+            return True
+        dbcl = self._getClient(svcRec)
+        if self.DeltaListing:
+            if "DeltaCursor" not in cache:
+                return True
+            delta = self._delta(dbcl, cache["DeltaCursor"], self._syncRoot(svcRec))
+            return delta["reset"] or len(delta["entries"]) > 0
+        if not cache.get("Structure"):
+            return True
+        for dir in cache["Structure"]:
+            if "Hash" not in dir:
+                return True
+            try:
+                dbcl.metadata(dir["Path"], hash=dir["Hash"])
+            except rest.ErrorResponse as e:
+                if e.status == 304:
+                    continue
+            return True
+        return False
+
     def DownloadActivity(self, serviceRecord, activity):
         # activity might not be populated at this point, still possible to bail out
         if not [x["Tagged"] for x in activity.UploadedTo if x["Connection"] == serviceRecord][0]:
@@ -253,9 +377,9 @@ class DropboxService(ServiceBase):
 
         # activity might already be populated, if not download it again
         if len(activity.Waypoints) == 0:  # in the abscence of an actual Populated variable...
-            path = [x["Path"] for x in activity.UploadedTo if x["Connection"] == serviceRecord][0]
+            uploadRecord = [x for x in activity.UploadedTo if x["Connection"] == serviceRecord][0]
             dbcl = self._getClient(serviceRecord)
-            fullActivity, rev = self._getActivity(serviceRecord, dbcl, path)
+            fullActivity = self._getActivity(serviceRecord, dbcl, uploadRecord["Path"], uploadRecord["Rev"])
             fullActivity.Type = activity.Type
             fullActivity.UploadedTo = activity.UploadedTo
             activity = fullActivity
@@ -282,18 +406,7 @@ class DropboxService(ServiceBase):
     def UploadActivity(self, serviceRecord, activity):
         activity.EnsureTZ()
         format = serviceRecord.GetConfiguration()["Format"]
-        if format == "tcx":
-            if "tcx" in activity.PrerenderedFormats:
-                logger.debug("Using prerendered TCX")
-                data = activity.PrerenderedFormats["tcx"]
-            else:
-                data = TCXIO.Dump(activity)
-        else:
-            if "gpx" in activity.PrerenderedFormats:
-                logger.debug("Using prerendered GPX")
-                data = activity.PrerenderedFormats["gpx"]
-            else:
-                data = GPXIO.Dump(activity)
+        data = RenderCache.Render(activity, "tcx" if format == "tcx" else "gpx")
 
         dbcl = self._getClient(serviceRecord)
         fname = self._format_file_name(serviceRecord.GetConfiguration()["Filename"], activity) + "." + format
@@ -304,7 +417,7 @@ class DropboxService(ServiceBase):
             fpath = serviceRecord.Config["SyncRoot"] + "/" + fname
 
         try:
-            metadata = dbcl.put_file(fpath, data.encode("UTF-8"))
+            metadata = dbcl.put_file(fpath, data.encode("UTF-8") if isinstance(data, str) else data)
         except rest.ErrorResponse as e:
             self._raiseDbException(e)
         # fake this in so we don't immediately redownload the activity next time 'round
@@ -314,4 +427,3 @@ class DropboxService(ServiceBase):
 
     def DeleteCachedData(self, serviceRecord):
         cachedb.dropbox_cache.remove({"ExternalID": serviceRecord.ExternalID})
-        cachedb.dropbox_activity_cache.remove({"ExternalID": serviceRecord.ExternalID})
@@ -6,7 +6,6 @@ from tapiriik.services.api import APIException, APIExcludeActivity, UserExceptio
 
 from django.core.urlresolvers import reverse
 from datetime import datetime, timedelta
-import requests
 import pytz
 import re
 import zlib
@@ -82,7 +81,7 @@ class EndomondoService(ServiceBase):
     def Authorize(self, email, password):
         params = {"email": email, "password": password, "v": "2.4", "action": "pair", "deviceId": "TAP-SYNC-" + email.lower(), "country": "N/A"}  # note to future self: deviceId can't change intra-account otherwise we'll get different tokens back
 
-        resp = requests.get("https://api.mobile.endomondo.com/mobile/auth", params=params)
+        resp = self.HTTP.get("https://api.mobile.endomondo.com/mobile/auth", params=params)
         if resp.text.strip() == "USER_UNKNOWN" or resp.text.strip() == "USER_EXISTS_PASSWORD_WRONG":
             raise APIException("Invalid login", block=True, user_exception=UserException(UserExceptionType.Authorization, intervention_required=True))
         data = self._parseKVP(resp.text)
@@ -93,9 +92,26 @@ class EndomondoService(ServiceBase):
         pass
 
     def _downloadRawTrackRecord(self, serviceRecord, trackId):
-        params = {"authToken": serviceRecord.Authorization["AuthToken"], "trackId": trackId}
-        response = requests.get("http://api.mobile.endomondo.com/mobile/readTrack", params=params)
-        return response.text
+        def download():
+            params = {"authToken": serviceRecord.Authorization["AuthToken"], "trackId": trackId}
+            response = self.HTTP.get("http://api.mobile.endomondo.com/mobile/readTrack", params=params)
+            if response.status_code != 200:
+                raise APIException("Unable to download track " + str(trackId) + " status " + str(response.status_code))
+            return response.text.encode("utf-8")
+
+        def parse(payload):
+            # Errors come back with a 200 too - and a track that's cut short shouldn't be cached either.
+            recordText = payload.decode("utf-8")
+            rows = [row for row in recordText.split("\n") if len(row)]
+            if not rows or rows[0] != "OK":
+                raise APIException("Unable to download track " + str(trackId) + " response " + recordText[:100])
+            if [row for row in rows[1:] if len(row.split(";")) < 8]:
+                raise APIExcludeActivity("Incomplete track data", activityId=trackId, permanent=False)
+            if not [row for row in rows[1:] if row.split(";")[2] != "W"]:
+                raise APIExcludeActivity("No track data", activityId=trackId, permanent=False)
+            return recordText
+
+        return self.CachedDownload(serviceRecord, trackId, download, parse)
 
     def _populateActivityFromTrackData(self, activity, recordText, minimumWaypoints=False):
         activity.Waypoints = []
@@ -179,7 +195,7 @@ class EndomondoService(ServiceBase):
         else:
             activity.Waypoints = []  # practically speaking
 
-    def DownloadActivityList(self, serviceRecord, exhaustive=False):
+    def DownloadActivityList(self, serviceRecord, exhaustive=False, since=None):
 
         activities = []
         exclusions = []
@@ -191,7 +207,7 @@ class EndomondoService(ServiceBase):
             before = "" if earliestDate is None else earliestDate.astimezone(pytz.utc).strftime("%Y-%m-%d %H:%M:%S UTC")
             params = {"authToken": serviceRecord.Authorization["AuthToken"], "maxResults": 45, "before": before}
             logger.debug("Req with " + str(params))
-            response = requests.get("http://api.mobile.endomondo.com/mobile/api/workout/list", params=params)
+            response = self.HTTP.get("http://api.mobile.endomondo.com/mobile/api/workout/list", params=params)
 
             if response.status_code != 200:
                 if response.status_code == 401 or response.status_code == 403:
@@ -209,6 +225,8 @@ class EndomondoService(ServiceBase):
                 startTime = pytz.utc.localize(datetime.strptime(act["start_time"], "%Y-%m-%d %H:%M:%S UTC"))
                 if earliestDate is None or startTime < earliestDate:  # probably redundant, I would assume it works out the TZes...
                     earliestDate = startTime
+                if since and startTime < since and not exhaustive:
+                    continue  # no sense resolving the TZ of something the sync isn't going to look at
                 logger.debug("activity pre")
                 if not act["has_points"]:
                     logger.warning("\t no pts")
@@ -240,8 +258,8 @@ class EndomondoService(ServiceBase):
                 track_id = activity.UploadedTo[0]["ActivityID"]
                 if track_id not in cached_track_tzs:
                     logger.debug("\t Resolving TZ for %s" % activity.StartTime)
-                    cachedTrackData = self._downloadRawTrackRecord(serviceRecord, track_id)
                     try:
+                        cachedTrackData = self._downloadRawTrackRecord(serviceRecord, track_id)
                         self._populateActivityFromTrackData(activity, cachedTrackData, minimumWaypoints=True)
                     except APIExcludeActivity as e:
                         e.ExternalActivityID = track_id
@@ -265,12 +283,24 @@ class EndomondoService(ServiceBase):
 
             if not paged:
                 earliestFirstPageDate = earliestDate
-            if not exhaustive or ("more" in data and data["more"] is False):
+            if ("more" in data and data["more"] is False) or not (exhaustive or (since and earliestDate and earliestDate >= since)):
                 break
             else:
                 paged = True
         return activities, exclusions
 
+    def HasNewActivities(self, serviceRecord, since):
+        # They come back newest first.
+        response = self.HTTP.get("http://api.mobile.endomondo.com/mobile/api/workout/list", params={"authToken": serviceRecord.Authorization["AuthToken"], "maxResults": 1})
+        if response.status_code != 200:
+            return True
+        data = response.json()
+        if "error" in data or "data" not in data:
+            return True
+        if not len(data["data"]):
+            return False
+        return pytz.utc.localize(datetime.strptime(data["data"][0]["start_time"], "%Y-%m-%d %H:%M:%S UTC")) >= since
+
     def DownloadActivity(self, serviceRecord, activity):
         uploadRecord = [x for x in activity.UploadedTo if x["Connection"] == serviceRecord][0]
         trackData = uploadRecord["ActivityData"]
@@ -297,7 +327,8 @@ class EndomondoService(ServiceBase):
         params = {"authToken": serviceRecord.Authorization["AuthToken"], "sport": sportId, "workoutId": "tap-sync-" + str(os.getpid()) + "-" + activity.UID + "-" + activity.UploadedTo[0]["Connection"].Service.ID, "deflate": "true", "duration": activity.GetDuration().total_seconds(), "distance": activity.Distance / 1000 if activity.Distance is not None else None}
         data = self._createUploadData(activity)
         compressed_data = zlib.compress(data.encode("ASCII"))
-        response = requests.get("http://api.mobile.endomondo.com/mobile/track", params=params, data=compressed_data)
+        # It's a GET, but it's anything but idempotent - a retry could leave a duplicate.
+        response = self.HTTP.get("http://api.mobile.endomondo.com/mobile/track", params=params, data=compressed_data, retries=0)
         logger.debug("Upload result " + response.text)
         if response.status_code != 200:
             del compressed_data  # keep the error logs clean - automatically scrapes for local variables
@@ -4,12 +4,13 @@ from tapiriik.database import cachedb
 from tapiriik.services.interchange import UploadedActivity, ActivityType, Waypoint, WaypointType, Location
 from tapiriik.services.api import APIException, APIWarning, APIExcludeActivity, UserException, UserExceptionType
 from tapiriik.services.tcx import TCXIO
+from tapiriik.services.render_cache import RenderCache
 from tapiriik.services.sessioncache import SessionCache
 
 from django.core.urlresolvers import reverse
+from lxml import etree
 import pytz
 from datetime import datetime, timedelta
-import requests
 import json
 import os
 
@@ -60,7 +61,7 @@ class GarminConnectService(ServiceBase):
     _sessionCache = SessionCache(lifetime=timedelta(minutes=30), freshen_on_get=True)
 
     def __init__(self):
-        self._activityHierarchy = requests.get("http://connect.garmin.com/proxy/activity-service-1.2/json/activity_types").json()["dictionary"]
+        self._activityHierarchy = self.HTTP.get("http://connect.garmin.com/proxy/activity-service-1.2/json/activity_types").json()["dictionary"]
 
     def _get_cookies(self, record=None, email=None, password=None):
         from tapiriik.auth.credential_storage import CredentialStore
@@ -72,8 +73,8 @@ class GarminConnectService(ServiceBase):
             password = CredentialStore.Decrypt(record.ExtendedAuthorization["Password"])
             email = CredentialStore.Decrypt(record.ExtendedAuthorization["Email"])
         params = {"login": "login", "login:loginUsernameField": email, "login:password": password, "login:signInButton": "Sign In", "javax.faces.ViewState": "j_id1"}
-        preResp = requests.get("https://connect.garmin.com/signin")
-        resp = requests.post("https://connect.garmin.com/signin", data=params, allow_redirects=False, cookies=preResp.cookies)
+        preResp = self.HTTP.get("https://connect.garmin.com/signin")
+        resp = self.HTTP.post("https://connect.garmin.com/signin", data=params, allow_redirects=False, cookies=preResp.cookies)
         if resp.status_code >= 500 and resp.status_code<600:
             raise APIException("Remote API failure")
         if resp.status_code != 302:  # yep
@@ -88,7 +89,7 @@ class GarminConnectService(ServiceBase):
     def Authorize(self, email, password):
         from tapiriik.auth.credential_storage import CredentialStore
         cookies = self._get_cookies(email=email, password=password)
-        username = requests.get("http://connect.garmin.com/user/username", cookies=cookies).json()["username"]
+        username = self.HTTP.get("http://connect.garmin.com/user/username", cookies=cookies).json()["username"]
         if not len(username):
             raise APIException("Unable to retrieve username", block=True, user_exception=UserException(UserExceptionType.Authorization, intervention_required=True))
         return (username, {}, {"Email": CredentialStore.Encrypt(email), "Password": CredentialStore.Encrypt(password)})
@@ -104,21 +105,27 @@ class GarminConnectService(ServiceBase):
                 raise ValueError("Activity type not found in activity hierarchy")
         return self._activityMappings[act_type]
 
-    def DownloadActivityList(self, serviceRecord, exhaustive=False):
+    def DownloadActivityList(self, serviceRecord, exhaustive=False, since=None):
         #http://connect.garmin.com/proxy/activity-search-service-1.0/json/activities?&start=0&limit=50
         cookies = self._get_cookies(record=serviceRecord)
         page = 1
         pageSz = 50
         activities = []
         exclusions = []
+        earliestDate = None
         while True:
             logger.debug("Req with " + str({"start": (page - 1) * pageSz, "limit": pageSz}))
-            res = requests.get("http://connect.garmin.com/proxy/activity-search-service-1.0/json/activities", params={"start": (page - 1) * pageSz, "limit": pageSz}, cookies=cookies)
+            res = self.HTTP.get("http://connect.garmin.com/proxy/activity-search-service-1.0/json/activities", params={"start": (page - 1) * pageSz, "limit": pageSz}, cookies=cookies)
             res = res.json()["results"]
             if "activities" not in res:
                 break  # No activities on this page - empty account.
             for act in res["activities"]:
                 act = act["activity"]
+                startTime = pytz.utc.localize(datetime.utcfromtimestamp(float(act["beginTimestamp"]["millis"])/1000))
+                if earliestDate is None or startTime < earliestDate:
+                    earliestDate = startTime
+                if since and startTime < since and not exhaustive:
+                    continue
                 if "beginLatitude" not in act or "endLatitude" not in act or (act["beginLatitude"] is act["endLatitude"] and act["beginLongitude"] is act["endLongitude"]):
                     exclusions.append(APIExcludeActivity("No points", activityId=act["activityId"]))
                     continue
@@ -136,7 +143,7 @@ class GarminConnectService(ServiceBase):
                 if len(act["activityName"]["value"].strip()) and act["activityName"]["value"] != "Untitled":
                     activity.Name = act["activityName"]["value"]
                 # beginTimestamp/endTimestamp is in UTC
-                activity.StartTime = pytz.utc.localize(datetime.utcfromtimestamp(float(act["beginTimestamp"]["millis"])/1000))
+                activity.StartTime = startTime
                 if "sumElapsedDuration" in act:
                     activity.EndTime = activity.StartTime + timedelta(0, round(float(act["sumElapsedDuration"]["value"])))
                 elif "sumDuration" in act:
@@ -153,31 +160,49 @@ class GarminConnectService(ServiceBase):
                 activity.UploadedTo = [{"Connection": serviceRecord, "ActivityID": act["activityId"]}]
                 activities.append(activity)
             logger.debug("Finished page " + str(page) + " of " + str(res["search"]["totalPages"]))
-            if not exhaustive or int(res["search"]["totalPages"]) == page:
+            if int(res["search"]["totalPages"]) == page or not (exhaustive or (since and earliestDate >= since)):
                 break
             else:
                 page += 1
         return activities, exclusions
 
+    def HasNewActivities(self, serviceRecord, since):
+        # They come back newest first.
+        cookies = self._get_cookies(record=serviceRecord)
+        res = self.HTTP.get("http://connect.garmin.com/proxy/activity-search-service-1.0/json/activities", params={"start": 0, "limit": 1}, cookies=cookies)
+        res = res.json()["results"]
+        if "activities" not in res:
+            return False
+        return pytz.utc.localize(datetime.utcfromtimestamp(float(res["activities"][0]["activity"]["beginTimestamp"]["millis"])/1000)) >= since
+
     def DownloadActivity(self, serviceRecord, activity):
         #http://connect.garmin.com/proxy/activity-service-1.1/tcx/activity/#####?full=true
         activityID = [x["ActivityID"] for x in activity.UploadedTo if x["Connection"] == serviceRecord][0]
-        cookies = self._get_cookies(record=serviceRecord)
-        res = requests.get("http://connect.garmin.com/proxy/activity-service-1.1/tcx/activity/" + str(activityID) + "?full=true", cookies=cookies)
+
+        def download():
+            res = self.HTTP.get("http://connect.garmin.com/proxy/activity-service-1.1/tcx/activity/" + str(activityID) + "?full=true", cookies=self._get_cookies(record=serviceRecord))
+            if res.status_code != 200:
+                raise APIException("Unable to download activity " + str(activityID) + " status " + str(res.status_code))
+            return res.content
+
+        def parse(payload):
+            activity.Waypoints = []  # in case a bad cached copy got partway
+            return TCXIO.Parse(payload, activity)
+
         try:
-            TCXIO.Parse(res.content, activity)
-        except ValueError as e:
-            raise APIExcludeActivity("TCX parse error " + str(e))
+            self.CachedDownload(serviceRecord, activityID, download, parse)
+        except (ValueError, etree.XMLSyntaxError) as e:
+            raise APIExcludeActivity("TCX parse error " + str(e), permanent=False)  # it may well download properly next time
 
         return activity
 
     def UploadActivity(self, serviceRecord, activity):
         #/proxy/upload-service-1.1/json/upload/.tcx
         activity.EnsureTZ()
-        tcx_file = TCXIO.Dump(activity)
+        tcx_file = RenderCache.Render(activity, "tcx")
         files = {"data": ("tap-sync-" + str(os.getpid()) + "-" + activity.UID + ".tcx", tcx_file)}
         cookies = self._get_cookies(record=serviceRecord)
-        res = requests.post("http://connect.garmin.com/proxy/upload-service-1.1/json/upload/.tcx", files=files, cookies=cookies)
+        res = self.HTTP.post("http://connect.garmin.com/proxy/upload-service-1.1/json/upload/.tcx", files=files, cookies=cookies)
         res = res.json()["detailedImportResult"]
 
         if len(res["successes"]) != 1:
@@ -191,7 +216,7 @@ class GarminConnectService(ServiceBase):
                 raise APIWarning("GarminConnect does not support activity type " + activity.Type)
             else:
                 acttype = acttype[0]
-            res = requests.post("http://connect.garmin.com/proxy/activity-service-1.2/json/type/" + str(actid), data={"value": acttype}, cookies=cookies)
+            res = self.HTTP.post("http://connect.garmin.com/proxy/activity-service-1.2/json/type/" + str(actid), data={"value": acttype}, cookies=cookies)
             res = res.json()
             if "activityType" not in res or res["activityType"]["key"] != acttype:
                 raise APIWarning("Unable to set activity type")
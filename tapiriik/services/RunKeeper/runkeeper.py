@@ -1,12 +1,11 @@
-from tapiriik.settings import WEB_ROOT, RUNKEEPER_CLIENT_ID, RUNKEEPER_CLIENT_SECRET, AGGRESSIVE_CACHE
+from tapiriik.settings import WEB_ROOT, RUNKEEPER_CLIENT_ID, RUNKEEPER_CLIENT_SECRET
 from tapiriik.services.service_base import ServiceAuthenticationType, ServiceBase
 from tapiriik.services.service_record import ServiceRecord
 from tapiriik.services.api import APIException, UserException, UserExceptionType, APIExcludeActivity
 from tapiriik.services.interchange import UploadedActivity, ActivityType, WaypointType, Waypoint, Location
-from tapiriik.database import cachedb
+from tapiriik.services.streams import StreamAligner
 from django.core.urlresolvers import reverse
 from datetime import datetime, timedelta
-import requests
 import urllib.parse
 import json
 import logging
@@ -38,6 +37,7 @@ class RunKeeperService(ServiceBase):
 
     SupportsHR = True
     SupportsCalories = True
+    StreamAlignmentTolerance = 0  # seconds between a path point and the HR/calorie sample that goes with it - 0 takes only exact matches
 
     _wayptTypeMappings = {"start": WaypointType.Start, "end": WaypointType.End, "pause": WaypointType.Pause, "resume": WaypointType.Resume}
 
@@ -51,7 +51,7 @@ class RunKeeperService(ServiceBase):
         code = req.GET.get("code")
         params = {"grant_type": "authorization_code", "code": code, "client_id": RUNKEEPER_CLIENT_ID, "client_secret": RUNKEEPER_CLIENT_SECRET, "redirect_uri": WEB_ROOT + reverse("oauth_return", kwargs={"service": "runkeeper"})}
 
-        response = requests.post("https://runkeeper.com/apps/token", data=urllib.parse.urlencode(params), headers={"Content-Type": "application/x-www-form-urlencoded"})
+        response = self.HTTP.post("https://runkeeper.com/apps/token", data=urllib.parse.urlencode(params), headers={"Content-Type": "application/x-www-form-urlencoded"})
         if response.status_code != 200:
             raise APIException("Invalid code")
         token = response.json()["access_token"]
@@ -66,7 +66,7 @@ class RunKeeperService(ServiceBase):
         return (uid, {"Token": token})
 
     def RevokeAuthorization(self, serviceRecord):
-        resp = requests.post("https://runkeeper.com/apps/de-authorize", data={"access_token": serviceRecord.Authorization["Token"]})
+        resp = self.HTTP.post("https://runkeeper.com/apps/de-authorize", data={"access_token": serviceRecord.Authorization["Token"]})
         if resp.status_code != 204 and resp.status_code != 200:
             raise APIException("Unable to deauthorize RK auth token, status " + str(resp.status_code) + " resp " + resp.text)
         pass
@@ -78,7 +78,7 @@ class RunKeeperService(ServiceBase):
         if hasattr(self, "_uris"):  # cache these for the life of the batch job at least? hope so
             return self._uris
         else:
-            response = requests.get("https://api.runkeeper.com/user/", headers=self._apiHeaders(serviceRecord))
+            response = self.HTTP.get("https://api.runkeeper.com/user/", headers=self._apiHeaders(serviceRecord))
 
             if response.status_code != 200:
                 if response.status_code == 401 or response.status_code == 403:
@@ -93,26 +93,28 @@ class RunKeeperService(ServiceBase):
             return uris
 
     def _getUserId(self, serviceRecord):
-        resp = requests.get("https://api.runkeeper.com/user/", headers=self._apiHeaders(serviceRecord))
+        resp = self.HTTP.get("https://api.runkeeper.com/user/", headers=self._apiHeaders(serviceRecord))
         data = resp.json()
         return data["userID"]
 
-    def DownloadActivityList(self, serviceRecord, exhaustive=False):
+    def DownloadActivityList(self, serviceRecord, exhaustive=False, since=None):
         uris = self._getAPIUris(serviceRecord)
 
         allItems = []
 
         pageUri = uris["fitness_activities"]
+        if since and not exhaustive:
+            pageUri += "?" + urllib.parse.urlencode({"noEarlierThan": since.strftime("%Y-%m-%d")})  # the next page links keep this
 
         while True:
-            response = requests.get(pageUri, headers=self._apiHeaders(serviceRecord))
+            response = self.HTTP.get(pageUri, headers=self._apiHeaders(serviceRecord))
             if response.status_code != 200:
                 if response.status_code == 401 or response.status_code == 403:
                     raise APIException("No authorization to retrieve activity list", block=True, user_exception=UserException(UserExceptionType.Authorization, intervention_required=True))
                 raise APIException("Unable to retrieve activity list " + str(response) + " " + response.text)
             data = response.json()
             allItems += data["items"]
-            if not exhaustive or "next" not in data or data["next"] == "":
+            if not (exhaustive or since) or "next" not in data or data["next"] == "":
                 break
             pageUri = "https://api.runkeeper.com" + data["next"]
 
@@ -149,23 +151,29 @@ class RunKeeperService(ServiceBase):
         activity.CalculateUID()
         return activity
 
+    def HasNewActivities(self, serviceRecord, since):
+        uris = self._getAPIUris(serviceRecord)
+        response = self.HTTP.get(uris["fitness_activities"], headers=self._apiHeaders(serviceRecord), params={"noEarlierThan": since.strftime("%Y-%m-%d"), "pageSize": 1})
+        return response.status_code != 200 or response.json()["size"] > 0
+
     def DownloadActivity(self, serviceRecord, activity):
         activityID = [x["ActivityID"] for x in activity.UploadedTo if x["Connection"] == serviceRecord][0]
-        if AGGRESSIVE_CACHE:
-            ridedata = cachedb.rk_activity_cache.find_one({"uri": activityID})
-        if not AGGRESSIVE_CACHE or ridedata is None:
-            response = requests.get("https://api.runkeeper.com" + activityID, headers=self._apiHeaders(serviceRecord))
+
+        def download():
+            response = self.HTTP.get("https://api.runkeeper.com" + activityID, headers=self._apiHeaders(serviceRecord))
             if response.status_code != 200:
                 if response.status_code == 401 or response.status_code == 403:
                     raise APIException("No authorization to download activity" + activityID, block=True, user_exception=UserException(UserExceptionType.Authorization, intervention_required=True))
                 raise APIException("Unable to download activity " + activityID + " response " + str(response) + " " + response.text)
-            ridedata = response.json()
-            ridedata["Owner"] = serviceRecord.ExternalID
-            if AGGRESSIVE_CACHE:
-                cachedb.rk_activity_cache.insert(ridedata)
+            return response.content
+
+        def parse(payload):
+            ridedata = json.loads(payload.decode("utf-8"))
+            if "is_live" in ridedata and ridedata["is_live"] is True:
+                raise APIExcludeActivity("Not complete", activityId=activityID, permanent=False)  # and so not to be cached
+            return ridedata
 
-        if "is_live" in ridedata and ridedata["is_live"] is True:
-            raise APIExcludeActivity("Not complete", activityId=activityID, permanent=False)
+        ridedata = self.CachedDownload(serviceRecord, activityID, download, parse)
 
         if "userID" in ridedata and int(ridedata["userID"]) != int(serviceRecord.ExternalID):
             raise APIExcludeActivity("Not the user's own activity", activityId=activityID)
@@ -185,19 +193,21 @@ class RunKeeperService(ServiceBase):
         #  path is the primary stream, HR/power/etc must have fewer pts
         hasHR = "heart_rate" in rawData and len(rawData["heart_rate"]) > 0
         hasCalories = "calories" in rawData and len(rawData["calories"]) > 0
-        for pathpoint in rawData["path"]:
+        streams = {}
+        if hasHR:
+            streams["heart_rate"] = [(x["timestamp"], x["heart_rate"]) for x in rawData["heart_rate"]]
+        if hasCalories:
+            streams["calories"] = [(x["timestamp"], x["calories"]) for x in rawData["calories"]]
+        columns = StreamAligner.AlignStreams([pathpoint["timestamp"] for pathpoint in rawData["path"]], streams, tolerance=self.StreamAlignmentTolerance)
+        for idx, pathpoint in enumerate(rawData["path"]):
             waypoint = Waypoint(activity.StartTime + timedelta(0, pathpoint["timestamp"]))
             waypoint.Location = Location(pathpoint["latitude"], pathpoint["longitude"], pathpoint["altitude"] if "altitude" in pathpoint and float(pathpoint["altitude"]) != 0 else None)  # if you're running near sea level, well...
             waypoint.Type = self._wayptTypeMappings[pathpoint["type"]] if pathpoint["type"] in self._wayptTypeMappings else WaypointType.Regular
 
             if hasHR:
-                hrpoint = [x for x in rawData["heart_rate"] if x["timestamp"] == pathpoint["timestamp"]]
-                if len(hrpoint) > 0:
-                    waypoint.HR = hrpoint[0]["heart_rate"]
+                waypoint.HR = columns["heart_rate"][idx]
             if hasCalories:
-                calpoint = [x for x in rawData["calories"] if x["timestamp"] == pathpoint["timestamp"]]
-                if len(calpoint) > 0:
-                    waypoint.Calories = calpoint[0]["calories"]
+                waypoint.Calories = columns["calories"][idx]
 
             activity.Waypoints.append(waypoint)
 
@@ -207,7 +217,7 @@ class RunKeeperService(ServiceBase):
         uris = self._getAPIUris(serviceRecord)
         headers = self._apiHeaders(serviceRecord)
         headers["Content-Type"] = "application/vnd.com.runkeeper.NewFitnessActivity+json"
-        response = requests.post(uris["fitness_activities"], headers=headers, data=json.dumps(uploadData))
+        response = self.HTTP.post(uris["fitness_activities"], headers=headers, data=json.dumps(uploadData))
 
         if response.status_code != 201:
             if response.status_code == 401 or response.status_code == 403:
@@ -261,4 +271,4 @@ class RunKeeperService(ServiceBase):
         return record
 
     def DeleteCachedData(self, serviceRecord):
-        cachedb.rk_activity_cache.remove({"Owner": serviceRecord.ExternalID})
+        pass  # No cached data...
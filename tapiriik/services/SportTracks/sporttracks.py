@@ -2,14 +2,13 @@ from tapiriik.settings import WEB_ROOT, SPORTTRACKS_OPENFIT_ENDPOINT
 from tapiriik.services.service_base import ServiceAuthenticationType, ServiceBase
 from tapiriik.services.interchange import UploadedActivity, ActivityType, Waypoint, WaypointType, Location
 from tapiriik.services.api import APIException, UserException, UserExceptionType, APIExcludeActivity
+from tapiriik.services.streams import StreamAligner
 from tapiriik.services.sessioncache import SessionCache
+from tapiriik.services.iso8601 import ParseISO8601
 
 from django.core.urlresolvers import reverse
 import pytz
 from datetime import timedelta
-import dateutil.parser
-from dateutil.tz import tzutc
-import requests
 import json
 
 import logging
@@ -146,7 +145,7 @@ class SportTracksService(ServiceBase):
             password = CredentialStore.Decrypt(record.ExtendedAuthorization["Password"])
             email = CredentialStore.Decrypt(record.ExtendedAuthorization["Email"])
         params = {"username": email, "password": password}
-        resp = requests.post(self.OpenFitEndpoint + "/user/login", data=json.dumps(params), allow_redirects=False, headers={"Accept": "application/json", "Content-Type": "application/json"})
+        resp = self.HTTP.post(self.OpenFitEndpoint + "/user/login", data=json.dumps(params), allow_redirects=False, headers={"Accept": "application/json", "Content-Type": "application/json"})
         if resp.status_code != 200:
             raise APIException("Invalid login", block=True, user_exception=UserException(UserExceptionType.Authorization, intervention_required=True))
 
@@ -169,14 +168,15 @@ class SportTracksService(ServiceBase):
     def DeleteCachedData(self, serviceRecord):
         pass  # No cached data...
 
-    def DownloadActivityList(self, serviceRecord, exhaustive=False):
+    def DownloadActivityList(self, serviceRecord, exhaustive=False, since=None):
         cookies = self._get_cookies(record=serviceRecord)
         activities = []
         exclusions = []
+        earliestDate = None
         pageUri = self.OpenFitEndpoint + "/fitnessActivities.json"
         while True:
             logger.debug("Req against " + pageUri)
-            res = requests.get(pageUri, cookies=cookies)
+            res = self.HTTP.get(pageUri, cookies=cookies)
             res = res.json()
             for act in res["items"]:
                 activity = UploadedActivity()
@@ -184,13 +184,13 @@ class SportTracksService(ServiceBase):
 
                 if len(act["name"].strip()):
                     activity.Name = act["name"]
-                activity.StartTime = dateutil.parser.parse(act["start_time"])
-                if isinstance(activity.StartTime.tzinfo, tzutc):
-                    activity.TZ = pytz.utc # The dateutil tzutc doesn't have an _offset value.
-                else:
-                    activity.TZ = pytz.FixedOffset(activity.StartTime.tzinfo._offset.total_seconds() / 60)  # Convert the dateutil lame timezones into pytz awesome timezones.
-
-                activity.StartTime = activity.StartTime.replace(tzinfo=activity.TZ)
+                activity.StartTime = ParseISO8601(act["start_time"])
+                startTime = activity.StartTime if activity.StartTime.tzinfo else pytz.utc.localize(activity.StartTime)  # just for comparing against since
+                if earliestDate is None or startTime < earliestDate:
+                    earliestDate = startTime
+                if since and startTime < since and not exhaustive:
+                    continue  # before we go looking for its TZ
+                activity.TZ = activity.StartTime.tzinfo  # pytz.utc or a pytz.FixedOffset
                 activity.EndTime = activity.StartTime + timedelta(seconds=float(act["duration"]))
 
                 # Sometimes activities get returned with a UTC timezone even when they are clearly not in UTC.
@@ -220,7 +220,7 @@ class SportTracksService(ServiceBase):
 
                 activity.CalculateUID()
                 activities.append(activity)
-            if not exhaustive or "next" not in res or not len(res["next"]):
+            if "next" not in res or not len(res["next"]) or not (exhaustive or (since and earliestDate and earliestDate >= since)):
                 break
             else:
                 pageUri = res["next"]
@@ -228,16 +228,21 @@ class SportTracksService(ServiceBase):
 
     def _downloadActivity(self, serviceRecord, activity, returnFirstLocation=False):
         activityURI = [x["ActivityURI"] for x in activity.UploadedTo if x["Connection"] == serviceRecord][0]
-        cookies = self._get_cookies(record=serviceRecord)
-        activityData = requests.get(activityURI, cookies=cookies)
-        activityData = activityData.json()
+
+        def download():
+            response = self.HTTP.get(activityURI, cookies=self._get_cookies(record=serviceRecord))
+            if response.status_code != 200:
+                raise APIException("Unable to download activity " + activityURI + " status " + str(response.status_code))
+            return response.content
+
+        activityData = self.CachedDownload(serviceRecord, activityURI, download, lambda payload: json.loads(payload.decode("utf-8")))
         if "location" not in activityData:
             raise APIExcludeActivity("No points")
 
         timerStops = []
         if "timer_stops" in activityData:
             for stop in activityData["timer_stops"]:
-                timerStops.append([dateutil.parser.parse(stop[0]), dateutil.parser.parse(stop[1])])
+                timerStops.append([ParseISO8601(stop[0]), ParseISO8601(stop[1])])
 
         def isInTimerStop(timestamp):
             for stop in timerStops:
@@ -250,44 +255,35 @@ class SportTracksService(ServiceBase):
         laps = []
         if "laps" in activityData:
             for lap in activityData["laps"]:
-                laps.append(dateutil.parser.parse(lap["start_time"]))
+                laps.append(ParseISO8601(lap["start_time"]))
         # Collate the individual streams into our waypoints.
         # Everything is resampled by nearest-neighbour to the rate of the location stream.
-        parallel_indices = {}
-        parallel_stream_lengths = {}
-        for secondary_stream in ["elevation", "heartrate", "power", "cadence"]:
-            if secondary_stream in activityData:
-                parallel_indices[secondary_stream] = 0
-                parallel_stream_lengths[secondary_stream] = len(activityData[secondary_stream])
+        locations = StreamAligner.Interleaved(activityData["location"])
+        if returnFirstLocation:
+            locations = locations[:1]
+        streams = dict((stream, StreamAligner.Interleaved(activityData[stream])) for stream in ["elevation", "heartrate", "power", "cadence"] if stream in activityData)
+        columns = StreamAligner.AlignStreams([offset for offset, location in locations], streams, tolerance=None)
 
         activity.Waypoints = []
         wasInPause = False
         currentLapIdx = 0
-        for idx in range(0, len(activityData["location"]), 2):
-            # Pick the nearest indices in the parallel streams
-            for parallel_stream, parallel_index in parallel_indices.items():
-                if parallel_index + 2 == parallel_stream_lengths[parallel_stream]:
-                    continue  # We're at the end of this stream
-                # Is the next datapoint a better choice than the current?
-                if abs(activityData["location"][idx] - activityData[parallel_stream][parallel_index + 2]) < abs(activityData["location"][idx] - activityData[parallel_stream][parallel_index]):
-                    parallel_indices[parallel_stream] += 2
-
-            waypoint = Waypoint(activity.StartTime + timedelta(0, activityData["location"][idx]))
-            waypoint.Location = Location(activityData["location"][idx+1][0], activityData["location"][idx+1][1], None)
-            if "elevation" in parallel_indices:
-                waypoint.Location.Altitude = activityData["elevation"][parallel_indices["elevation"]+1]
+        for idx, (offset, location) in enumerate(locations):
+            waypoint = Waypoint(activity.StartTime + timedelta(0, offset))
+            waypoint.Location = Location(location[0], location[1], None)
+            if "elevation" in columns:
+                waypoint.Location.Altitude = columns["elevation"][idx]
 
             if returnFirstLocation:
                 return waypoint.Location
 
-            if "heartrate" in parallel_indices:
-                waypoint.HR = activityData["heartrate"][parallel_indices["heartrate"]+1]
+            if "heartrate" in columns:
+                waypoint.HR = columns["heartrate"][idx]
 
-            if "power" in parallel_indices:
-                waypoint.Power = activityData["power"][parallel_indices["power"]+1]
+            if "power" in columns:
+                waypoint.Power = columns["power"][idx]
 
-            if "cadence" in parallel_indices:
-                waypoint.Cadence = activityData["cadence"][parallel_indices["cadence"]+1]
+            if "cadence" in columns:
+                waypoint.Cadence = columns["cadence"][idx]
 
 
             inPause = isInTimerStop(waypoint.Timestamp)
@@ -365,7 +361,7 @@ class SportTracksService(ServiceBase):
         activityData["timer_stops"] = [[y.isoformat() for y in x] for x in timer_stops]
 
         cookies = self._get_cookies(record=serviceRecord)
-        upload_resp = requests.post(self.OpenFitEndpoint + "/fitnessActivities.json", data=json.dumps(activityData), cookies=cookies, headers={"Content-Type": "application/json"})
+        upload_resp = self.HTTP.post(self.OpenFitEndpoint + "/fitnessActivities.json", data=json.dumps(activityData), cookies=cookies, headers={"Content-Type": "application/json"})
         if upload_resp.status_code != 200:
             if upload_resp.status_code == 401:
                 raise APIException("ST.mobi trial expired", block=True, user_exception=UserException(UserExceptionType.AccountExpired, intervention_required=True))
@@ -4,12 +4,14 @@ from tapiriik.services.service_record import ServiceRecord
 from tapiriik.database import cachedb
 from tapiriik.services.interchange import UploadedActivity, ActivityType, Waypoint, WaypointType, Location
 from tapiriik.services.api import APIException, UserException, UserExceptionType, APIExcludeActivity
-from tapiriik.services.tcx import TCXIO
+from tapiriik.services.render_cache import RenderCache
+from tapiriik.services.ratelimit import RateLimit
+from tapiriik.services.streams import StreamAligner
 
 from django.core.urlresolvers import reverse
 from datetime import datetime, timedelta
 import calendar
-import requests
+import json
 import os
 import logging
 import pytz
@@ -28,6 +30,8 @@ class StravaService(ServiceBase):
 
     SupportsHR = SupportsCadence = SupportsTemp = SupportsPower = True
 
+    RateLimits = [RateLimit(600, timedelta(minutes=15)), RateLimit(30000, timedelta(days=1))]  # for the application as a whole
+
     # For mapping Strava->common; no ambiguity in Strava activity type
     _activityTypeMappings = {
         ActivityType.Cycling: "Ride",
@@ -71,7 +75,7 @@ class StravaService(ServiceBase):
         code = req.GET.get("code")
         params = {"grant_type": "authorization_code", "code": code, "client_id": STRAVA_CLIENT_ID, "client_secret": STRAVA_CLIENT_SECRET, "redirect_uri": WEB_ROOT + reverse("oauth_return", kwargs={"service": "strava"})}
 
-        response = requests.post("https://www.strava.com/oauth/token", data=params)
+        response = self.HTTP.post("https://www.strava.com/oauth/token", data=params)
         self._logAPICall("auth-token", None, response.status_code != 200)
         if response.status_code != 200:
             raise APIException("Invalid code")
@@ -79,7 +83,7 @@ class StravaService(ServiceBase):
 
         authorizationData = {"OAuthToken": data["access_token"]}
         # Retrieve the user ID, meh.
-        id_resp = requests.get("https://www.strava.com/api/v3/athlete", headers=self._apiHeaders(ServiceRecord({"Authorization": authorizationData})))
+        id_resp = self.HTTP.get("https://www.strava.com/api/v3/athlete", headers=self._apiHeaders(ServiceRecord({"Authorization": authorizationData})))
         self._logAPICall("auth-extid", None, None)
         return (id_resp.json()["id"], authorizationData)
 
@@ -87,14 +91,21 @@ class StravaService(ServiceBase):
         #  you can't revoke the tokens strava distributes :\
         pass
 
-    def DownloadActivityList(self, svcRecord, exhaustive=False):
+    def DownloadActivityList(self, svcRecord, exhaustive=False, since=None):
         activities = []
         exclusions = []
         before = earliestDate = None
+        page = 1
+        pageSz = 200
 
         while True:
-            logger.debug("Req with before=" + str(before) + "/" + str(earliestDate))
-            resp = requests.get("https://www.strava.com/api/v3/athletes/" + str(svcRecord.ExternalID) + "/activities", headers=self._apiHeaders(svcRecord), params={"before": before})
+            if since and not exhaustive:
+                # With after=, they come back oldest first - so keep going until there's a short page.
+                params = {"after": calendar.timegm(since.utctimetuple()), "page": page, "per_page": pageSz}
+            else:
+                params = {"before": before}
+            logger.debug("Req with " + str(params) + "/" + str(earliestDate))
+            resp = self.HTTP.get("https://www.strava.com/api/v3/athletes/" + str(svcRecord.ExternalID) + "/activities", headers=self._apiHeaders(svcRecord), params=params)
             self._logAPICall("list", (svcRecord.ExternalID, str(earliestDate)), resp.status_code == 401)
             if resp.status_code == 401:
                 raise APIException("No authorization to retrieve activity list", block=True, user_exception=UserException(UserExceptionType.Authorization, intervention_required=True))
@@ -138,25 +149,47 @@ class StravaService(ServiceBase):
                 activity.CalculateUID()
                 activities.append(activity)
 
-            if not exhaustive or not earliestDate:
+            if since and not exhaustive:
+                if len(reqdata) < pageSz:
+                    break
+                page += 1
+            elif not exhaustive or not earliestDate:
                 break
 
         return activities, exclusions
 
+    def HasNewActivities(self, svcRecord, since):
+        resp = self.HTTP.get("https://www.strava.com/api/v3/athletes/" + str(svcRecord.ExternalID) + "/activities", headers=self._apiHeaders(svcRecord), params={"after": calendar.timegm(since.utctimetuple()), "per_page": 1})
+        self._logAPICall("preflight", (svcRecord.ExternalID, str(since)), resp.status_code != 200)
+        return resp.status_code != 200 or len(resp.json()) > 0
+
     def DownloadActivity(self, svcRecord, activity):
         # thanks to Cosmo Catalano for the API reference code
         activityID = [x["ActivityID"] for x in activity.UploadedTo if x["Connection"] == svcRecord][0]
 
-        streamdata = requests.get("https://www.strava.com/api/v3/activities/" + str(activityID) + "/streams/time,altitude,heartrate,cadence,watts,watts_calc,temp,resting,latlng", headers=self._apiHeaders(svcRecord))
-        if streamdata.status_code == 401:
-            self._logAPICall("download", (svcRecord.ExternalID, str(activity.StartTime)), "auth")
-            raise APIException("No authorization to download activity", block=True, user_exception=UserException(UserExceptionType.Authorization, intervention_required=True))
-
-        streamdata = streamdata.json()
-
-        if "message" in streamdata and streamdata["message"] == "Record Not Found":
-            self._logAPICall("download", (svcRecord.ExternalID, str(activity.StartTime)), "missing")
-            raise APIException("Could not find activity")
+        def download():
+            response = self.HTTP.get("https://www.strava.com/api/v3/activities/" + str(activityID) + "/streams/time,altitude,heartrate,cadence,watts,watts_calc,temp,resting,latlng", headers=self._apiHeaders(svcRecord))
+            if response.status_code == 401:
+                self._logAPICall("download", (svcRecord.ExternalID, str(activity.StartTime)), "auth")
+                raise APIException("No authorization to download activity", block=True, user_exception=UserException(UserExceptionType.Authorization, intervention_required=True))
+            if response.status_code == 404:
+                self._logAPICall("download", (svcRecord.ExternalID, str(activity.StartTime)), "missing")
+                raise APIException("Could not find activity")
+            if response.status_code != 200:
+                raise APIException("Unable to download activity " + str(activityID) + " response " + response.text + " status " + str(response.status_code))
+            return response.content
+
+        def parse(payload):
+            # The streams come as a list - a dict is an error, which shouldn't be cached.
+            streamdata = json.loads(payload.decode("utf-8"))
+            if "message" in streamdata and streamdata["message"] == "Record Not Found":
+                self._logAPICall("download", (svcRecord.ExternalID, str(activity.StartTime)), "missing")
+                raise APIException("Could not find activity")
+            if type(streamdata) is not list:
+                raise APIException("Unable to download activity " + str(activityID) + " response " + payload.decode("utf-8"))
+            return streamdata
+
+        streamdata = self.CachedDownload(svcRecord, activityID, download, parse)
 
         ridedata = {}
         for stream in streamdata:
@@ -178,11 +211,11 @@ class StravaService(ServiceBase):
 
         hasLocation = False
         waypointCt = len(ridedata["time"])
+        # Strava's streams are all sampled together - they line up by index, but one running short shouldn't take the rest down with it.
+        columns = StreamAligner.AlignStreams(range(0, waypointCt - 1), dict((stream, list(enumerate(ridedata[stream]))) for stream in ["latlng", "altitude", "heartrate", "cadence", "temp", "watts", "resting"] if stream in ridedata))
         for idx in range(0, waypointCt - 1):
-            latlng = ridedata["latlng"][idx]
-
             waypoint = Waypoint(activity.StartTime + timedelta(0, ridedata["time"][idx]))
-            latlng = ridedata["latlng"][idx]
+            latlng = columns["latlng"][idx] if "latlng" in columns and columns["latlng"][idx] else (0, 0)
             waypoint.Location = Location(latlng[0], latlng[1], None)
             if waypoint.Location.Longitude == 0 and waypoint.Location.Latitude == 0:
                 waypoint.Location.Longitude = None
@@ -190,27 +223,27 @@ class StravaService(ServiceBase):
             else:  # strava only returns 0 as invalid coords, so no need to check for null (update: ??)
                 hasLocation = True
             if hasAltitude:
-                waypoint.Location.Altitude = float(ridedata["altitude"][idx])
+                waypoint.Location.Altitude = float(columns["altitude"][idx]) if columns["altitude"][idx] is not None else None
 
             if idx == 0:
                 waypoint.Type = WaypointType.Start
             elif idx == waypointCt - 2:
                 waypoint.Type = WaypointType.End
-            elif hasRestingData and not moving and ridedata["resting"][idx] is False:
+            elif hasRestingData and not moving and columns["resting"][idx] is False:
                 waypoint.Type = WaypointType.Resume
                 moving = True
-            elif hasRestingData and ridedata["resting"][idx] is True:
+            elif hasRestingData and columns["resting"][idx] is True:
                 waypoint.Type = WaypointType.Pause
                 moving = False
 
             if hasHR:
-                waypoint.HR = ridedata["heartrate"][idx]
+                waypoint.HR = columns["heartrate"][idx]
             if hasCadence:
-                waypoint.Cadence = ridedata["cadence"][idx]
+                waypoint.Cadence = columns["cadence"][idx]
             if hasTemp:
-                waypoint.Temp = ridedata["temp"][idx]
+                waypoint.Temp = columns["temp"][idx]
             if hasPower:
-                waypoint.Power = ridedata["watts"][idx]
+                waypoint.Power = columns["watts"][idx]
             activity.Waypoints.append(waypoint)
         if not hasLocation:
             self._logAPICall("download", (svcRecord.ExternalID, str(activity.StartTime)), "faulty")
@@ -228,16 +261,12 @@ class StravaService(ServiceBase):
                 "activity_type": self._activityTypeMappings[activity.Type],
                 "private": activity.Private}
 
-        if "tcx" in activity.PrerenderedFormats:
-            logger.debug("Using prerendered TCX")
-            tcxData = activity.PrerenderedFormats["tcx"]
-        else:
+        if "tcx" not in activity.PrerenderedFormats:
             activity.EnsureTZ()
-            tcxData = TCXIO.Dump(activity)
-        # TODO: put the tcx back into PrerenderedFormats once there's more RAM to go around and there's a possibility of it actually being used.
+        tcxData = RenderCache.Render(activity, "tcx")
         files = {"file":(req["external_id"] + ".tcx", tcxData)}
 
-        response = requests.post("http://www.strava.com/api/v3/uploads", data=req, files=files, headers=self._apiHeaders(serviceRecord))
+        response = self.HTTP.post("http://www.strava.com/api/v3/uploads", data=req, files=files, headers=self._apiHeaders(serviceRecord))
         if response.status_code != 201:
             self._logAPICall("upload", (serviceRecord.ExternalID, str(activity.StartTime)), response.text)
             if response.status_code == 401:
@@ -251,7 +280,7 @@ class StravaService(ServiceBase):
         upload_id = response.json()["id"]
         while not response.json()["activity_id"]:
             time.sleep(1)
-            response = requests.get("http://www.strava.com/api/v3/uploads/%s" % upload_id, headers=self._apiHeaders(serviceRecord))
+            response = self.HTTP.get("http://www.strava.com/api/v3/uploads/%s" % upload_id, headers=self._apiHeaders(serviceRecord))
             logger.debug("Waiting for upload - status %s id %s" % (response.json()["status"], response.json()["activity_id"]))
             if response.json()["error"]:
                 error = response.json()["error"]
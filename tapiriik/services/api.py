@@ -22,6 +22,10 @@ class APIException(ServiceException):
 class APIWarning(ServiceWarning):
     pass
 
+class APIDeferral(APIException):
+    # The remote end won't take any more from us for now - nothing's wrong, it just has to wait for a later (regular) sync.
+    pass
+
 # Theoretically, APIExcludeActivity should actually be a ServiceException with block=True, scope=Activity
 # It's on the to-do list.
 
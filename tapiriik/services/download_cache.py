@@ -0,0 +1,83 @@
+from tapiriik.database import cachedb
+from tapiriik.settings import DOWNLOAD_CACHE_SIZE, DOWNLOAD_CACHE_TTL
+from datetime import datetime, timedelta
+import threading
+import zlib
+import logging
+logger = logging.getLogger(__name__)
+
+
+class ActivityDownloadCache:
+    """ Activities as they came from the service, kept zlib-compressed in cachedb.download_cache so retried and exhaustive syncs needn't download them again.
+        Entries are keyed on (service, account, activity ID, revision) - services that can't tell when an activity has changed pass no revision, and rely on the TTL to not hand out stale copies for long.
+        Entries are dropped DOWNLOAD_CACHE_TTL seconds after they were stored, however often they're used - and the least recently used ones go early, until the rest fit in DOWNLOAD_CACHE_SIZE bytes (checked every EvictionInterval stores).
+    """
+    EvictionInterval = 100
+
+    def __init__(self, size=DOWNLOAD_CACHE_SIZE, ttl=DOWNLOAD_CACHE_TTL):
+        self._size = size
+        self._ttl = timedelta(seconds=ttl)
+        self._lock = threading.Lock()
+        self._storesSinceEviction = 0
+        self._dbIndexEnsured = False
+        self.Hits = self.Misses = 0
+
+    def Get(self, serviceId, owner, activityId, revision=None):
+        self._ensureIndexes()
+        now = datetime.utcnow()
+        rec = cachedb.download_cache.find_one({"Service": serviceId, "Owner": owner, "ActivityID": str(activityId), "Revision": revision})
+        if not rec or "Stored" not in rec or rec["Stored"] < now - self._ttl:
+            with self._lock:
+                self.Misses += 1
+            return None
+        cachedb.download_cache.update({"_id": rec["_id"]}, {"$set": {"LastUsed": now}})
+        with self._lock:
+            self.Hits += 1
+        return zlib.decompress(rec["Data"])
+
+    def Store(self, serviceId, owner, activityId, payload, revision=None):
+        self._ensureIndexes()
+        compressed = zlib.compress(payload)
+        # Any other revision is out of date now.
+        cachedb.download_cache.remove({"Service": serviceId, "Owner": owner, "ActivityID": str(activityId), "Revision": {"$ne": revision}})
+        cachedb.download_cache.update({"Service": serviceId, "Owner": owner, "ActivityID": str(activityId), "Revision": revision},
+                                      {"$set": {"Data": compressed, "Size": len(compressed), "Stored": datetime.utcnow(), "LastUsed": datetime.utcnow()}},
+                                      upsert=True)
+        with self._lock:
+            self._storesSinceEviction += 1
+            if self._storesSinceEviction < self.EvictionInterval:
+                return
+            self._storesSinceEviction = 0
+        self.Evict()
+
+    def Discard(self, serviceId, owner, activityId, revision=None):
+        cachedb.download_cache.remove({"Service": serviceId, "Owner": owner, "ActivityID": str(activityId), "Revision": revision})
+
+    def Remove(self, serviceId, owner):
+        cachedb.download_cache.remove({"Service": serviceId, "Owner": owner})
+
+    def Evict(self):
+        cachedb.download_cache.remove({"$or": [{"Stored": {"$lt": datetime.utcnow() - self._ttl}}, {"Stored": {"$exists": False}}]})
+        total = 0
+        evicted = []
+        for rec in cachedb.download_cache.find({}, {"Size": True}).sort("LastUsed", -1):
+            total += rec["Size"]
+            if total > self._size:
+                evicted.append(rec["_id"])
+        if evicted:
+            logger.info("Evicting %d cached downloads" % len(evicted))
+            cachedb.download_cache.remove({"_id": {"$in": evicted}})
+
+    def Stats(self):
+        with self._lock:
+            return {"Hits": self.Hits, "Misses": self.Misses}
+
+    def _ensureIndexes(self):
+        if self._dbIndexEnsured:
+            return
+        cachedb.download_cache.ensure_index([("Service", 1), ("Owner", 1), ("ActivityID", 1), ("Revision", 1)])
+        cachedb.download_cache.ensure_index("LastUsed")
+        cachedb.download_cache.ensure_index("Stored")
+        self._dbIndexEnsured = True
+
+DownloadCache = ActivityDownloadCache()
@@ -1,9 +1,11 @@
 from lxml import etree
 from pytz import UTC
+from io import BytesIO
 import copy
-import dateutil.parser
 from datetime import datetime
 from .interchange import WaypointType, Activity, Waypoint, Location
+from .xmlstream import XMLStreamWriter
+from .iso8601 import ParseISO8601
 
 
 class GPXIO:
@@ -14,101 +16,151 @@ class GPXIO:
         "gpxext": "http://www.garmin.com/xmlschemas/GpxExtensions/v3"
     }
 
-    def Parse(gpxData):
-        ns = copy.deepcopy(GPXIO.Namespaces)
-        ns["gpx"] = ns[None]
-        del ns[None]
+    def Parse(gpxData, minimumWaypoints=False):
+        """ Reads GPX data (bytes, str, or a file-like object) into an Activity, one trackpoint at a time.
+            With minimumWaypoints, it stops after the first trackpoint - the activity then has a StartTime but no EndTime or Distance.
+        """
+        gpxNS = "{" + GPXIO.Namespaces[None] + "}"
+        metadataTag, nameTag, trkTag, trksegTag, trkptTag = [gpxNS + x for x in ["metadata", "name", "trk", "trkseg", "trkpt"]]
         act = Activity()
         act.Distance = None
 
-        try:
-            root = etree.XML(gpxData)
-        except:
-            root = etree.fromstring(gpxData)
+        if isinstance(gpxData, str):
+            gpxData = gpxData.encode("UTF-8")
+        if isinstance(gpxData, bytes):
+            gpxData = BytesIO(gpxData)
 
-        xmeta = root.find("gpx:metadata", namespaces=ns)
-        if xmeta is not None:
-            xname = xmeta.find("gpx:name", namespaces=ns)
-            if xname is not None:
-                act.Name = xname.text
-        xtrk = root.find("gpx:trk", namespaces=ns)
-
-        if xtrk is None:
-            raise ValueError("Invalid GPX")
-
-        xtrksegs = xtrk.findall("gpx:trkseg", namespaces=ns)
         startTime = None
         endTime = None
 
+        path = []
+        metadataCount = trkCount = 0
+        nameSeen = False
         beginSeg = False
-        for xtrkseg in xtrksegs:
-            beginSeg = True
-            for xtrkpt in xtrkseg.findall("gpx:trkpt", namespaces=ns):
-                wp = Waypoint()
+        for event, el in etree.iterparse(gpxData, events=("start", "end")):
+            if event == "start":
+                path.append(el.tag)
+                if len(path) == 2:
+                    if el.tag == metadataTag:
+                        metadataCount += 1
+                    elif el.tag == trkTag:
+                        trkCount += 1
+                elif len(path) == 3 and el.tag == trksegTag and path[1] == trkTag and trkCount == 1:
+                    beginSeg = True
+                continue
+
+            depth = len(path)
+            path.pop()
+            inFirstTrk = trkCount == 1 and depth > 2 and path[1] == trkTag
+            if depth == 4 and el.tag == trkptTag and inFirstTrk and path[2] == trksegTag:
+                wp = GPXIO._parseTrackpoint(el)
                 if len(act.Waypoints) == 0:
                     wp.Type = WaypointType.Start
                 elif beginSeg:
                     wp.Type = WaypointType.Lap
                 beginSeg = False
 
-                wp.Timestamp = dateutil.parser.parse(xtrkpt.find("gpx:time", namespaces=ns).text)
-                wp.Timestamp.replace(tzinfo=UTC)
                 if startTime is None or wp.Timestamp < startTime:
                     startTime = wp.Timestamp
                 if endTime is None or wp.Timestamp > endTime:
                     endTime = wp.Timestamp
-
-                wp.Location = Location(float(xtrkpt.attrib["lat"]), float(xtrkpt.attrib["lon"]), None)
-                eleEl = xtrkpt.find("gpx:ele", namespaces=ns)
-                if eleEl is not None:
-                    wp.Location.Altitude = float(eleEl.text)
-                extEl = xtrkpt.find("gpx:extensions", namespaces=ns)
-                if extEl is not None:
-                    gpxtpxExtEl = extEl.find("gpxtpx:TrackPointExtension", namespaces=ns)
-                    if gpxtpxExtEl is not None:
-                        hrEl = gpxtpxExtEl.find("gpxtpx:hr", namespaces=ns)
-                        if hrEl is not None:
-                            wp.HR = int(hrEl.text)
-                        cadEl = gpxtpxExtEl.find("gpxtpx:cad", namespaces=ns)
-                        if cadEl is not None:
-                            wp.Cadence = int(cadEl.text)
-                        tempEl = gpxtpxExtEl.find("gpxtpx:atemp", namespaces=ns)
-                        if tempEl is not None:
-                            wp.Temp = float(tempEl.text)
-                    gpxdataHR = extEl.find("gpxdata:hr", namespaces=ns)
-                    if gpxdataHR is not None:
-                        wp.HR = float(gpxdataHR.text)
-                    gpxdataCadence = extEl.find("gpxdata:cadence", namespaces=ns)
-                    if gpxdataCadence is not None:
-                        wp.Cadence = float(gpxdataCadence.text)
-
                 act.Waypoints.append(wp)
 
-            if not len(act.Waypoints):
-                raise ValueError("Track with no points")
+                # The parser keeps everything it's read in the tree unless we throw it out.
+                el.clear()
+                while el.getprevious() is not None:
+                    del el.getparent()[0]
+
+                if minimumWaypoints:
+                    break
+            elif depth == 3 and el.tag == trksegTag and inFirstTrk:
+                if not len(act.Waypoints):
+                    raise ValueError("Track with no points")
+            elif depth == 3 and el.tag == nameTag and path[1] == metadataTag and metadataCount == 1 and not nameSeen:
+                act.Name = el.text
+                nameSeen = True
+            elif depth == 2:
+                el.clear()
+
+        if trkCount == 0:
+            raise ValueError("Invalid GPX")
 
         if not len(act.Waypoints):
             raise ValueError("GPX with no tracks")
-        act.Waypoints[len(act.Waypoints)-1].Type = WaypointType.End
         act.TZ = act.Waypoints[0].Timestamp.tzinfo
         act.StartTime = startTime
+        if minimumWaypoints:
+            act.CalculateUID()
+            return act
+        act.Waypoints[len(act.Waypoints)-1].Type = WaypointType.End
         act.EndTime = endTime
         act.CalculateDistance()
         act.CalculateUID()
         return act
 
+    def _parseTrackpoint(xtrkpt):
+        gpxNS = "{" + GPXIO.Namespaces[None] + "}"
+        gpxtpxNS = "{" + GPXIO.Namespaces["gpxtpx"] + "}"
+        gpxdataNS = "{" + GPXIO.Namespaces["gpxdata"] + "}"
+        wp = Waypoint()
+        wp.Location = Location(float(xtrkpt.attrib["lat"]), float(xtrkpt.attrib["lon"]), None)
+
+        timeEl = eleEl = extEl = None
+        for child in xtrkpt:
+            if child.tag == gpxNS + "time" and timeEl is None:
+                timeEl = child
+            elif child.tag == gpxNS + "ele" and eleEl is None:
+                eleEl = child
+            elif child.tag == gpxNS + "extensions" and extEl is None:
+                extEl = child
+
+        wp.Timestamp = ParseISO8601(timeEl.text, naiveTZ=UTC)  # GPX times are in UTC unless they say otherwise
+
+        if eleEl is not None:
+            wp.Location.Altitude = float(eleEl.text)
+        if extEl is not None:
+            gpxtpxExtEl = gpxdataHR = gpxdataCadence = None
+            for ext in extEl:
+                if ext.tag == gpxtpxNS + "TrackPointExtension" and gpxtpxExtEl is None:
+                    gpxtpxExtEl = ext
+                elif ext.tag == gpxdataNS + "hr" and gpxdataHR is None:
+                    gpxdataHR = ext
+                elif ext.tag == gpxdataNS + "cadence" and gpxdataCadence is None:
+                    gpxdataCadence = ext
+            if gpxtpxExtEl is not None:
+                hrEl = cadEl = tempEl = None
+                for field in gpxtpxExtEl:
+                    if field.tag == gpxtpxNS + "hr" and hrEl is None:
+                        hrEl = field
+                    elif field.tag == gpxtpxNS + "cad" and cadEl is None:
+                        cadEl = field
+                    elif field.tag == gpxtpxNS + "atemp" and tempEl is None:
+                        tempEl = field
+                if hrEl is not None:
+                    wp.HR = int(hrEl.text)
+                if cadEl is not None:
+                    wp.Cadence = int(cadEl.text)
+                if tempEl is not None:
+                    wp.Temp = float(tempEl.text)
+            if gpxdataHR is not None:
+                wp.HR = float(gpxdataHR.text)
+            if gpxdataCadence is not None:
+                wp.Cadence = float(gpxdataCadence.text)
+        return wp
+
     def Dump(activity):
-        GPXTPX = "{" + GPXIO.Namespaces["gpxtpx"] + "}"
-        root = etree.Element("gpx", nsmap=GPXIO.Namespaces)
-        root.attrib["creator"] = "tapiriik-sync"
-        meta = etree.SubElement(root, "metadata")
-        trk = etree.SubElement(root, "trk")
+        return GPXIO.DumpBytes(activity).decode("UTF-8")
+
+    def DumpBytes(activity, prettyPrint=True):
+        stream = BytesIO()
+        GPXIO.DumpToStream(activity, stream, prettyPrint=prettyPrint)
+        return stream.getvalue()
 
-        if activity.Name is not None:
-            etree.SubElement(meta, "name").text = activity.Name
-            etree.SubElement(trk, "name").text = activity.Name
+    def DumpToStream(activity, stream, prettyPrint=True):
+        GPXTPX = "{" + GPXIO.Namespaces["gpxtpx"] + "}"
 
-        trkseg = etree.SubElement(trk, "trkseg")
+        # Work out the segments first, so nothing is written for activities we can't export.
+        trksegs = [[]]
         inPause = False
         for wp in activity.Waypoints:
             if wp.Location is None or wp.Location.Latitude is None or wp.Location.Longitude is None:
@@ -119,24 +171,32 @@ class GPXIO:
                     continue  # this used to be an exception, but I don't think that was merited
                 inPause = True
             if inPause and wp.Type != WaypointType.Pause:
-                trkseg = etree.SubElement(trk, "trkseg")
+                trksegs.append([])
                 inPause = False
-            trkpt = etree.SubElement(trkseg, "trkpt")
             if wp.Timestamp.tzinfo is None:
                 raise ValueError("GPX export requires TZ info")
-            etree.SubElement(trkpt, "time").text = wp.Timestamp.astimezone(UTC).isoformat()
-            trkpt.attrib["lat"] = str(wp.Location.Latitude)
-            trkpt.attrib["lon"] = str(wp.Location.Longitude)
-            if wp.Location.Altitude is not None:
-                etree.SubElement(trkpt, "ele").text = str(wp.Location.Altitude)
-            if wp.HR is not None or wp.Cadence is not None or wp.Temp is not None or wp.Calories is not None or wp.Power is not None:
-                exts = etree.SubElement(trkpt, "extensions")
-                gpxtpxexts = etree.SubElement(exts, GPXTPX + "TrackPointExtension")
-                if wp.HR is not None:
-                    etree.SubElement(gpxtpxexts, GPXTPX + "hr").text = str(int(wp.HR))
-                if wp.Cadence is not None:
-                    etree.SubElement(gpxtpxexts, GPXTPX + "cad").text = str(int(wp.Cadence))
-                if wp.Temp is not None:
-                    etree.SubElement(gpxtpxexts, GPXTPX + "atemp").text = str(wp.Temp)
-
-        return etree.tostring(root, pretty_print=True, xml_declaration=True, encoding="UTF-8").decode("UTF-8")
+            trksegs[-1].append(wp)
+
+        writer = XMLStreamWriter(stream, prettyPrint=prettyPrint)
+        with writer.Document(), writer.Element("gpx", attrib={"creator": "tapiriik-sync"}, nsmap=GPXIO.Namespaces):
+            with writer.Element("metadata"):
+                if activity.Name is not None:
+                    writer.Leaf("name", activity.Name)
+            with writer.Element("trk"):
+                if activity.Name is not None:
+                    writer.Leaf("name", activity.Name)
+                for trkseg in trksegs:
+                    with writer.Element("trkseg"):
+                        for wp in trkseg:
+                            with writer.Element("trkpt", attrib={"lat": str(wp.Location.Latitude), "lon": str(wp.Location.Longitude)}):
+                                writer.Leaf("time", wp.Timestamp.astimezone(UTC).isoformat())
+                                if wp.Location.Altitude is not None:
+                                    writer.Leaf("ele", str(wp.Location.Altitude))
+                                if wp.HR is not None or wp.Cadence is not None or wp.Temp is not None or wp.Calories is not None or wp.Power is not None:
+                                    with writer.Element("extensions"), writer.Element(GPXTPX + "TrackPointExtension"):
+                                        if wp.HR is not None:
+                                            writer.Leaf(GPXTPX + "hr", str(int(wp.HR)))
+                                        if wp.Cadence is not None:
+                                            writer.Leaf(GPXTPX + "cad", str(int(wp.Cadence)))
+                                        if wp.Temp is not None:
+                                            writer.Leaf(GPXTPX + "atemp", str(wp.Temp))
@@ -1,8 +1,8 @@
 from datetime import timedelta, datetime
-from tapiriik.database import cachedb
-from tapiriik.database.tz import TZLookup
+from tapiriik.database.tz import TZCache
 import hashlib
 import pytz
+import math
 
 
 class ActivityType:  # taken from RK API docs. The text values have no meaning except for debugging
@@ -64,6 +64,12 @@ class Activity:
         csp.update(roundedStartTime.strftime("%Y-%m-%d %H:%M:%S").encode('utf-8'))  # exclude TZ for compat
         self.UID = csp.hexdigest()
 
+    def CompactWaypoints(self):
+        """ Swaps the waypoint list for array-backed WaypointColumns - it behaves the same, but takes a fraction of the memory """
+        from tapiriik.services.waypoint_columns import WaypointColumns
+        if not isinstance(self.Waypoints, WaypointColumns):
+            self.Waypoints = WaypointColumns(self.Waypoints)
+
     def GetFirstWaypointWithLocation(self):
         loc_wp = None
         for wp in self.Waypoints:
@@ -90,7 +96,8 @@ class Activity:
         if self.TZ is None:
             raise ValueError("TZ not set")
         self.StartTime = self.StartTime.astimezone(self.TZ)
-        self.EndTime = self.EndTime.astimezone(self.TZ)
+        if self.EndTime:  # not known after a partial parse
+            self.EndTime = self.EndTime.astimezone(self.TZ)
 
         for wp in self.Waypoints:
                 wp.Timestamp = wp.Timestamp.astimezone(self.TZ)
@@ -107,17 +114,11 @@ class Activity:
             if loc is None:
                 raise Exception("Can't find TZ without a waypoint with a location")
 
-        # I guess at some point it will be faster to perform a full lookup than digging through this table.
-        cachedTzData = cachedb.tz_cache.find_one({"Latitude": loc.Latitude, "Longitude": loc.Longitude})
-        if cachedTzData is None:
-            res = TZLookup(loc.Latitude, loc.Longitude)
-            cachedTzData = {"TZ": res, "Latitude": loc.Latitude, "Longitude": loc.Longitude}
-            cachedb.tz_cache.insert(cachedTzData)
-
-        if type(cachedTzData["TZ"]) != str:
-            self.TZ = pytz.FixedOffset(cachedTzData["TZ"] * 60)
+        res = TZCache.Lookup(loc.Latitude, loc.Longitude)
+        if type(res) != str:
+            self.TZ = pytz.FixedOffset(res * 60)
         else:
-            self.TZ = pytz.timezone(cachedTzData["TZ"])
+            self.TZ = pytz.timezone(res)
         return self.TZ
 
     def EnsureTZ(self):
@@ -130,69 +131,22 @@ class Activity:
     def CalculateDistance(self):
         self.Distance = self.GetDistance()
 
-    def GetDistance(self, startWpt=None, endWpt=None):
-        import math
-        dist = 0
-        altHold = None  # seperate from the lastLoc variable, since we want to hold the altitude as long as required
-        lastTimestamp = lastLoc = None
-
-        if not startWpt:
-            startWpt = self.Waypoints[0]
-        if not endWpt:
-            endWpt = self.Waypoints[-1]
-
-        for x in range(self.Waypoints.index(startWpt), self.Waypoints.index(endWpt) + 1):
-            timeDelta = self.Waypoints[x].Timestamp - lastTimestamp if lastTimestamp else None
-            lastTimestamp = self.Waypoints[x].Timestamp
-
-            if self.Waypoints[x].Type == WaypointType.Pause or (timeDelta and timeDelta > self.ImplicitPauseTime):
-                lastLoc = None  # don't count distance while paused
-                continue
-
-            loc = self.Waypoints[x].Location
-            if loc is None or loc.Longitude is None or loc.Latitude is None:
-                # Used to throw an exception in this case, but the TCX schema allows for location-free waypoints, so we'll just patch over it.
-                continue
-
-            if loc and lastLoc:
-                altHold = lastLoc.Altitude if lastLoc.Altitude is not None else altHold
-                latRads = loc.Latitude * math.pi / 180
-                meters_lat_degree = 1000 * 111.13292 + 1.175 * math.cos(4 * latRads) - 559.82 * math.cos(2 * latRads)
-                meters_lon_degree = 1000 * 111.41284 * math.cos(latRads) - 93.5 * math.cos(3 * latRads)
-                dx = (loc.Longitude - lastLoc.Longitude) * meters_lon_degree
-                dy = (loc.Latitude - lastLoc.Latitude) * meters_lat_degree
-                if loc.Altitude is not None and altHold is not None:  # incorporate the altitude when possible
-                    dz = loc.Altitude - altHold
-                else:
-                    dz = 0
-                dist += math.sqrt(dx ** 2 + dy ** 2 + dz ** 2)
-            lastLoc = loc
+    def GetCumulativeStats(self):
+        """ Precomputes distance and moving time along the waypoints, so repeated GetDistance/GetDuration-style queries (e.g. per lap) don't each walk the activity """
+        return CumulativeStats(self)
 
-        return dist
+    def GetDistance(self, startWpt=None, endWpt=None):
+        startIdx = self.Waypoints.index(startWpt) if startWpt else None
+        endIdx = self.Waypoints.index(endWpt) if endWpt else None
+        return self.GetCumulativeStats().GetDistance(startIdx, endIdx)
 
     def GetDuration(self, startWpt=None, endWpt=None):
         if len(self.Waypoints) < 3:
             # Either no waypoints, or one at the start and one at the end - just use regular time elapsed
             return self.EndTime - self.StartTime
-        duration = timedelta(0)
-        if not startWpt:
-            startWpt = self.Waypoints[0]
-        if not endWpt:
-            endWpt = self.Waypoints[-1]
-        lastTimestamp = None
-        for x in range(self.Waypoints.index(startWpt), self.Waypoints.index(endWpt) + 1):
-            wpt = self.Waypoints[x]
-            delta = wpt.Timestamp - lastTimestamp if lastTimestamp else None
-            lastTimestamp = wpt.Timestamp
-            if wpt.Type is WaypointType.Pause:
-                lastTimestamp = None
-            elif delta and delta > self.ImplicitPauseTime:
-                delta = None  # Implicit pauses
-            if delta:
-                duration += delta
-        if duration.total_seconds() == 0 and startWpt is None and endWpt is None:
-            raise ValueError("Zero-duration activity")
-        return duration
+        startIdx = self.Waypoints.index(startWpt) if startWpt else None
+        endIdx = self.Waypoints.index(endWpt) if endWpt else None
+        return self.GetCumulativeStats().GetDuration(startIdx, endIdx)
 
     def CheckSanity(self):
         if not hasattr(self, "UploadedTo") or len(self.UploadedTo) == 0:
@@ -257,6 +211,118 @@ class Activity:
         return not self.__eq__(other)
 
 
+class CumulativeStats:
+    """ Distance and moving time accumulated along an activity's waypoints, built in a single pass.
+        Distances use a local ellipsoid approximation, and neither distance nor time is counted across explicit pauses or gaps longer than Activity.ImplicitPauseTime.
+    """
+    def __init__(self, activity):
+        from tapiriik.services.waypoint_columns import WaypointColumns
+        from array import array
+        self._activity = activity
+        waypoints = activity.Waypoints
+        count = len(waypoints)
+        nan = float("nan")
+
+        if isinstance(waypoints, WaypointColumns):
+            self._types = waypoints.Types
+            self._lat, self._lon, self._alt = waypoints.Latitude, waypoints.Longitude, waypoints.Altitude
+            timestamps = [waypoints.GetTimestamp(x) for x in range(count)]
+        else:
+            self._types = array("B", [wp.Type for wp in waypoints])
+            self._lat, self._lon, self._alt = array("d"), array("d"), array("d")
+            for wp in waypoints:
+                loc = wp.Location
+                self._lat.append(loc.Latitude if loc is not None and loc.Latitude is not None else nan)
+                self._lon.append(loc.Longitude if loc is not None and loc.Longitude is not None else nan)
+                self._alt.append(loc.Altitude if loc is not None and loc.Altitude is not None else nan)
+            timestamps = [wp.Timestamp for wp in waypoints]
+
+        # Time elapsed since the previous waypoint (None for the first), using the same datetime arithmetic as ever.
+        self._timeDeltas = [None] + [(timestamps[x] - timestamps[x - 1]) if timestamps[x - 1] else None for x in range(1, count)]
+
+        # Cumulative distance, plus the state needed to pick up a partial walk part-way through (see GetDistance).
+        self._distances = array("d", [0]) * count
+        self._lastLocIndices = array("q", [-1]) * count
+        self._altHolds = array("d", [nan]) * count
+        dist = 0
+        lastLocIdx = -1
+        altHold = None
+        for x in range(count):
+            lastLocIdx, altHold, segment = self._step(x, x > 0, lastLocIdx, altHold)
+            dist += segment
+            self._distances[x] = dist
+            self._lastLocIndices[x] = lastLocIdx
+            self._altHolds[x] = altHold if altHold is not None else nan
+
+        # Cumulative moving time, in microseconds.
+        self._movingTimes = array("q", [0]) * count
+        movingTime = 0
+        for x in range(1, count):
+            delta = self._timeDeltas[x] if self._types[x - 1] != WaypointType.Pause else None
+            if delta and self._types[x] != WaypointType.Pause and delta > Activity.ImplicitPauseTime:
+                delta = None  # Implicit pauses
+            if delta:
+                movingTime += (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+            self._movingTimes[x] = movingTime
+
+    def _step(self, x, continuing, lastLocIdx, altHold):
+        # Returns the (lastLocIdx, altHold, distance covered) after moving to waypoint x
+        timeDelta = self._timeDeltas[x] if continuing else None
+        if self._types[x] == WaypointType.Pause or (timeDelta and timeDelta > Activity.ImplicitPauseTime):
+            return -1, altHold, 0  # don't count distance while paused
+
+        if math.isnan(self._lat[x]) or math.isnan(self._lon[x]):
+            # Used to throw an exception in this case, but the TCX schema allows for location-free waypoints, so we'll just patch over it.
+            return lastLocIdx, altHold, 0
+
+        if lastLocIdx < 0:
+            return x, altHold, 0
+
+        altHold = self._alt[lastLocIdx] if not math.isnan(self._alt[lastLocIdx]) else altHold
+        latRads = self._lat[x] * math.pi / 180
+        meters_lat_degree = 1000 * 111.13292 + 1.175 * math.cos(4 * latRads) - 559.82 * math.cos(2 * latRads)
+        meters_lon_degree = 1000 * 111.41284 * math.cos(latRads) - 93.5 * math.cos(3 * latRads)
+        dx = (self._lon[x] - self._lon[lastLocIdx]) * meters_lon_degree
+        dy = (self._lat[x] - self._lat[lastLocIdx]) * meters_lat_degree
+        if not math.isnan(self._alt[x]) and altHold is not None:  # incorporate the altitude when possible
+            dz = self._alt[x] - altHold
+        else:
+            dz = 0
+        return x, altHold, math.sqrt(dx ** 2 + dy ** 2 + dz ** 2)
+
+    def _resolveRange(self, startIdx, endIdx):
+        count = len(self._types)
+        if count == 0:
+            raise IndexError("No waypoints")
+        startIdx = 0 if startIdx is None else startIdx
+        endIdx = count - 1 if endIdx is None else endIdx
+        return startIdx, endIdx
+
+    def GetDistance(self, startIdx=None, endIdx=None):
+        startIdx, endIdx = self._resolveRange(startIdx, endIdx)
+        # A walk starting at startIdx doesn't know where the previous point was, so we step along until its state lines up with the full walk - from there on, the cumulative distances apply.
+        dist = 0
+        lastLocIdx = -1
+        altHold = None
+        for x in range(startIdx, endIdx + 1):
+            lastLocIdx, altHold, segment = self._step(x, x > startIdx, lastLocIdx, altHold)
+            dist += segment
+            fullAltHold = self._altHolds[x]
+            if lastLocIdx == self._lastLocIndices[x] and ((altHold is None and math.isnan(fullAltHold)) or altHold == fullAltHold):
+                remaining = self._distances[endIdx] - self._distances[x]
+                return dist + remaining if remaining else dist
+        return dist
+
+    def GetDuration(self, startIdx=None, endIdx=None):
+        if len(self._types) < 3:
+            # Either no waypoints, or one at the start and one at the end - just use regular time elapsed
+            return self._activity.EndTime - self._activity.StartTime
+        startIdx, endIdx = self._resolveRange(startIdx, endIdx)
+        if endIdx <= startIdx:
+            return timedelta(0)
+        return timedelta(microseconds=self._movingTimes[endIdx] - self._movingTimes[startIdx])
+
+
 class UploadedActivity (Activity):
     pass  # will contain list of which service instances contain this activity - not really merited
 
@@ -0,0 +1,37 @@
+from datetime import datetime
+import dateutil.parser
+import pytz
+import re
+
+# The timestamps in GPX/TCX files and the OpenFit API are all (more or less) this one format, which is a lot quicker to pick apart ourselves than to hand to dateutil.
+_iso8601Pattern = re.compile(r"\s*(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(?:[.,](\d+))?(?:(Z)|([+-])(\d\d)(?::?(\d\d))?)?\s*$")
+
+
+def ParseISO8601(text, naiveTZ=None):
+    """ Parses an ISO 8601 timestamp, falling back to dateutil for anything that isn't in the usual YYYY-MM-DDTHH:MM:SS[.fff][Z|+HH:MM] form.
+        Timestamps with an offset come back with a pytz tzinfo (pytz.utc or a pytz.FixedOffset), those without get naiveTZ.
+    """
+    match = _iso8601Pattern.match(text)
+    if match is None:
+        return _parseFallback(text, naiveTZ)
+    year, month, day, hour, minute, second, fraction, zulu, offsetSign, offsetHours, offsetMinutes = match.groups()
+    if zulu:
+        tz = pytz.utc
+    elif offsetSign:
+        offset = int(offsetHours) * 60 + (int(offsetMinutes) if offsetMinutes else 0)
+        tz = pytz.FixedOffset(-offset if offsetSign == "-" else offset)  # which is pytz.utc for +00:00
+    else:
+        tz = naiveTZ
+    microsecond = int(fraction[:6].ljust(6, "0")) if fraction else 0
+    try:
+        return datetime(int(year), int(month), int(day), int(hour), int(minute), int(second), microsecond, tzinfo=tz)
+    except ValueError:
+        # e.g. 24:00:00 or a leap second - let dateutil decide what to do with it.
+        return _parseFallback(text, naiveTZ)
+
+
+def _parseFallback(text, naiveTZ):
+    result = dateutil.parser.parse(text)
+    if result.tzinfo is None:
+        return result.replace(tzinfo=naiveTZ)
+    return result.replace(tzinfo=pytz.FixedOffset(int(result.utcoffset().total_seconds() // 60)))
@@ -0,0 +1,114 @@
+from tapiriik.services.api import APIDeferral, ServiceExceptionScope
+from pymongo.errors import DuplicateKeyError
+import threading
+import time
+import logging
+logger = logging.getLogger(__name__)
+
+
+class RateLimit:
+    """ No more than `requests` calls in any window of length `period`.
+        Enforced as a token bucket holding up to `burst` tokens, refilling at (requests - burst) / period - so that even a full bucket at the start of a window can't push that window over the limit.
+        Which means the burst has to leave something to refill with: 1 <= burst < requests.
+    """
+    def __init__(self, requests, period, burst=None):
+        if requests < 2:
+            raise ValueError("Rate limit must allow at least 2 requests per period, not %s" % requests)
+        if period.total_seconds() <= 0:
+            raise ValueError("Rate limit period must be positive")
+        self.Requests = requests
+        self.Period = period.total_seconds()
+        self.Burst = burst if burst is not None else max(1, requests // 10)
+        if not 1 <= self.Burst < requests:
+            raise ValueError("Rate limit burst must be at least 1 and less than the %d requests allowed, not %s" % (requests, self.Burst))
+        self.RefillRate = (requests - self.Burst) / self.Period
+
+
+def _takeToken(tokens, updated, limits, now):
+    """ Returns the bucket levels after taking a token from each, and 0 - or, if any bucket is short, the levels as they stand (nothing taken) and how long until there's a token in all of them """
+    if tokens is None or len(tokens) != len(limits):
+        tokens = [limit.Burst for limit in limits]
+    else:
+        elapsed = max(0, now - updated)
+        tokens = [min(limit.Burst, level + elapsed * limit.RefillRate) for level, limit in zip(tokens, limits)]
+    wait = max([(1 - level) / limit.RefillRate if level < 1 else 0 for level, limit in zip(tokens, limits)])
+    if wait > 0:
+        return tokens, wait
+    return [level - 1 for level in tokens], 0
+
+
+class MemoryRateLimitStore:
+    """ Buckets held in this process only - for tests, or a single worker """
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def Consume(self, key, limits, now):
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (None, None))
+            tokens, wait = _takeToken(tokens, updated, limits, now)
+            self._buckets[key] = (tokens, now)
+            return wait
+
+    def Drain(self, key, limits, now):
+        with self._lock:
+            self._buckets[key] = ([0] * len(limits), now)
+
+
+class MongoRateLimitStore:
+    """ Buckets shared by every worker, in cachedb.rate_limits - each one is updated only if nobody else got to it first """
+    def _collection(self):
+        from tapiriik.database import cachedb
+        return cachedb.rate_limits
+
+    def Consume(self, key, limits, now):
+        while True:
+            rec = self._collection().find_one({"_id": key})
+            tokens, wait = _takeToken(rec["Tokens"] if rec else None, rec["Updated"] if rec else None, limits, now)
+            if wait > 0:
+                return wait
+            if self._write(rec, key, tokens, now):
+                return 0
+
+    def Drain(self, key, limits, now):
+        self._collection().update({"_id": key}, {"$set": {"Tokens": [0] * len(limits), "Updated": now}, "$inc": {"Version": 1}}, upsert=True)
+
+    def _write(self, rec, key, tokens, now):
+        if rec is None:
+            try:
+                self._collection().insert({"_id": key, "Tokens": tokens, "Updated": now, "Version": 1})
+            except DuplicateKeyError:
+                return False
+            return True
+        result = self._collection().update({"_id": key, "Version": rec["Version"]}, {"$set": {"Tokens": tokens, "Updated": now}, "$inc": {"Version": 1}})
+        return result["n"] == 1
+
+
+class RateLimiter:
+    """ Holds calls to a service (or one account on it) to its RateLimits - Acquire waits for a token for up to MaxWait, then gives up with an APIDeferral so the activity is retried next sync """
+    DefaultStore = MongoRateLimitStore()
+    MaxWait = 30  # seconds
+
+    def __init__(self, serviceId, limits, store=None):
+        self._serviceId = serviceId
+        self._limits = limits
+        self._store = store if store else RateLimiter.DefaultStore
+
+    def _key(self, account):
+        return self._serviceId if account is None else self._serviceId + ":" + str(account)
+
+    def Acquire(self, account=None):
+        waited = 0
+        while True:
+            wait = self._store.Consume(self._key(account), self._limits, time.time())
+            if wait == 0:
+                return
+            if waited + wait > self.MaxWait:
+                raise APIDeferral("Rate limit reached for %s" % self._key(account), scope=ServiceExceptionScope.Service)
+            logger.debug("Waiting %.1fs for %s rate limit" % (wait, self._key(account)))
+            time.sleep(wait)
+            waited += wait
+
+    def Drain(self, account=None):
+        # For when the service says we're over the limit regardless - no point spending the tokens we think we have.
+        self._store.Drain(self._key(account), self._limits, time.time())
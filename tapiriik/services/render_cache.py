@@ -0,0 +1,131 @@
+from tapiriik.settings import RENDER_CACHE_SIZE, RENDER_CACHE_PATH, RENDER_CACHE_DISK_SIZE
+from tapiriik.services.tcx import TCXIO
+from tapiriik.services.gpx import GPXIO
+from tapiriik.services.waypoint_columns import WaypointColumns
+from collections import OrderedDict
+from contextlib import contextmanager
+import hashlib
+import threading
+import zlib
+import os
+import logging
+logger = logging.getLogger(__name__)
+
+
+class ActivityRenderCache:
+    """ Holds activities rendered to TCX/GPX, so an activity going to several services is only rendered once per format.
+        Entries are keyed on the activity's UID, a digest of its contents and the format, so an activity that's changed since is rendered afresh.
+        They're kept zlib-compressed in an in-process LRU of up to RENDER_CACHE_SIZE bytes, and, if RENDER_CACHE_PATH is set, spill from there into files of up to RENDER_CACHE_DISK_SIZE bytes in total.
+        The files are named by their key, so workers may share the directory - but each only keeps track of (and cleans up) the ones it wrote.
+    """
+    Renderers = {"tcx": TCXIO.DumpBytes, "gpx": GPXIO.DumpBytes}
+
+    def __init__(self, size=RENDER_CACHE_SIZE, path=RENDER_CACHE_PATH, diskSize=RENDER_CACHE_DISK_SIZE):
+        self._size = size
+        self._path = path
+        self._diskSize = diskSize
+        self._entries = OrderedDict()  # key -> compressed bytes
+        self._entriesSize = 0
+        self._diskEntries = OrderedDict()  # key -> size of the file
+        self._diskEntriesSize = 0
+        self._lock = threading.Lock()
+        self._renderLocks = {}  # key -> [lock, waiters] - uploads of the same activity run concurrently, but only one of them should render it
+        self.Hits = self.DiskHits = self.Misses = 0
+
+    def Render(self, activity, format, prettyPrint=False):
+        if format in activity.PrerenderedFormats:
+            logger.debug("Using prerendered %s" % format.upper())
+            return activity.PrerenderedFormats[format]
+        key = ActivityRenderCache._key(activity, format, prettyPrint)
+        with self._renderLock(key):
+            data = self._get(key)
+            if data is None:
+                data = self.Renderers[format](activity, prettyPrint=prettyPrint)
+                with self._lock:
+                    self.Misses += 1
+                    self._put(key, zlib.compress(data))
+        return data
+
+    def Stats(self):
+        with self._lock:
+            return {"Hits": self.Hits, "DiskHits": self.DiskHits, "Misses": self.Misses, "Size": self._entriesSize, "DiskSize": self._diskEntriesSize}
+
+    def _key(activity, format, prettyPrint):
+        digest = hashlib.md5()
+        digest.update(repr((getattr(activity, "UID", None), format, prettyPrint, activity.StartTime, activity.EndTime, str(activity.TZ), activity.Type, activity.Name, activity.Distance, activity.Private)).encode("utf-8"))
+        if isinstance(activity.Waypoints, WaypointColumns):
+            activity.Waypoints.UpdateDigest(digest)
+        else:
+            for wp in activity.Waypoints:
+                location = (wp.Location.Latitude, wp.Location.Longitude, wp.Location.Altitude) if wp.Location else None
+                digest.update(repr((wp.Timestamp, wp.Type, location, wp.HR, wp.Cadence, wp.Calories, wp.Power, wp.Temp)).encode("utf-8"))
+        return digest.hexdigest()
+
+    @contextmanager
+    def _renderLock(self, key):
+        with self._lock:
+            lock = self._renderLocks.setdefault(key, [threading.Lock(), 0])
+            lock[1] += 1
+        try:
+            with lock[0]:
+                yield
+        finally:
+            with self._lock:
+                lock[1] -= 1
+                if not lock[1]:
+                    del self._renderLocks[key]
+
+    def _get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.Hits += 1
+                return zlib.decompress(self._entries[key])
+            if key not in self._diskEntries:
+                return None
+            # Back into memory it goes.
+            try:
+                with open(self._filePath(key), "rb") as f:
+                    compressed = f.read()
+            except IOError:
+                return None
+            finally:
+                self._removeFile(key)
+            self.DiskHits += 1
+            self._put(key, compressed)
+            return zlib.decompress(compressed)
+
+    def _put(self, key, compressed):
+        # Called with the lock held.
+        self._entries[key] = compressed
+        self._entriesSize += len(compressed)
+        while self._entriesSize > self._size and self._entries:
+            evictedKey, evicted = self._entries.popitem(last=False)
+            self._entriesSize -= len(evicted)
+            if self._path:
+                self._spill(evictedKey, evicted)
+
+    def _spill(self, key, compressed):
+        try:
+            os.makedirs(self._path, exist_ok=True)
+            with open(self._filePath(key), "wb") as f:
+                f.write(compressed)
+        except IOError:
+            logger.exception("Could not spill rendered activity to disk")
+            return
+        self._diskEntries[key] = len(compressed)
+        self._diskEntriesSize += len(compressed)
+        while self._diskEntriesSize > self._diskSize and self._diskEntries:
+            self._removeFile(next(iter(self._diskEntries)))
+
+    def _removeFile(self, key):
+        self._diskEntriesSize -= self._diskEntries.pop(key)
+        try:
+            os.remove(self._filePath(key))
+        except OSError:
+            pass  # it wasn't ours to begin with - another worker cleaned it up
+
+    def _filePath(self, key):
+        return os.path.join(self._path, key + ".z")
+
+RenderCache = ActivityRenderCache()
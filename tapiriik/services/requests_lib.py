@@ -0,0 +1,50 @@
+from http.cookiejar import DefaultCookiePolicy
+import requests
+import logging
+logger = logging.getLogger(__name__)
+
+
+class _RejectAllCookiesPolicy(DefaultCookiePolicy):
+    def set_ok(self, cookie, request):
+        return False
+
+
+class ServiceSession(requests.Session):
+    """ A requests.Session that keeps connections alive to the hosts a service talks to, so the TLS handshake isn't repeated for every call.
+        Requests get a default timeout (there's no other way to give requests one), and idempotent requests are retried if they couldn't connect.
+        A request that timed out waiting for the response may well have been acted on, so those aren't retried - nor is anything sent with retries=0 (e.g. an upload that happens to be a GET).
+        With a rateLimiter, every request waits its turn - pass rateLimitAccount to count it against that account's limits rather than the whole service's.
+        Since one session is shared between every user of a service, it never holds on to cookies - pass them per-request, as before.
+    """
+
+    _idempotentMethods = ["GET", "HEAD", "OPTIONS", "DELETE", "PUT"]
+
+    def __init__(self, timeout, poolSize, retries, rateLimiter=None):
+        super(ServiceSession, self).__init__()
+        self._timeout = timeout
+        self._retries = retries
+        self._rateLimiter = rateLimiter
+        self.cookies.set_policy(_RejectAllCookiesPolicy())
+        # Retries are handled below rather than in the adapter, where they'd also apply to uploads that may well have gone through.
+        adapter = requests.adapters.HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize, max_retries=0)
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+
+    def request(self, method, url, rateLimitAccount=None, retries=None, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self._timeout
+        if retries is None:
+            retries = self._retries if method.upper() in ServiceSession._idempotentMethods else 0
+        attempts = retries + 1
+        for attempt in range(attempts):
+            if self._rateLimiter:
+                self._rateLimiter.Acquire(rateLimitAccount)
+            try:
+                response = super(ServiceSession, self).request(method, url, **kwargs)
+                if response.status_code == 429 and self._rateLimiter:
+                    self._rateLimiter.Drain(rateLimitAccount)
+                return response
+            except requests.exceptions.ConnectionError:  # but not a read timeout
+                if attempt == attempts - 1:
+                    raise
+                logger.info("Retrying %s %s after connection failure" % (method, url))
@@ -1,5 +1,6 @@
 from tapiriik.services import *
 from .service_record import ServiceRecord
+from tapiriik.services.download_cache import DownloadCache
 from tapiriik.database import db, cachedb
 from bson.objectid import ObjectId
 
@@ -64,6 +65,7 @@ class Service:
     def DeleteServiceRecord(serviceRecord):
         svc = serviceRecord.Service
         svc.DeleteCachedData(serviceRecord)
+        DownloadCache.Remove(svc.ID, serviceRecord.ExternalID)
         svc.RevokeAuthorization(serviceRecord)
         cachedb.extendedAuthDetails.remove({"ID": serviceRecord._id})
         db.connections.remove({"_id": serviceRecord._id})
@@ -1,3 +1,10 @@
+from tapiriik.services.requests_lib import ServiceSession
+from tapiriik.services.ratelimit import RateLimiter
+from tapiriik.services.download_cache import DownloadCache
+import threading
+import logging
+logger = logging.getLogger(__name__)
+
 class ServiceAuthenticationType:
     OAuth = "oauth"
     UsernamePassword = "direct"
@@ -16,6 +23,23 @@ class ServiceBase:
     UserProfileURL = UserActivityURL = None
     AuthenticationNoFrame = False
     ConfigurationDefaults = {}
+    UploadConcurrency = 4  # simultaneous UploadActivity calls per sync worker process
+    HTTPTimeout = 60  # seconds, for requests that don't give their own
+    HTTPPoolSize = 10  # kept-alive connections per host
+    HTTPRetries = 2  # extra attempts for idempotent requests that couldn't connect
+    RateLimits = []  # RateLimit(s) that every request through HTTP is held to, across all workers
+
+    _httpSession = None
+    _httpSessionLock = threading.Lock()
+
+    @property
+    def HTTP(self):
+        # One pooled session per service, shared by every sync thread in the process - use this rather than requests.get/post.
+        if self._httpSession is None:
+            with ServiceBase._httpSessionLock:
+                if self._httpSession is None:
+                    self._httpSession = ServiceSession(timeout=self.HTTPTimeout, poolSize=self.HTTPPoolSize, retries=self.HTTPRetries, rateLimiter=RateLimiter(self.ID, self.RateLimits) if self.RateLimits else None)
+        return self._httpSession
 
     def WebInit(self):
         pass
@@ -26,15 +50,35 @@ class ServiceBase:
     def RevokeAuthorization(self, serviceRecord):
         raise NotImplementedError
 
-    def DownloadActivityList(self, serviceRecord, exhaustive=False):
+    def DownloadActivityList(self, serviceRecord, exhaustive=False, since=None):
+        # since (a UTC datetime) is given on non-exhaustive syncs once every connection has been listed before - everything starting after it has to be returned, anything earlier is optional.
         raise NotImplementedError
 
+    def HasNewActivities(self, serviceRecord, since):
+        # A quick check before a regular sync - False only if a listing since then certainly wouldn't turn up anything to do, so the sync can be skipped.
+        return True
+
     def DownloadActivity(self, serviceRecord, activity):
         raise NotImplementedError
 
     def UploadActivity(self, serviceRecord, activity):
         raise NotImplementedError
 
+    def CachedDownload(self, serviceRecord, activityID, download, parse=lambda payload: payload, revision=None):
+        # parse() of an activity's raw payload (bytes) - from the download cache if it's there, otherwise from download().
+        # A payload is only cached once it's parsed, so parse should raise for anything that shouldn't be served again (partial downloads, activities still in progress...)
+        payload = DownloadCache.Get(self.ID, serviceRecord.ExternalID, activityID, revision)
+        if payload is not None:
+            try:
+                return parse(payload)
+            except Exception:
+                logger.info("Discarding cached download of %s" % activityID)
+                DownloadCache.Discard(self.ID, serviceRecord.ExternalID, activityID, revision)
+        payload = download()
+        result = parse(payload)
+        DownloadCache.Store(self.ID, serviceRecord.ExternalID, activityID, payload, revision)
+        return result
+
     def DeleteCachedData(self, serviceRecord):
         raise NotImplementedError
 
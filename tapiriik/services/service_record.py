@@ -1,5 +1,9 @@
 from tapiriik.database import cachedb, db
+import binascii
 import copy
+import re
+
+_activityUIDPattern = re.compile("^[0-9a-f]{32}$")  # hex MD5 - see Activity.CalculateUID
 
 class ServiceRecord:
     def __new__(cls, dbRec):
@@ -8,6 +12,12 @@ class ServiceRecord:
         return super(ServiceRecord, cls).__new__(cls)
     def __init__(self, dbRec):
         self.__dict__.update(dbRec)
+        # The set of activities on this connection is stored as a sorted run of 16-byte MD5 digests (SynchronizedActivityDigests), plus whatever's been $addToSet onto the SynchronizedActivities array since it was last compacted.
+        # It's only decoded when something needs it.
+        if "SynchronizedActivities" in dbRec or "SynchronizedActivityDigests" in dbRec:
+            self._synchronizedActivityUIDs = self.__dict__.pop("SynchronizedActivities", None)
+            self._synchronizedActivityDigests = self.__dict__.pop("SynchronizedActivityDigests", None)
+            self._synchronizedActivities = None
     def __repr__(self):
         return "<ServiceRecord> " + str(self.__dict__)
 
@@ -22,6 +32,35 @@ class ServiceRecord:
 
     ExcludedActivities = {}
     Config = {}
+    _synchronizedActivityUIDs = _synchronizedActivityDigests = _synchronizedActivities = None
+
+    @property
+    def SynchronizedActivities(self):
+        if self._synchronizedActivities is None:
+            if self._synchronizedActivityUIDs is None and self._synchronizedActivityDigests is None:
+                raise AttributeError("SynchronizedActivities")
+            digests = self._synchronizedActivityDigests or b""
+            self._synchronizedActivities = set(self._synchronizedActivityUIDs or [])
+            self._synchronizedActivities.update(binascii.hexlify(digests[idx:idx + 16]).decode() for idx in range(0, len(digests), 16))
+        return self._synchronizedActivities
+
+    @SynchronizedActivities.setter
+    def SynchronizedActivities(self, value):
+        self._synchronizedActivities = set(value)
+
+    def CompactSynchronizedActivities(self):
+        """ Folds the UIDs added to the SynchronizedActivities array since last time into SynchronizedActivityDigests - should only be called while the user's sync is locked """
+        rec = db.connections.find_one({"_id": self._id}, {"SynchronizedActivities": True})
+        uids = [x for x in rec.get("SynchronizedActivities", []) if _activityUIDPattern.match(x)] if rec else []
+        if not uids:
+            return
+        digests = self._synchronizedActivityDigests or b""
+        digests = set(digests[idx:idx + 16] for idx in range(0, len(digests), 16))
+        digests.update(binascii.unhexlify(x) for x in uids)
+        packedDigests = b"".join(sorted(digests))
+        # Anything added since we read the array stays there for next time.
+        db.connections.update({"_id": self._id}, {"$set": {"SynchronizedActivityDigests": packedDigests}, "$pullAll": {"SynchronizedActivities": uids}})
+        self._synchronizedActivityDigests = packedDigests
 
     @property
     def Service(self):
@@ -0,0 +1,52 @@
+class StreamPolicy:
+    Nearest = "nearest"  # the closest sample - the earlier of two equally close
+    Previous = "previous"  # the last sample taken at or before the timestamp
+    Linear = "linear"  # interpolated between the samples either side (numeric streams only)
+
+
+class StreamAligner:
+    """ Resamples parallel streams of samples - heart rate, elevation, calories, etc. - to the timestamps of an activity's primary stream (usually its path), giving a column of values per stream to build waypoints from.
+        The primary timestamps are sorted once, and each stream is sorted and merge-joined against them, so it's O(n log n) overall rather than a scan of the whole stream per point.
+        Samples are (timestamp, value) pairs. Where a sample's timestamp is repeated, the first of them is used.
+    """
+
+    def AlignStreams(timestamps, streams, policy=StreamPolicy.Nearest, tolerance=0):
+        """ Returns a dict of the same keys as `streams`, each with a list holding the stream's value (or None) for each of `timestamps`.
+            tolerance is how far (in the timestamps' units) a Nearest/Previous sample may be from the timestamp, or how wide a gap Linear will interpolate across - None for no limit.
+            With the defaults, only samples taken at exactly the same time are matched.
+        """
+        order = sorted(range(len(timestamps)), key=timestamps.__getitem__)
+        return dict((name, StreamAligner._align(timestamps, order, samples, policy, tolerance)) for name, samples in streams.items())
+
+    def Align(timestamps, samples, policy=StreamPolicy.Nearest, tolerance=0):
+        return StreamAligner.AlignStreams(timestamps, {None: samples}, policy=policy, tolerance=tolerance)[None]
+
+    def Interleaved(stream):
+        """ Pairs up a [t, v, t, v...] stream """
+        return list(zip(stream[0::2], stream[1::2]))
+
+    def _align(timestamps, order, samples, policy, tolerance):
+        samples = sorted(samples, key=lambda sample: sample[0])  # stable, so the first of any duplicates stays first
+        sampleCt = len(samples)
+        values = [None] * len(timestamps)
+        j = 0
+        for idx in order:
+            t = timestamps[idx]
+            while j < sampleCt and samples[j][0] < t:
+                j += 1
+            # The first sample taken at or after t, and the last one before it.
+            after = samples[j] if j < sampleCt else None
+            before = samples[j - 1] if j > 0 else None
+            if after and after[0] == t:
+                values[idx] = after[1]
+                continue
+            if policy == StreamPolicy.Linear:
+                if before and after and before[1] is not None and after[1] is not None and (tolerance is None or after[0] - before[0] <= tolerance):
+                    values[idx] = before[1] + (after[1] - before[1]) * (t - before[0]) / (after[0] - before[0])
+                continue
+            match = before
+            if policy == StreamPolicy.Nearest and after and (not before or after[0] - t < t - before[0]):
+                match = after
+            if match and (tolerance is None or abs(match[0] - t) <= tolerance):
+                values[idx] = match[1]
+        return values
@@ -1,9 +1,10 @@
 from lxml import etree, objectify
 from pytz import UTC
-import copy
-import dateutil.parser
+from io import BytesIO
 from datetime import datetime
 from .interchange import WaypointType, Activity, ActivityType, Waypoint, Location
+from .xmlstream import XMLStreamWriter
+from .iso8601 import ParseISO8601
 
 
 class TCXIO:
@@ -16,156 +17,169 @@ class TCXIO:
         "xsi": "http://www.w3.org/2001/XMLSchema-instance"
     }
 
-    def Parse(tcxData, act=None):
-        ns = copy.deepcopy(TCXIO.Namespaces)
-        ns["tcx"] = ns[None]
-        del ns[None]
+    def Parse(tcxData, act=None, minimumWaypoints=False):
+        """ Reads TCX data (bytes, str, or a file-like object) into an Activity, one trackpoint at a time.
+            With minimumWaypoints, only the times of the trackpoints are read, and the only waypoint kept is the first one with a location - enough for the start/end time, sport and TZ.
+        """
+        tcxNS = "{" + TCXIO.Namespaces[None] + "}"
+        activitiesTag, activityTag, lapTag, trackTag, trackpointTag, timeTag = [tcxNS + x for x in ["Activities", "Activity", "Lap", "Track", "Trackpoint", "Time"]]
 
         act = act if act else Activity()
         act.Distance = None
 
-        try:
-            root = etree.XML(tcxData)
-        except:
-            root = etree.fromstring(tcxData)
+        if isinstance(tcxData, str):
+            tcxData = tcxData.encode("UTF-8")
+        if isinstance(tcxData, bytes):
+            tcxData = BytesIO(tcxData)
 
-
-        xacts = root.find("tcx:Activities", namespaces=ns)
-        if xacts is None:
-            raise ValueError("No activities element in TCX")
-
-        xact = xacts.find("tcx:Activity", namespaces=ns)
-        if xact is None:
-            raise ValueError("No activity element in TCX")
-
-        if not act.Type:
-            if xact.attrib["Sport"] == "Biking":
-                act.Type = ActivityType.Cycling
-            elif xact.attrib["Sport"] == "Running":
-                act.Type = ActivityType.Running
-
-        xlaps = xact.findall("tcx:Lap", namespaces=ns)
         startTime = None
         endTime = None
+        firstTZ = None
+        trackpointCount = 0
 
+        path = []
+        activitiesCount = activityCount = tracksInLap = 0
         beginSeg = False
-        for xlap in xlaps:
-            beginSeg = True
-            xtrkseg = xlap.find("tcx:Track", namespaces=ns)
-            if xtrkseg is None:
-                # Some TCX files have laps with no track - not sure if it's valid or not.
+        for event, el in etree.iterparse(tcxData, events=("start", "end")):
+            if event == "start":
+                path.append(el.tag)
+                depth = len(path)
+                if depth == 2 and el.tag == activitiesTag:
+                    activitiesCount += 1
+                elif depth == 3 and el.tag == activityTag and activitiesCount == 1:
+                    activityCount += 1
+                    if activityCount == 1 and not act.Type:
+                        if el.attrib["Sport"] == "Biking":
+                            act.Type = ActivityType.Cycling
+                        elif el.attrib["Sport"] == "Running":
+                            act.Type = ActivityType.Running
+                elif depth == 4 and el.tag == lapTag and path[2] == activityTag and activityCount == 1 and activitiesCount == 1:
+                    beginSeg = True
+                    tracksInLap = 0
+                elif depth == 5 and el.tag == trackTag:
+                    tracksInLap += 1
                 continue
-            for xtrkpt in xtrkseg.findall("tcx:Trackpoint", namespaces=ns):
-                wp = Waypoint()
-                if len(act.Waypoints) == 0:
-                    wp.Type = WaypointType.Start
-                elif beginSeg:
-                    wp.Type = WaypointType.Lap
+
+            depth = len(path)
+            path.pop()
+            inFirstActivity = depth > 3 and activitiesCount == 1 and activityCount == 1 and path[1] == activitiesTag and path[2] == activityTag
+            if depth == 6 and el.tag == trackpointTag and inFirstActivity and path[3] == lapTag and path[4] == trackTag and tracksInLap == 1:
+                if minimumWaypoints and len(act.Waypoints):
+                    # We still need the time of every trackpoint to find the end time.
+                    timestamp = None
+                    for child in el:
+                        if child.tag == timeTag:
+                            timestamp = ParseISO8601(child.text, naiveTZ=UTC)
+                            break
+                    if timestamp is None:
+                        raise ValueError("Trackpoint without time in TCX")
+                else:
+                    wp = TCXIO._parseTrackpoint(el)
+                    if trackpointCount == 0:
+                        wp.Type = WaypointType.Start
+                    elif beginSeg:
+                        wp.Type = WaypointType.Lap
+                    timestamp = wp.Timestamp
+                    if not minimumWaypoints or (wp.Location and wp.Location.Latitude is not None and wp.Location.Longitude is not None):
+                        act.Waypoints.append(wp)
                 beginSeg = False
 
-                wp.Timestamp = dateutil.parser.parse(xtrkpt.find("tcx:Time", namespaces=ns).text)
-                wp.Timestamp.replace(tzinfo=UTC)
-                if startTime is None or wp.Timestamp < startTime:
-                    startTime = wp.Timestamp
-                if endTime is None or wp.Timestamp > endTime:
-                    endTime = wp.Timestamp
-                xpos = xtrkpt.find("tcx:Position", namespaces=ns)
-                if xpos is not None:
-                    wp.Location = Location(float(xpos.find("tcx:LatitudeDegrees", namespaces=ns).text), float(xpos.find("tcx:LongitudeDegrees", namespaces=ns).text), None)
-                eleEl = xtrkpt.find("tcx:AltitudeMeters", namespaces=ns)
-                if eleEl is not None:
-                    wp.Location = wp.Location if wp.Location else Location(None, None, None)
-                    wp.Location.Altitude = float(eleEl.text)
-                hrEl = xtrkpt.find("tcx:HeartRateBpm", namespaces=ns)
-                if hrEl is not None:
-                    wp.HR = int(hrEl.find("tcx:Value", namespaces=ns).text)
-                cadEl = xtrkpt.find("tcx:Cadence", namespaces=ns)
-                if cadEl is not None:
-                    wp.Cadence = int(cadEl.text)
-                extsEl = xtrkpt.find("tcx:Extensions", namespaces=ns)
-                if extsEl is not None:
-                    tpxEl = extsEl.find("tpx:TPX", namespaces=ns)
-                    if tpxEl is not None:
-                        powerEl = tpxEl.find("tpx:Watts", namespaces=ns)
-                        if powerEl is not None:
-                            wp.Power = float(powerEl.text)
-                act.Waypoints.append(wp)
-                xtrkpt.clear()
-                del xtrkpt
-        if not len(act.Waypoints):
+                if firstTZ is None and trackpointCount == 0:
+                    firstTZ = timestamp.tzinfo
+                trackpointCount += 1
+                if startTime is None or timestamp < startTime:
+                    startTime = timestamp
+                if endTime is None or timestamp > endTime:
+                    endTime = timestamp
+
+                # The parser keeps everything it's read in the tree unless we throw it out.
+                el.clear()
+                while el.getprevious() is not None:
+                    del el.getparent()[0]
+            elif depth == 4 and el.tag == lapTag:
+                el.clear()
+                while el.getprevious() is not None:
+                    del el.getparent()[0]
+
+        if activitiesCount == 0:
+            raise ValueError("No activities element in TCX")
+        if activityCount == 0:
+            raise ValueError("No activity element in TCX")
+        if not trackpointCount:
             raise ValueError("No waypoints in TCX")
 
-        act.Waypoints[len(act.Waypoints)-1].Type = WaypointType.End
-        act.TZ = act.Waypoints[0].Timestamp.tzinfo
+        if not minimumWaypoints:
+            act.Waypoints[len(act.Waypoints)-1].Type = WaypointType.End
+        act.TZ = firstTZ
         act.StartTime = startTime
         act.EndTime = endTime
-        act.CalculateDistance()
+        if not minimumWaypoints:
+            act.CalculateDistance()
         act.CalculateUID()
         return act
 
-    def Dump(activity):
-
-        TRKPTEXT = "{%s}" % TCXIO.Namespaces["tpx"]
-        root = etree.Element("TrainingCenterDatabase", nsmap=TCXIO.Namespaces)
-        activities = etree.SubElement(root, "Activities")
-        act = etree.SubElement(activities, "Activity")
+    def _parseTrackpoint(xtrkpt):
+        tcxNS = "{" + TCXIO.Namespaces[None] + "}"
+        tpxNS = "{" + TCXIO.Namespaces["tpx"] + "}"
+
+        def child(el, tag):
+            for x in el:
+                if x.tag == tag:
+                    return x
+            return None
+
+        wp = Waypoint()
+        timeEl = child(xtrkpt, tcxNS + "Time")
+        if timeEl is None:
+            raise ValueError("Trackpoint without time in TCX")
+        wp.Timestamp = ParseISO8601(timeEl.text, naiveTZ=UTC)  # TCX times are in UTC unless they say otherwise
+        xpos = child(xtrkpt, tcxNS + "Position")
+        if xpos is not None:
+            wp.Location = Location(float(child(xpos, tcxNS + "LatitudeDegrees").text), float(child(xpos, tcxNS + "LongitudeDegrees").text), None)
+        eleEl = child(xtrkpt, tcxNS + "AltitudeMeters")
+        if eleEl is not None:
+            wp.Location = wp.Location if wp.Location else Location(None, None, None)
+            wp.Location.Altitude = float(eleEl.text)
+        hrEl = child(xtrkpt, tcxNS + "HeartRateBpm")
+        if hrEl is not None:
+            wp.HR = int(child(hrEl, tcxNS + "Value").text)
+        cadEl = child(xtrkpt, tcxNS + "Cadence")
+        if cadEl is not None:
+            wp.Cadence = int(cadEl.text)
+        extsEl = child(xtrkpt, tcxNS + "Extensions")
+        if extsEl is not None:
+            tpxEl = child(extsEl, tpxNS + "TPX")
+            if tpxEl is not None:
+                powerEl = child(tpxEl, tpxNS + "Watts")
+                if powerEl is not None:
+                    wp.Power = float(powerEl.text)
+        return wp
 
+    def Dump(activity):
+        return TCXIO.DumpBytes(activity).decode("UTF-8")
 
-        author = etree.SubElement(root, "Author")
-        author.attrib["{" + TCXIO.Namespaces["xsi"] + "}type"] = "Application_t"
-        etree.SubElement(author, "Name").text = "tapiriik"
-        build = etree.SubElement(author, "Build")
-        version = etree.SubElement(build, "Version")
-        etree.SubElement(version, "VersionMajor").text = "0"
-        etree.SubElement(version, "VersionMinor").text = "0"
-        etree.SubElement(version, "BuildMajor").text = "0"
-        etree.SubElement(version, "BuildMinor").text = "0"
-        etree.SubElement(author, "LangID").text = "en"
-        etree.SubElement(author, "PartNumber").text = "000-00000-00"
+    def DumpBytes(activity, prettyPrint=True):
+        stream = BytesIO()
+        TCXIO.DumpToStream(activity, stream, prettyPrint=prettyPrint)
+        return stream.getvalue()
 
+    def DumpToStream(activity, stream, prettyPrint=True):
+        XSITYPE = "{%s}type" % TCXIO.Namespaces["xsi"]
         dateFormat = "%Y-%m-%dT%H:%M:%S.000Z"
 
-        if activity.Name is not None:
-            etree.SubElement(act, "Notes").text = activity.Name
-
         if activity.Type == ActivityType.Cycling:
-            act.attrib["Sport"] = "Biking"
+            sport = "Biking"
         elif activity.Type == ActivityType.Running:
-            act.attrib["Sport"] = "Running"
+            sport = "Running"
         else:
-            act.attrib["Sport"] = "Other"
+            sport = "Other"
 
-        etree.SubElement(act, "Id").text = activity.StartTime.astimezone(UTC).strftime(dateFormat)
-        lap = track = None
+        # The lap stats go before the trackpoints, so work out where the laps fall first - that also means nothing is written for activities we can't export.
+        laps = []  # (index of the first waypoint, index of the last waypoint, trackpoints)
+        lapStartIdx = 0
+        trackpoints = []
         inPause = False
-        lapStartWpt = None
-        def newLap(wpt):
-            nonlocal lapStartWpt, lap, track
-            lapStartWpt = wpt
-            lap = etree.SubElement(act, "Lap")
-            lap.attrib["StartTime"] = wpt.Timestamp.astimezone(UTC).strftime(dateFormat)
-            if wpt.Calories and lapStartWpt.Calories:
-                etree.SubElement(lap, "Calories").text = str(wpt.Calories - lapStartWpt.Calories)
-            else:
-                etree.SubElement(lap, "Calories").text = "0"  # meh schema is meh
-            etree.SubElement(lap, "Intensity").text = "Active"
-            etree.SubElement(lap, "TriggerMethod").text = "Manual"  # I assume!
-
-            track = None
-
-        def finishLap(wpt):
-            nonlocal lapStartWpt, lap
-            dist = activity.GetDistance(lapStartWpt, wpt)
-            movingTime = activity.GetDuration(lapStartWpt, wpt)
-            xdist = etree.SubElement(lap, "DistanceMeters")
-            xdist.text = str(dist)
-            totaltime = etree.SubElement(lap, "TotalTimeSeconds")
-            totaltime.text = str(movingTime.total_seconds())
-            lap.insert(0, xdist)
-            lap.insert(0, totaltime)
-
-        newLap(activity.Waypoints[0])
-        for wp in activity.Waypoints:
+        for idx, wp in enumerate(activity.Waypoints):
             if wp.Location is None or wp.Location.Latitude is None or wp.Location.Longitude is None:
                 continue  # drop the point
             if wp.Type == WaypointType.Pause:
@@ -175,31 +189,59 @@ class TCXIO:
             if inPause and wp.Type != WaypointType.Pause or wp.Type == WaypointType.Lap:
                 # Make a new lap when they unpause
                 inPause = False
-                finishLap(wp)
-                newLap(wp)
-            if track is None:  # Defer creating the track until there are points
-                track = etree.SubElement(lap, "Track") # TODO - pauses should create new tracks instead of new laps?
-            trkpt = etree.SubElement(track, "Trackpoint")
+                laps.append((lapStartIdx, idx, trackpoints))
+                lapStartIdx = idx
+                trackpoints = []
             if wp.Timestamp.tzinfo is None:
                 raise ValueError("TCX export requires TZ info")
-            etree.SubElement(trkpt, "Time").text = wp.Timestamp.astimezone(UTC).strftime(dateFormat)
-            if wp.Location:
-                pos = etree.SubElement(trkpt, "Position")
-                etree.SubElement(pos, "LatitudeDegrees").text = str(wp.Location.Latitude)
-                etree.SubElement(pos, "LongitudeDegrees").text = str(wp.Location.Longitude)
-
-            if wp.Location.Altitude is not None:
-                etree.SubElement(trkpt, "AltitudeMeters").text = str(wp.Location.Altitude)
-            if wp.HR is not None:
-                xhr = etree.SubElement(trkpt, "HeartRateBpm")
-                xhr.attrib["{" + TCXIO.Namespaces["xsi"] + "}type"] = "HeartRateInBeatsPerMinute_t"
-                etree.SubElement(xhr, "Value").text = str(int(wp.HR))
-            if wp.Cadence is not None:
-                etree.SubElement(trkpt, "Cadence").text = str(int(wp.Cadence))
-            if wp.Power is not None:
-                exts = etree.SubElement(trkpt, "Extensions")
-                gpxtpxexts = etree.SubElement(exts, "TPX")
-                gpxtpxexts.attrib["xmlns"] = "http://www.garmin.com/xmlschemas/ActivityExtension/v2"
-                etree.SubElement(gpxtpxexts, "Watts").text = str(int(wp.Power))
-        finishLap(wp)
-        return etree.tostring(root, pretty_print=True, xml_declaration=True, encoding="UTF-8").decode("UTF-8")
+            trackpoints.append(wp)  # TODO - pauses should create new tracks instead of new laps?
+        laps.append((lapStartIdx, idx, trackpoints))
+
+        stats = activity.GetCumulativeStats()  # so the per-lap stats don't each walk the whole activity
+        writer = XMLStreamWriter(stream, prettyPrint=prettyPrint)
+        with writer.Document(), writer.Element("TrainingCenterDatabase", nsmap=TCXIO.Namespaces):
+            with writer.Element("Activities"), writer.Element("Activity", attrib={"Sport": sport}):
+                if activity.Name is not None:
+                    writer.Leaf("Notes", activity.Name)
+                writer.Leaf("Id", activity.StartTime.astimezone(UTC).strftime(dateFormat))
+                for lapStartIdx, lapEndIdx, trackpoints in laps:
+                    wpt = lapStartWpt = activity.Waypoints[lapStartIdx]
+                    with writer.Element("Lap", attrib={"StartTime": wpt.Timestamp.astimezone(UTC).strftime(dateFormat)}):
+                        writer.Leaf("TotalTimeSeconds", str(stats.GetDuration(lapStartIdx, lapEndIdx).total_seconds()))
+                        writer.Leaf("DistanceMeters", str(stats.GetDistance(lapStartIdx, lapEndIdx)))
+                        if wpt.Calories and lapStartWpt.Calories:
+                            writer.Leaf("Calories", str(wpt.Calories - lapStartWpt.Calories))
+                        else:
+                            writer.Leaf("Calories", "0")  # meh schema is meh
+                        writer.Leaf("Intensity", "Active")
+                        writer.Leaf("TriggerMethod", "Manual")  # I assume!
+                        if not trackpoints:
+                            continue  # No track without any points
+                        with writer.Element("Track"):
+                            for wp in trackpoints:
+                                with writer.Element("Trackpoint"):
+                                    writer.Leaf("Time", wp.Timestamp.astimezone(UTC).strftime(dateFormat))
+                                    if wp.Location:
+                                        with writer.Element("Position"):
+                                            writer.Leaf("LatitudeDegrees", str(wp.Location.Latitude))
+                                            writer.Leaf("LongitudeDegrees", str(wp.Location.Longitude))
+                                    if wp.Location.Altitude is not None:
+                                        writer.Leaf("AltitudeMeters", str(wp.Location.Altitude))
+                                    if wp.HR is not None:
+                                        with writer.Element("HeartRateBpm", attrib={XSITYPE: "HeartRateInBeatsPerMinute_t"}):
+                                            writer.Leaf("Value", str(int(wp.HR)))
+                                    if wp.Cadence is not None:
+                                        writer.Leaf("Cadence", str(int(wp.Cadence)))
+                                    if wp.Power is not None:
+                                        with writer.Element("Extensions"), writer.Element("TPX", attrib={"xmlns": "http://www.garmin.com/xmlschemas/ActivityExtension/v2"}):
+                                            writer.Leaf("Watts", str(int(wp.Power)))
+
+            with writer.Element("Author", attrib={XSITYPE: "Application_t"}):
+                writer.Leaf("Name", "tapiriik")
+                with writer.Element("Build"), writer.Element("Version"):
+                    writer.Leaf("VersionMajor", "0")
+                    writer.Leaf("VersionMinor", "0")
+                    writer.Leaf("BuildMajor", "0")
+                    writer.Leaf("BuildMinor", "0")
+                writer.Leaf("LangID", "en")
+                writer.Leaf("PartNumber", "000-00000-00")
@@ -0,0 +1,212 @@
+from tapiriik.services.interchange import Waypoint, Location
+from datetime import datetime, timedelta
+from array import array
+import math
+
+_epoch = datetime(1970, 1, 1)
+_nan = float("nan")
+
+
+class WaypointColumns:
+    """ A list of waypoints kept in typed arrays (one per field) instead of thousands of Waypoint/Location/datetime objects.
+        Indexing and iterating yield Waypoint-like views that read and write through to the arrays, so it can stand in for a list of Waypoints.
+        Missing numeric values are stored as NaN.
+    """
+    NumericColumns = ["Latitude", "Longitude", "Altitude", "HR", "Cadence", "Calories", "Power", "Temp"]
+
+    _hasTimestamp = 1
+    _hasLocation = 2
+    # ...and bit (4 << i) is set when NumericColumns[i] was given as an int, so it comes back out as one.
+
+    def __init__(self, waypoints=()):
+        self.Timestamps = array("q")  # microseconds since the epoch, in the waypoint's own wall clock time
+        self.TZIndices = array("H")  # 0 for naive timestamps, otherwise 1 + the index into TZInfos
+        self.TZInfos = []
+        self.Types = array("B")
+        self.Flags = array("H")
+        for column in WaypointColumns.NumericColumns:
+            setattr(self, column, array("d"))
+        self._tzIndices = {}  # id(tzinfo) -> index in TZIndices
+        self.extend(waypoints)
+
+    def __len__(self):
+        return len(self.Types)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [_WaypointView(self, x) for x in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError("waypoint index out of range")
+        return _WaypointView(self, idx)
+
+    def __setitem__(self, idx, wp):
+        if idx < 0:
+            idx += len(self)
+        self._store(idx, wp)
+
+    def __delitem__(self, idx):
+        for column in self._columns():
+            del column[idx]
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield _WaypointView(self, idx)
+
+    def append(self, wp):
+        for column in self._columns():
+            column.append(0)
+        self._store(len(self) - 1, wp)
+
+    def extend(self, waypoints):
+        for wp in waypoints:
+            self.append(wp)
+
+    def index(self, wp):
+        if isinstance(wp, _WaypointView) and wp._columns is self:
+            return wp._idx
+        for idx, candidate in enumerate(self):
+            if candidate == wp:
+                return idx
+        raise ValueError("waypoint not in list")
+
+    def __eq__(self, other):
+        try:
+            if len(self) != len(other):
+                return False
+        except TypeError:
+            return False
+        for a, b in zip(self, other):
+            if a != b:
+                return False
+        return True
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __copy__(self):
+        dupe = WaypointColumns()
+        dupe.Timestamps, dupe.TZIndices, dupe.Types, dupe.Flags = array("q", self.Timestamps), array("H", self.TZIndices), array("B", self.Types), array("H", self.Flags)
+        for column in WaypointColumns.NumericColumns:
+            setattr(dupe, column, array("d", getattr(self, column)))
+        dupe.TZInfos = list(self.TZInfos)  # tzinfos are immutable, no need to copy them
+        dupe._tzIndices = dict(self._tzIndices)
+        return dupe
+
+    def __deepcopy__(self, memo):
+        return self.__copy__()
+
+    def __repr__(self):
+        return "<WaypointColumns> " + str(list(self))
+
+    def UpdateDigest(self, digest):
+        """ Feeds the waypoints into a hashlib object, a column at a time """
+        for column in self._columns():
+            digest.update(column.tobytes())
+        digest.update(repr([str(tz) for tz in self.TZInfos]).encode("utf-8"))
+
+    def _columns(self):
+        return [self.Timestamps, self.TZIndices, self.Types, self.Flags] + [getattr(self, column) for column in WaypointColumns.NumericColumns]
+
+    def _store(self, idx, wp):
+        self.SetTimestamp(idx, wp.Timestamp)
+        self.Types[idx] = wp.Type
+        self.SetLocation(idx, wp.Location)
+        for column in ["HR", "Cadence", "Calories", "Power", "Temp"]:
+            self.SetValue(idx, column, getattr(wp, column))
+
+    def GetTimestamp(self, idx):
+        if not self.Flags[idx] & WaypointColumns._hasTimestamp:
+            return None
+        ts = _epoch + timedelta(microseconds=self.Timestamps[idx])
+        if self.TZIndices[idx]:
+            ts = ts.replace(tzinfo=self.TZInfos[self.TZIndices[idx] - 1])
+        return ts
+
+    def SetTimestamp(self, idx, ts):
+        if ts is None:
+            self.Flags[idx] &= ~WaypointColumns._hasTimestamp
+            self.Timestamps[idx] = self.TZIndices[idx] = 0
+            return
+        delta = ts.replace(tzinfo=None) - _epoch
+        self.Timestamps[idx] = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+        self.TZIndices[idx] = self._tzIndex(ts.tzinfo)
+        self.Flags[idx] |= WaypointColumns._hasTimestamp
+
+    def _tzIndex(self, tzinfo):
+        if tzinfo is None:
+            return 0
+        if id(tzinfo) not in self._tzIndices:
+            self.TZInfos.append(tzinfo)
+            self._tzIndices[id(tzinfo)] = len(self.TZInfos)
+        return self._tzIndices[id(tzinfo)]
+
+    def SetLocation(self, idx, loc):
+        if loc is None:
+            self.Flags[idx] &= ~WaypointColumns._hasLocation
+            for column in ["Latitude", "Longitude", "Altitude"]:
+                self.SetValue(idx, column, None)
+            return
+        self.Flags[idx] |= WaypointColumns._hasLocation
+        self.SetValue(idx, "Latitude", loc.Latitude)
+        self.SetValue(idx, "Longitude", loc.Longitude)
+        self.SetValue(idx, "Altitude", loc.Altitude)
+
+    def GetValue(self, idx, column):
+        value = getattr(self, column)[idx]
+        if math.isnan(value):
+            return None
+        if self.Flags[idx] & (4 << WaypointColumns.NumericColumns.index(column)):
+            return int(value)
+        return value
+
+    def SetValue(self, idx, column, value):
+        intFlag = 4 << WaypointColumns.NumericColumns.index(column)
+        if value is None:
+            getattr(self, column)[idx] = _nan
+            self.Flags[idx] &= ~intFlag
+            return
+        getattr(self, column)[idx] = value
+        if type(value) is int:
+            self.Flags[idx] |= intFlag
+        else:
+            self.Flags[idx] &= ~intFlag
+
+
+class _WaypointView(Waypoint):
+    __slots__ = ["_columns", "_idx"]
+
+    def __init__(self, columns, idx):
+        self._columns = columns
+        self._idx = idx
+
+    Timestamp = property(lambda self: self._columns.GetTimestamp(self._idx), lambda self, value: self._columns.SetTimestamp(self._idx, value))
+    Type = property(lambda self: self._columns.Types[self._idx], lambda self, value: self._columns.Types.__setitem__(self._idx, value))
+    HR = property(lambda self: self._columns.GetValue(self._idx, "HR"), lambda self, value: self._columns.SetValue(self._idx, "HR", value))
+    Cadence = property(lambda self: self._columns.GetValue(self._idx, "Cadence"), lambda self, value: self._columns.SetValue(self._idx, "Cadence", value))
+    Calories = property(lambda self: self._columns.GetValue(self._idx, "Calories"), lambda self, value: self._columns.SetValue(self._idx, "Calories", value))
+    Power = property(lambda self: self._columns.GetValue(self._idx, "Power"), lambda self, value: self._columns.SetValue(self._idx, "Power", value))
+    Temp = property(lambda self: self._columns.GetValue(self._idx, "Temp"), lambda self, value: self._columns.SetValue(self._idx, "Temp", value))
+
+    @property
+    def Location(self):
+        if not self._columns.Flags[self._idx] & WaypointColumns._hasLocation:
+            return None
+        return _LocationView(self._columns, self._idx)
+
+    @Location.setter
+    def Location(self, value):
+        self._columns.SetLocation(self._idx, value)
+
+
+class _LocationView(Location):
+    __slots__ = ["_columns", "_idx"]
+
+    def __init__(self, columns, idx):
+        self._columns = columns
+        self._idx = idx
+
+    Latitude = property(lambda self: self._columns.GetValue(self._idx, "Latitude"), lambda self, value: self._columns.SetValue(self._idx, "Latitude", value))
+    Longitude = property(lambda self: self._columns.GetValue(self._idx, "Longitude"), lambda self, value: self._columns.SetValue(self._idx, "Longitude", value))
+    Altitude = property(lambda self: self._columns.GetValue(self._idx, "Altitude"), lambda self, value: self._columns.SetValue(self._idx, "Altitude", value))
@@ -0,0 +1,47 @@
+from lxml import etree
+from contextlib import contextmanager
+
+
+class XMLStreamWriter:
+    """ Writes an XML document to a file-like object one element at a time (via etree.xmlfile), so the whole tree never has to be held in memory.
+        With prettyPrint, the output is indented the same way etree.tostring(..., pretty_print=True) would.
+    """
+
+    def __init__(self, stream, prettyPrint=True):
+        self._stream = stream
+        self._prettyPrint = prettyPrint
+        self._xf = None
+        self._hasChildren = []
+
+    @contextmanager
+    def Document(self):
+        with etree.xmlfile(self._stream, encoding="UTF-8") as xf:
+            self._xf = xf
+            xf.write_declaration()
+            yield
+        self._xf = None
+        if self._prettyPrint:
+            self._stream.write(b"\n")
+
+    @contextmanager
+    def Element(self, tag, attrib=None, nsmap=None):
+        self._startChild()
+        self._hasChildren.append(False)
+        with self._xf.element(tag, attrib=attrib if attrib else {}, nsmap=nsmap):
+            yield
+            if self._hasChildren.pop():
+                self._newLine()
+
+    def Leaf(self, tag, text, attrib=None):
+        self._startChild()
+        with self._xf.element(tag, attrib=attrib if attrib else {}):
+            self._xf.write(text)
+
+    def _startChild(self):
+        if self._hasChildren:
+            self._hasChildren[-1] = True
+            self._newLine()
+
+    def _newLine(self):
+        if self._prettyPrint:
+            self._xf.write("\n" + "  " * len(self._hasChildren))
@@ -182,12 +182,34 @@ DISABLED_SERVICES = []
 # where to put per-user sync logs
 USER_SYNC_LOGS = "./"
 
+# how many users each sync worker process synchronizes concurrently
+SYNC_WORKER_CONCURRENCY = 1
+
+# bounds (in seconds) on the interval between a paying user's automatic syncs - it's adjusted to how often they record activities
+SYNC_INTERVAL_MIN = 60 * 30
+SYNC_INTERVAL_MAX = 60 * 60 * 6
+
+# timezone boundary index written by tz_ingest.py - TZ lookups go to the tapiriik_tz database if it isn't there
+TZ_INDEX_PATH = "./tz_index.bin"
+
+# how many ~1km cells' TZs each process remembers, and how long (in seconds) they're kept in the tz_cache collection
+TZ_CACHE_SIZE = 10000
+TZ_CACHE_TTL = 60 * 60 * 24 * 30
+
+# activities rendered to TCX/GPX for upload are kept (compressed) for the next service that wants them - this many bytes in memory,
+# then, if RENDER_CACHE_PATH is set, this many more on disk there
+RENDER_CACHE_SIZE = 1024 * 1024 * 32
+RENDER_CACHE_PATH = None
+RENDER_CACHE_DISK_SIZE = 1024 * 1024 * 256
+
+# activities downloaded from services are kept (compressed) in cachedb for retries and resyncs - up to this many bytes in all,
+# each for at most this many seconds
+DOWNLOAD_CACHE_SIZE = 1024 * 1024 * 512
+DOWNLOAD_CACHE_TTL = 60 * 60 * 24
+
 # set at startup
 SITE_VER = "unknown"
 
-# cache lots of stuff to make local debugging faster
-AGGRESSIVE_CACHE = True
-
 # Diagnostics auth, None = no auth
 DIAG_AUTH_TOTP_SECRET = DIAG_AUTH_PASSWORD = None
 
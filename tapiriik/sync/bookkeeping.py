@@ -0,0 +1,91 @@
+from tapiriik.database import db
+from datetime import datetime, timedelta
+import os
+import socket
+from collections import defaultdict, OrderedDict
+
+
+class SyncBookkeeping:
+    """ Write-behind buffer for the records a user's sync keeps as it goes through their activities.
+        They're written in bulk once FlushSize have built up or FlushInterval has passed, and whenever Flush is called (i.e. at the end of the sync).
+        Nothing is queued until what it records has actually happened - so a crash can lose some records (and that work gets redone next sync), but can't record an upload that didn't succeed.
+    """
+    FlushSize = 100
+    FlushInterval = timedelta(seconds=30)
+
+    def __init__(self, userId):
+        self._userId = userId
+        self._lastFlush = datetime.utcnow()
+        self._queued = 0
+        self._origins = []
+        self._synchronizedActivities = defaultdict(set)  # connection ID -> activity UIDs
+        self._locationTypes = OrderedDict()  # (lat, lng) -> record
+        self._syncStats = OrderedDict()  # activity UID -> (destination service IDs, source service IDs, distance, timestamp)
+        self._progress = None
+
+    def RecordOrigin(self, activityUID, origin):
+        self._origins.append({"ActivityUID": activityUID, "Origin": origin})
+        self._queue()
+
+    def RecordSynchronizedActivity(self, connectionIds, activityUID):
+        for connectionId in connectionIds:
+            self._synchronizedActivities[connectionId].add(activityUID)
+        self._queue()
+
+    def RecordLocationType(self, location, startTime, activityType):
+        self._locationTypes[(location.Latitude, location.Longitude)] = {"Latitude": location.Latitude, "Longitude": location.Longitude, "StartTime": startTime, "Type": activityType}
+        self._queue()
+
+    def RecordSyncStats(self, activityUID, destinationServiceID, sourceServiceID, distance):
+        if activityUID not in self._syncStats:
+            self._syncStats[activityUID] = (set(), set(), distance, None)
+        destinations, sources, _, _ = self._syncStats[activityUID]
+        destinations.add(destinationServiceID)
+        sources.add(sourceServiceID)
+        self._syncStats[activityUID] = (destinations, sources, distance, datetime.utcnow())
+        self._queue()
+
+    def RecordProgress(self, progress):
+        self._progress = progress
+        self._checkpoint()
+
+    def _queue(self):
+        self._queued += 1
+        self._checkpoint()
+
+    def _checkpoint(self):
+        if self._queued >= SyncBookkeeping.FlushSize or datetime.utcnow() - self._lastFlush >= SyncBookkeeping.FlushInterval:
+            self.Flush()
+
+    def Flush(self):
+        # Each part is dropped from the buffer once it's written, so a failed flush can be retried without doubling anything up.
+        if self._synchronizedActivities:
+            for connectionId, activityUIDs in list(self._synchronizedActivities.items()):
+                db.connections.update({"_id": connectionId}, {"$addToSet": {"SynchronizedActivities": {"$each": list(activityUIDs)}}})
+                del self._synchronizedActivities[connectionId]
+
+        if self._origins:
+            db.activity_origins.insert(self._origins)
+            self._origins = []
+
+        if self._syncStats:
+            bulk = db.sync_stats.initialize_unordered_bulk_op()
+            for activityUID, (destinations, sources, distance, timestamp) in self._syncStats.items():
+                bulk.find({"ActivityID": activityUID}).upsert().update({"$addToSet": {"DestinationServices": {"$each": list(destinations)}, "SourceServices": {"$each": list(sources)}}, "$set": {"Distance": distance, "Timestamp": timestamp}})
+            bulk.execute()
+            self._syncStats = OrderedDict()
+
+        if self._locationTypes:
+            bulk = db.act_metadata_loctype.initialize_unordered_bulk_op()
+            for record in self._locationTypes.values():
+                bulk.find({"Latitude": record["Latitude"], "Longitude": record["Longitude"]}).upsert().replace_one(record)
+            bulk.execute()
+            self._locationTypes = OrderedDict()
+
+        if self._progress is not None:
+            # Only while we still hold them - the lease is renewed separately (see SyncLease).
+            db.users.update({"_id": self._userId, "SynchronizationWorker": os.getpid(), "SynchronizationHost": socket.gethostname()}, {"$set": {"SynchronizationProgress": self._progress}})
+            self._progress = None
+
+        self._queued = 0
+        self._lastFlush = datetime.utcnow()
@@ -0,0 +1,120 @@
+from datetime import datetime, timedelta
+import bisect
+
+_epoch = datetime(1970, 1, 1)
+
+def _microseconds(delta):
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+def _wallKey(dt):
+    return _microseconds(dt.replace(tzinfo=None) - _epoch)
+
+def _utcKey(dt):
+    offset = dt.utcoffset()
+    return _microseconds(dt.replace(tzinfo=None) - (offset if offset is not None else timedelta(0)) - _epoch)
+
+class DuplicateActivityIndex:
+    """ Finds the earliest-listed activity that a newly listed activity duplicates, without comparing it against every activity seen so far """
+
+    StartLeeway = timedelta(minutes=3)
+    TimezoneErrorPeriod = timedelta(hours=38)
+
+    def __init__(self, activities=()):
+        self._activities = []
+        self._positions = {}  # id(activity) -> position in _activities
+        self._indexedUnder = {}  # position -> (UID, StartTime) it was indexed with
+        self._byUID = {}
+        # Sorted (key, position) lists
+        self._awareByUTC = []
+        self._awareByWall = []
+        self._naiveByWall = []
+        self._byMinuteSecond = {}  # (minute, second, microsecond) of the wall clock time -> sorted (wall key, position)
+        for act in activities:
+            self.Add(act)
+
+    def IsDuplicate(act, x):
+        if x.UID == act.UID:
+            return True
+        if x.StartTime is None or act.StartTime is None:
+            return False
+        # check to see if the activities are reasonably close together to be considered duplicate
+        if (act.StartTime.tzinfo is not None) == (x.StartTime.tzinfo is not None) and abs(act.StartTime - x.StartTime) < DuplicateActivityIndex.StartLeeway:
+            return True
+        # try comparing the time as if it were TZ-aware and in the expected TZ (this won't actually change the value of the times being compared)
+        if (act.StartTime.tzinfo is not None) != (x.StartTime.tzinfo is not None) and abs(act.StartTime.replace(tzinfo=None) - x.StartTime.replace(tzinfo=None)) < DuplicateActivityIndex.StartLeeway:
+            return True
+        # Sometimes wacky stuff happens and we get two activities with the same mm:ss but different hh, because of a TZ issue somewhere along the line.
+        # So, we check for any activities +/- 14, wait, 38 hours that have the same minutes and seconds values.
+        #  (14 hours because Kiribati, and later, 38 hours because of some really terrible import code that existed on a service that shall not be named).
+        # There's a very low chance that two activities in this period would intersect and be merged together.
+        # But, given the fact that most users have maybe 0.05 activities per this period, it's an acceptable tradeoff.
+        return (abs(act.StartTime.replace(tzinfo=None) - x.StartTime.replace(tzinfo=None)) < DuplicateActivityIndex.TimezoneErrorPeriod and
+                act.StartTime.replace(tzinfo=None).time().replace(hour=0) == x.StartTime.replace(tzinfo=None).time().replace(hour=0))
+
+    def FindDuplicate(self, act):
+        candidates = set()
+        if act.UID in self._byUID:
+            candidates.add(self._byUID[act.UID])
+        if act.StartTime is not None:
+            leeway = _microseconds(DuplicateActivityIndex.StartLeeway)
+            wall = _wallKey(act.StartTime)
+            if act.StartTime.tzinfo is not None:
+                candidates.update(self._range(self._awareByUTC, _utcKey(act.StartTime), leeway))
+                candidates.update(self._range(self._naiveByWall, wall, leeway))
+            else:
+                candidates.update(self._range(self._naiveByWall, wall, leeway))
+                candidates.update(self._range(self._awareByWall, wall, leeway))
+            bucket = self._byMinuteSecond.get(self._minuteSecond(act.StartTime))
+            if bucket:
+                candidates.update(self._range(bucket, wall, _microseconds(DuplicateActivityIndex.TimezoneErrorPeriod)))
+        # The candidates are a superset of the real matches, and we want the first one that was listed.
+        for position in sorted(candidates):
+            if DuplicateActivityIndex.IsDuplicate(act, self._activities[position]):
+                return self._activities[position]
+        return None
+
+    def Add(self, act):
+        position = len(self._activities)
+        self._activities.append(act)
+        self._positions[id(act)] = position
+        self._index(act, position)
+
+    def Update(self, act):
+        # Merging can change the UID/StartTime of an indexed activity (e.g. adopting a TZ), so it needs to be moved.
+        position = self._positions[id(act)]
+        self._unindex(position)
+        self._index(act, position)
+
+    def _minuteSecond(self, dt):
+        return (dt.minute, dt.second, dt.microsecond)
+
+    def _range(self, index, key, within):
+        # Inclusive of the bounds - IsDuplicate makes the final call.
+        lo = bisect.bisect_left(index, (key - within, -1))
+        hi = bisect.bisect_right(index, (key + within, len(self._activities)))
+        return [position for _, position in index[lo:hi]]
+
+    def _entries(self, startTime, position):
+        if startTime is None:
+            return []
+        wall = (_wallKey(startTime), position)
+        entries = [(self._byMinuteSecond.setdefault(self._minuteSecond(startTime), []), wall)]
+        if startTime.tzinfo is not None:
+            entries += [(self._awareByUTC, (_utcKey(startTime), position)), (self._awareByWall, wall)]
+        else:
+            entries += [(self._naiveByWall, wall)]
+        return entries
+
+    def _index(self, act, position):
+        if act.UID not in self._byUID:
+            self._byUID[act.UID] = position
+        for index, entry in self._entries(act.StartTime, position):
+            bisect.insort(index, entry)
+        self._indexedUnder[position] = (act.UID, act.StartTime)
+
+    def _unindex(self, position):
+        uid, startTime = self._indexedUnder.pop(position)
+        if self._byUID.get(uid) == position:
+            del self._byUID[uid]
+        for index, entry in self._entries(startTime, position):
+            del index[bisect.bisect_left(index, entry)]
@@ -0,0 +1,91 @@
+from tapiriik.database import db
+from tapiriik.settings import SYNC_INTERVAL_MIN, SYNC_INTERVAL_MAX
+from datetime import datetime, timedelta
+import math
+import os
+import socket
+
+
+class SyncPriority:
+    Scheduled = 0
+    Interactive = 10  # "sync now", (re)connecting a service, etc.
+
+
+class SyncScheduler:
+    """ Hands out the users that are due for a sync - each to exactly one worker, most urgent first - straight from the NextSynchronization/SynchronizationWorker fields on the user record.
+        A claim is a lease: if whatever held it dies without releasing it, the user goes back in the queue once it expires. A sync renews it as it goes (see SyncLease).
+    """
+    LeaseDuration = timedelta(hours=1)  # comfortably more than the watchdog gives a worker to list everything
+    CadenceHalfLife = timedelta(days=14)  # how quickly what a user used to do stops counting towards their sync interval
+    CadenceMinimumHistory = timedelta(days=3)  # until then, they get the standard interval
+    CadenceReferenceRate = 1 / 24  # activities/hour that get the standard interval - anyone recording more gets synced more often, and vice versa
+
+    def EnsureIndexes():
+        db.users.ensure_index([("SynchronizationPriority", -1), ("NextSynchronization", 1)])
+
+    def LeaseExpiry():
+        return datetime.utcnow() + SyncScheduler.LeaseDuration
+
+    def Claim():
+        # Claiming is a single findAndModify, so there's nothing for workers to race on.
+        now = datetime.utcnow()
+        return db.users.find_and_modify({"NextSynchronization": {"$lte": now}, "$or": [{"SynchronizationWorker": None}, {"SynchronizationLeaseExpiry": {"$lt": now}}]},
+                                        {"$set": {"SynchronizationWorker": os.getpid(), "SynchronizationHost": socket.gethostname(), "SynchronizationLeaseExpiry": now + SyncScheduler.LeaseDuration, "SynchronizationProgress": 0, "SynchronizationStartTime": now}},
+                                        sort=[("SynchronizationPriority", -1), ("NextSynchronization", 1)],
+                                        new=True)
+
+    def UpdateCadence(user, newActivities):
+        # SyncCadence is an exponentially-weighted count of the new activities each sync turned up, and of the hours they were found over.
+        cadence = user["SyncCadence"] if "SyncCadence" in user and user["SyncCadence"] else {"Activities": 0, "Hours": 0}
+        elapsedHours = (datetime.utcnow() - user["LastSynchronization"]).total_seconds() / 3600 if "LastSynchronization" in user and user["LastSynchronization"] else 0
+        decay = 0.5 ** (elapsedHours / (SyncScheduler.CadenceHalfLife.total_seconds() / 3600))
+        return {"Activities": cadence["Activities"] * decay + newActivities, "Hours": cadence["Hours"] * decay + elapsedHours}
+
+    def SyncInterval(cadence, standardInterval):
+        if cadence["Hours"] < SyncScheduler.CadenceMinimumHistory.total_seconds() / 3600:
+            return standardInterval
+        rate = cadence["Activities"] / cadence["Hours"]
+        if rate <= 0:
+            return timedelta(seconds=SYNC_INTERVAL_MAX)
+        # The square root so it doesn't swing too far on the strength of a couple of busy (or quiet) weeks.
+        interval = standardInterval.total_seconds() * math.sqrt(SyncScheduler.CadenceReferenceRate / rate)
+        return timedelta(seconds=max(SYNC_INTERVAL_MIN, min(SYNC_INTERVAL_MAX, interval)))
+
+    def Release(user, nextSync, cadence=None):
+        # PerformUserSync will usually have unlocked them already - but not if they were skipped, or there was nothing to sync.
+        update = {"NextSynchronization": nextSync, "LastSynchronization": datetime.utcnow(), "SynchronizationPriority": SyncPriority.Scheduled}
+        if cadence is not None:
+            update["SyncCadence"] = cadence
+        db.users.update({"_id": user["_id"], "$or": [{"SynchronizationWorker": None}, {"SynchronizationWorker": os.getpid(), "SynchronizationHost": socket.gethostname()}]},
+                        {"$set": update,
+                         "$unset": {"NextSyncIsExhaustive": None, "SynchronizationWorker": None, "SynchronizationHost": None, "SynchronizationProgress": None, "SynchronizationLeaseExpiry": None}})
+
+    def RenewLease(userId):
+        # Returns False if this worker doesn't hold the user any more - i.e. the lease ran out and someone else claimed them.
+        return db.users.find_and_modify({"_id": userId, "SynchronizationWorker": os.getpid(), "SynchronizationHost": socket.gethostname()},
+                                        {"$set": {"SynchronizationLeaseExpiry": SyncScheduler.LeaseExpiry()}},
+                                        fields={"_id": True}) is not None
+
+    def Schedule(user, exhaustive=None, priority=SyncPriority.Interactive):
+        update = {"NextSynchronization": datetime.utcnow(), "SynchronizationPriority": priority}
+        if exhaustive is not None:
+            update["NextSyncIsExhaustive"] = exhaustive
+        db.users.update({"_id": user["_id"]}, {"$set": update})
+
+
+class SyncLease:
+    """ The hold a worker has on the user it's synchronizing. The sync renews it at every step, so it only runs out if the worker's stopped making progress.
+        Renewals are a database round trip, so they're skipped if the last one was less than RenewalInterval ago.
+    """
+    RenewalInterval = timedelta(minutes=1)
+
+    def __init__(self, userId):
+        self._userId = userId
+        self._lastRenewal = datetime.utcnow()  # it was just claimed
+
+    def Renew(self, force=False):
+        """ Returns False if another worker holds the user now """
+        if not force and datetime.utcnow() - self._lastRenewal < SyncLease.RenewalInterval:
+            return True
+        self._lastRenewal = datetime.utcnow()
+        return SyncScheduler.RenewLease(self._userId)
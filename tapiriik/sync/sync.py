@@ -1,6 +1,9 @@
 from tapiriik.database import db, cachedb
-from tapiriik.services import ServiceRecord, APIExcludeActivity, ServiceException, ServiceExceptionScope, ServiceWarning
+from tapiriik.services import ServiceRecord, APIExcludeActivity, APIDeferral, ServiceException, ServiceExceptionScope, ServiceWarning
 from tapiriik.settings import USER_SYNC_LOGS, DISABLED_SERVICES
+from .duplicate_index import DuplicateActivityIndex
+from .bookkeeping import SyncBookkeeping
+from .scheduler import SyncScheduler, SyncPriority, SyncLease
 from datetime import datetime, timedelta
 import sys
 import os
@@ -9,8 +12,12 @@ import traceback
 import pprint
 import copy
 import random
+import collections
+import threading
 import logging
 import logging.handlers
+import pytz
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 # Set this up seperate from the logger used in this scope, so services logging messages are caught and logged into user's files.
 _global_logger = logging.getLogger("tapiriik")
@@ -23,6 +30,18 @@ _global_logger.addHandler(logging_console_handler)
 
 logger = logging.getLogger("tapiriik.sync.worker")
 
+# Several users can be synchronizing in the same process at once, so we track which one the current thread is working for.
+_syncContext = threading.local()
+
+class _UserSyncLogFilter(logging.Filter):
+    # Keeps the per-user log file from picking up messages logged by threads working on other users.
+    def __init__(self, userId):
+        logging.Filter.__init__(self)
+        self._userId = userId
+
+    def filter(self, record):
+        return getattr(_syncContext, "UserID", None) == self._userId
+
 def _formatExc():
     try:
         exc_type, exc_value, exc_traceback = sys.exc_info()
@@ -42,8 +61,27 @@ def _formatExc():
     finally:
         del exc_traceback, exc_value, exc_type
 
+_uploadSemaphores = {}
+_uploadSemaphoresLock = threading.Lock()
+
+def _uploadSemaphore(svc):
+    # Shared by every user being synchronized in this process, so the cap holds per-service rather than per-sync.
+    with _uploadSemaphoresLock:
+        if svc.ID not in _uploadSemaphores:
+            _uploadSemaphores[svc.ID] = threading.BoundedSemaphore(svc.UploadConcurrency)
+        return _uploadSemaphores[svc.ID]
+
+class _SyncOutcome:
+    # What a download/upload thread ran into - applied to the sync state back on the main thread, in activity order.
+    def __init__(self):
+        self.Errors = []  # (ServiceRecord, packed error)
+        self.Exclusions = []  # (ServiceRecord, APIExcludeActivity)
+        self.ExcludedServices = []
+
 def _packServiceException(step, e):
     res = {"Step": step, "Message": e.Message + "\n" + _formatExc(), "Block": e.Block, "Scope": e.Scope}
+    if isinstance(e, APIDeferral):
+        res["Deferred"] = True
     if e.UserException:
         res["UserException"] = {"Type": e.UserException.Type, "Extra": e.UserException.Extra, "InterventionRequired": e.UserException.InterventionRequired, "ClearGroup": e.UserException.ClearGroup}
     return res
@@ -55,15 +93,16 @@ class Sync:
     SyncIntervalJitter = timedelta(minutes=5)
     MinimumSyncInterval = timedelta(seconds=30)
     MaximumIntervalBeforeExhaustiveSync = timedelta(days=14)  # Based on the general page size of 50 activites, this would be >3/day...
+    DownloadPrefetchDepth = 4  # How many activities can be downloading while the current one is uploaded
+    GlobalSyncClaimInterval = 1  # seconds - how often PerformGlobalSync looks for newly-due users while it has threads free
+    ListingCursorOverlap = timedelta(days=2)  # How far before the oldest listing cursor a non-exhaustive sync looks - covers activities that took a while to be uploaded
+    _listingTZSlack = timedelta(days=1)  # Services are asked for a bit more, so that start times in the wrong TZ can't put one copy of an activity inside the window and another outside it
 
     _logFormat = '[%(levelname)-8s] %(asctime)s (%(name)s:%(lineno)d) %(message)s'
     _logDateFormat = '%Y-%m-%d %H:%M:%S'
 
     def ScheduleImmediateSync(user, exhaustive=None):
-        if exhaustive is None:
-            db.users.update({"_id": user["_id"]}, {"$set": {"NextSynchronization": datetime.utcnow()}})
-        else:
-            db.users.update({"_id": user["_id"]}, {"$set": {"NextSynchronization": datetime.utcnow(), "NextSyncIsExhaustive": exhaustive}})
+        SyncScheduler.Schedule(user, exhaustive, priority=SyncPriority.Interactive)
 
     def SetNextSyncIsExhaustive(user, exhaustive=False):
         db.users.update({"_id": user["_id"]}, {"$set": {"NextSyncIsExhaustive": exhaustive}})
@@ -102,61 +141,37 @@ class Sync:
             return a
 
     def _accumulateActivities(svc, svcActivities, activityList):
-        # Yep, abs() works on timedeltas
-        activityStartLeeway = timedelta(minutes=3)
-        timezoneErrorPeriod = timedelta(hours=38)
         from tapiriik.services.interchange import ActivityType
+        duplicateIndex = DuplicateActivityIndex(activityList)
         for act in svcActivities:
             act.UIDs = [act.UID]
             if act.TZ and not hasattr(act.TZ, "localize"):
                 raise ValueError("Got activity with TZ type " + str(type(act.TZ)) + " instead of a pytz timezone")
             # Used to ensureTZ() right here - doubt it's needed any more?
-            existElsewhere = [x for x in activityList if x.UID == act.UID
-                              or  # check to see if the activities are reasonably close together to be considered duplicate
-                              (x.StartTime is not None and
-                               act.StartTime is not None and
-                               (act.StartTime.tzinfo is not None) == (x.StartTime.tzinfo is not None) and
-                               abs(act.StartTime-x.StartTime) < activityStartLeeway
-                              )
-                              or  # try comparing the time as if it were TZ-aware and in the expected TZ (this won't actually change the value of the times being compared)
-                              (x.StartTime is not None and
-                               act.StartTime is not None and
-                               (act.StartTime.tzinfo is not None) != (x.StartTime.tzinfo is not None) and
-                               abs(act.StartTime.replace(tzinfo=None)-x.StartTime.replace(tzinfo=None)) < activityStartLeeway
-                              )
-                              or
-                              # Sometimes wacky stuff happens and we get two activities with the same mm:ss but different hh, because of a TZ issue somewhere along the line.
-                              # So, we check for any activities +/- 14, wait, 38 hours that have the same minutes and seconds values.
-                              #  (14 hours because Kiribati, and later, 38 hours because of some really terrible import code that existed on a service that shall not be named).
-                              # There's a very low chance that two activities in this period would intersect and be merged together.
-                              # But, given the fact that most users have maybe 0.05 activities per this period, it's an acceptable tradeoff.
-                              (x.StartTime is not None and
-                               act.StartTime is not None and
-                               abs(act.StartTime.replace(tzinfo=None)-x.StartTime.replace(tzinfo=None)) < timezoneErrorPeriod and
-                               act.StartTime.replace(tzinfo=None).time().replace(hour=0) == x.StartTime.replace(tzinfo=None).time().replace(hour=0)
-                               )
-                              ]
-            if len(existElsewhere) > 0:
+            existingActivity = duplicateIndex.FindDuplicate(act)
+            if existingActivity is not None:
                 # we don't merge the exclude values here, since at this stage the services have the option of just not returning those activities
-                if act.TZ is not None and existElsewhere[0].TZ is None:
-                    existElsewhere[0].TZ = act.TZ
-                    existElsewhere[0].DefineTZ()
+                if act.TZ is not None and existingActivity.TZ is None:
+                    existingActivity.TZ = act.TZ
+                    existingActivity.DefineTZ()
                 # tortuous merging logic is tortuous
-                existElsewhere[0].StartTime = Sync._coalesceDatetime(existElsewhere[0].StartTime, act.StartTime)
-                existElsewhere[0].EndTime = Sync._coalesceDatetime(existElsewhere[0].EndTime, act.EndTime, knownTz=existElsewhere[0].StartTime.tzinfo)
-                existElsewhere[0].Name = existElsewhere[0].Name if existElsewhere[0].Name is not None else act.Name
-                existElsewhere[0].Waypoints = existElsewhere[0].Waypoints if len(existElsewhere[0].Waypoints) > 0 else act.Waypoints
-                existElsewhere[0].Type = ActivityType.PickMostSpecific([existElsewhere[0].Type, act.Type])
-                existElsewhere[0].Private = existElsewhere[0].Private or act.Private
+                existingActivity.StartTime = Sync._coalesceDatetime(existingActivity.StartTime, act.StartTime)
+                existingActivity.EndTime = Sync._coalesceDatetime(existingActivity.EndTime, act.EndTime, knownTz=existingActivity.StartTime.tzinfo)
+                existingActivity.Name = existingActivity.Name if existingActivity.Name is not None else act.Name
+                existingActivity.Waypoints = existingActivity.Waypoints if len(existingActivity.Waypoints) > 0 else act.Waypoints
+                existingActivity.Type = ActivityType.PickMostSpecific([existingActivity.Type, act.Type])
+                existingActivity.Private = existingActivity.Private or act.Private
 
                 prerenderedFormats = act.PrerenderedFormats
-                prerenderedFormats.update(existElsewhere[0].PrerenderedFormats)
-                existElsewhere[0].PrerenderedFormats = prerenderedFormats  # I bet this is gonna kill the RAM usage.
-                existElsewhere[0].UploadedTo += act.UploadedTo
-                existElsewhere[0].UIDs += act.UIDs  # I think this is merited
-                act.UIDs = existElsewhere[0].UIDs  # stop the circular inclusion, not that it matters
+                prerenderedFormats.update(existingActivity.PrerenderedFormats)
+                existingActivity.PrerenderedFormats = prerenderedFormats  # I bet this is gonna kill the RAM usage.
+                existingActivity.UploadedTo += act.UploadedTo
+                existingActivity.UIDs += act.UIDs  # I think this is merited
+                act.UIDs = existingActivity.UIDs  # stop the circular inclusion, not that it matters
+                duplicateIndex.Update(existingActivity)
                 continue
             activityList.append(act)
+            duplicateIndex.Add(act)
 
     def _determineEligibleRecipientServices(activity, recipientServices, excludedServices, user):
         from tapiriik.auth import User
@@ -206,39 +221,244 @@ class Sync:
             identifier = str(identifier).replace(".", "_")
             tempSyncExclusions[serviceRecord._id][identifier] = {"Message": exclusion.Message, "Activity": str(exclusion.Activity) if exclusion.Activity else None, "ExternalActivityID": exclusion.ExternalActivityID, "Permanent": exclusion.Permanent, "Effective": datetime.utcnow()}
 
-    def PerformGlobalSync(heartbeat_callback=None):
-        from tapiriik.auth import User
-        users = db.users.find({"NextSynchronization": {"$lte": datetime.utcnow()}, "SynchronizationWorker": None}).sort("NextSynchronization").limit(1)
-        userCt = 0
-        for user in users:
-            userCt += 1
-            syncStart = datetime.utcnow()
-
-            # Always to an exhaustive sync if there were errors
-            #   Sometimes services report that uploads failed even when they succeeded.
-            #   If a partial sync was done, we'd be assuming that the accounts were consistent past the first page
-            #       e.g. If an activity failed to upload far in the past, it would never be attempted again.
-            #   So we need to verify the full state of the accounts.
-            # But, we can still do a partial sync if there are *only* blocking errors
-            #   In these cases, the block will protect that service from being improperly manipulated (though tbqh I can't come up with a situation where this would happen, it's more of a performance thing).
-            #   And, when the block is cleared, NextSyncIsExhaustive is set.
-
-            exhaustive = "NextSyncIsExhaustive" in user and user["NextSyncIsExhaustive"] is True
-            if "NonblockingSyncErrorCount" in user and user["NonblockingSyncErrorCount"] > 0:
-                exhaustive = True
+    def _listingWindowStart(serviceConnections, exhaustive):
+        # Every connection remembers when it was last listed successfully, so a regular sync only needs to look at what's happened since the oldest of those.
+        # It's the same window for all of them - otherwise an activity could show up from one service and not the other, and get uploaded to where it already is.
+        if exhaustive:
+            return None
+        cursors = [getattr(conn, "ListingCursor", None) for conn in serviceConnections]
+        if not cursors or None in cursors:
+            return None
+        return min(cursors) - Sync.ListingCursorOverlap
+
+    def _startsBefore(activity, when):
+        startTime = activity.StartTime
+        if startTime.tzinfo:
+            startTime = startTime.astimezone(pytz.utc).replace(tzinfo=None)
+        return startTime < when
+
+    def _isLate(activity, serviceConnections, excludedServices, tempSyncExclusions, user):
+        # For activities from before the listing window - most will have been synchronized already, but ones that were uploaded long after they were recorded won't have been.
+        if activity.Private:
+            return False
+        if [x for x in activity.UploadedTo if activity.UID in tempSyncExclusions[x["Connection"]._id]]:
+            return False
+        recipientServices = Sync._determineRecipientServices(activity, serviceConnections)
+        return len(Sync._determineEligibleRecipientServices(activity, recipientServices, excludedServices, user)) > 0
+
+    def _downloadActivityList(conn, exhaustive, userId, since=None):
+        # Returns (activities, exclusions, packed error) - the error needs to be packed on this thread while the traceback is still around.
+        _syncContext.UserID = userId
+        svc = conn.Service
+        try:
+            logger.info("\tRetrieving list from " + svc.ID)
+            svcActivities, svcExclusions = svc.DownloadActivityList(conn, exhaustive, since=since)
+        except (ServiceException, ServiceWarning) as e:
+            return None, None, _packServiceException(SyncStep.List, e)
+        except Exception as e:
+            return None, None, {"Step": SyncStep.List, "Message": _formatExc()}
+        return svcActivities, svcExclusions, None
+
+    def _downloadActivityLists(serviceConnections, exhaustive, userId, since=None):
+        if len(serviceConnections) <= 1:
+            return [Sync._downloadActivityList(conn, exhaustive, userId, since) for conn in serviceConnections]
+        with ThreadPoolExecutor(max_workers=len(serviceConnections)) as pool:
+            return list(pool.map(lambda conn: Sync._downloadActivityList(conn, exhaustive, userId, since), serviceConnections))
+
+    def _downloadActivity(activity, excludedServices, tempSyncExclusions, userId):
+        # Runs on a download thread - returns (activity, source service, _SyncOutcome).
+        _syncContext.UserID = userId
+        outcome = _SyncOutcome()
+        dlSvc = None
+        for dlSvcUploadRec in activity.UploadedTo:
+            dlSvcRecord = dlSvcUploadRec["Connection"]  # I guess in the future we could smartly choose which for >1
+            dlSvc = dlSvcRecord.Service
+            logger.info("\t from " + dlSvc.ID)
+            if activity.UID in tempSyncExclusions[dlSvcRecord._id]:
+                logger.info("\t\t has activity exclusion logged")
+                continue
+            if dlSvcRecord in excludedServices or dlSvcRecord in outcome.ExcludedServices:
+                logger.info("\t\t service became excluded after listing") # Because otherwise we'd never have been trying to download from it in the first place.
+                continue
 
+            workingCopy = copy.copy(activity)  # we can hope
             try:
-                Sync.PerformUserSync(user, exhaustive, null_next_sync_on_unlock=True, heartbeat_callback=heartbeat_callback)
-            except SynchronizationConcurrencyException:
-                pass  # another worker picked them
+                workingCopy = dlSvc.DownloadActivity(dlSvcRecord, workingCopy)
+            except (ServiceException, ServiceWarning) as e:
+                outcome.Errors.append((dlSvcRecord, _packServiceException(SyncStep.Download, e)))
+                if e.Block and e.Scope == ServiceExceptionScope.Service: # I can't imagine why the same would happen at the account level, so there's no behaviour to immediately abort the sync in that case.
+                    outcome.ExcludedServices.append(dlSvcRecord)
+                if not issubclass(e.__class__, ServiceWarning):
+                    continue
+            except APIExcludeActivity as e:
+                logger.info("\t\t excluded by service")
+                e.Activity = workingCopy
+                outcome.Exclusions.append((dlSvcRecord, e))
+                continue
+            except Exception as e:
+                outcome.Errors.append((dlSvcRecord, {"Step": SyncStep.Download, "Message": _formatExc()}))
+                continue
+            if workingCopy.Private and not dlSvcRecord.GetConfiguration()["sync_private"]:
+                logger.info("\t\t is private and restricted from sync")  # Sync exclusion instead?
+                continue
+            try:
+                workingCopy.CheckSanity()
+            except:
+                logger.info("\t\t failed sanity check")
+                outcome.Exclusions.append((dlSvcRecord, APIExcludeActivity("Sanity check failed " + _formatExc(), activity=workingCopy)))
+                continue
             else:
-                nextSync = None
-                if User.HasActivePayment(user):
-                    nextSync = datetime.utcnow() + Sync.SyncInterval + timedelta(seconds=random.randint(-Sync.SyncIntervalJitter.total_seconds(), Sync.SyncIntervalJitter.total_seconds()))
-                db.users.update({"_id": user["_id"]}, {"$set": {"NextSynchronization": nextSync, "LastSynchronization": datetime.utcnow()}, "$unset": {"NextSyncIsExhaustive": None}})
-                syncTime = (datetime.utcnow() - syncStart).total_seconds()
-                db.sync_worker_stats.insert({"Timestamp": datetime.utcnow(), "Worker": os.getpid(), "Host": socket.gethostname(), "TimeTaken": syncTime})
-        return userCt
+                # It might be a while before this gets uploaded, since we're downloading ahead.
+                workingCopy.CompactWaypoints()
+                return workingCopy, dlSvc, outcome  # succesfully got the activity + passed sanity checks, can stop now
+        return None, dlSvc, outcome
+
+    def _uploadCopy(activity):
+        # The uploads to each destination run at once, and most of them start off with EnsureTZ(), which rewrites the times (and so the waypoints) in place.
+        # So each gets its own copy - the waypoints are the only part that's big, and by now they're compacted into columns that copy cheaply.
+        dupe = copy.copy(activity)
+        dupe.Waypoints = copy.deepcopy(activity.Waypoints)
+        return dupe
+
+    def _uploadActivity(destinationSvcRecord, activity, userId):
+        # Runs on an upload thread - returns (whether the activity should be marked as synchronized, _SyncOutcome).
+        _syncContext.UserID = userId
+        outcome = _SyncOutcome()
+        destSvc = destinationSvcRecord.Service
+        with _uploadSemaphore(destSvc):
+            try:
+                logger.info("\t\tUploading to " + destSvc.ID)
+                destSvc.UploadActivity(destinationSvcRecord, activity)
+            except (ServiceException, ServiceWarning) as e:
+                outcome.Errors.append((destinationSvcRecord, _packServiceException(SyncStep.Upload, e)))
+                if e.Block and e.Scope == ServiceExceptionScope.Service: # Similarly, no behaviour to immediately abort the sync if an account-level exception is raised
+                    outcome.ExcludedServices.append(destinationSvcRecord)
+                if not issubclass(e.__class__, ServiceWarning):
+                    return False, outcome
+            except Exception as e:
+                outcome.Errors.append((destinationSvcRecord, {"Step": SyncStep.Upload, "Message": _formatExc()}))
+                return False, outcome
+        return True, outcome
+
+    def _applyOutcome(outcome, tempSyncErrors, tempSyncExclusions, excludedServices):
+        for conn, error in outcome.Errors:
+            tempSyncErrors[conn._id].append(error)
+        for conn, exclusion in outcome.Exclusions:
+            Sync._accumulateExclusions(conn, exclusion, tempSyncExclusions)
+        for conn in outcome.ExcludedServices:
+            if conn not in excludedServices:
+                excludedServices.append(conn)
+
+    def PerformGlobalSync(heartbeat_callback=None, concurrency=1, limit=None, stop=None):
+        # Synchronizes up to `concurrency` users at once, claiming the next one due as soon as a thread frees up - until nobody's due and every thread's idle, `limit` users have been started, or stop() returns True.
+        # Returns how many users were synchronized.
+        started = 0
+
+        def claim():
+            if (limit is not None and started >= limit) or (stop and stop()):
+                return None
+            return SyncScheduler.Claim()
+
+        if concurrency <= 1:
+            while True:
+                user = claim()
+                if not user:
+                    return started
+                started += 1
+                Sync._performScheduledUserSync(user, heartbeat_callback)
+
+        # Nearly all of a sync is spent waiting on remote APIs, so we can get away with threads here.
+        # Each user's already been claimed for this process by the scheduler, which PerformUserSync's lock check accepts.
+        running = set()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            while True:
+                while len(running) < concurrency:
+                    user = claim()
+                    if not user:
+                        break
+                    started += 1
+                    running.add(pool.submit(Sync._performScheduledUserSync, user, heartbeat_callback))
+                if not running:
+                    return started
+                # With threads free, check back every so often for users that have come due in the meantime.
+                done, running = wait(running, timeout=Sync.GlobalSyncClaimInterval if len(running) < concurrency else None, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()  # a sync that blew up should take the worker down, as it always has
+
+    def _performScheduledUserSync(user, heartbeat_callback=None):
+        from tapiriik.auth import User
+        syncStart = datetime.utcnow()
+
+        # Always to an exhaustive sync if there were errors
+        #   Sometimes services report that uploads failed even when they succeeded.
+        #   If a partial sync was done, we'd be assuming that the accounts were consistent past the first page
+        #       e.g. If an activity failed to upload far in the past, it would never be attempted again.
+        #   So we need to verify the full state of the accounts.
+        # But, we can still do a partial sync if there are *only* blocking errors
+        #   In these cases, the block will protect that service from being improperly manipulated (though tbqh I can't come up with a situation where this would happen, it's more of a performance thing).
+        #   And, when the block is cleared, NextSyncIsExhaustive is set.
+
+        exhaustive = "NextSyncIsExhaustive" in user and user["NextSyncIsExhaustive"] is True
+        if "NonblockingSyncErrorCount" in user and user["NonblockingSyncErrorCount"] > 0:
+            exhaustive = True
+        if "LateActivityCount" in user and user["LateActivityCount"] > 0:
+            exhaustive = True  # they were left for this
+
+        try:
+            newActivities = 0
+            skipped = not exhaustive and Sync._preflight(user)
+            if not skipped:
+                newActivities = Sync.PerformUserSync(user, exhaustive, null_next_sync_on_unlock=True, heartbeat_callback=heartbeat_callback) or 0
+        except SynchronizationConcurrencyException:
+            pass  # another worker picked them
+        else:
+            # An exhaustive sync turns up all sorts of old things, which says nothing about how often they're recording new ones.
+            cadence = SyncScheduler.UpdateCadence(user, 0 if exhaustive else newActivities)
+            nextSync = None
+            if User.HasActivePayment(user):
+                nextSync = datetime.utcnow() + SyncScheduler.SyncInterval(cadence, Sync.SyncInterval) + timedelta(seconds=random.randint(-Sync.SyncIntervalJitter.total_seconds(), Sync.SyncIntervalJitter.total_seconds()))
+            SyncScheduler.Release(user, nextSync, cadence)
+            syncTime = (datetime.utcnow() - syncStart).total_seconds()
+            db.sync_worker_stats.insert({"Timestamp": datetime.utcnow(), "Worker": os.getpid(), "Host": socket.gethostname(), "TimeTaken": syncTime, "Skipped": skipped})
+
+    def _preflight(user):
+        # Most regular syncs turn up nothing, so before going to the trouble of locking the user and listing everything, ask each service whether anything's happened in the listing window.
+        # Returns True if none of them have anything new, in which case the sync can be skipped - and the cursors moved on, since that's as good as a listing.
+        preflightStart = datetime.utcnow()
+        connectedServiceIds = [x["ID"] for x in user["ConnectedServices"]]
+        serviceConnections = [ServiceRecord(x) for x in db.connections.find({"_id": {"$in": connectedServiceIds}}, {"SynchronizedActivities": False, "SynchronizedActivityDigests": False})]
+        if [x for x in serviceConnections if getattr(x, "SyncErrors", None)]:
+            return False  # leave those to the regular sync
+        serviceConnections = [x for x in serviceConnections if x.Service.ID not in DISABLED_SERVICES]
+        listingWindowStart = Sync._listingWindowStart(serviceConnections, exhaustive=False)
+        if not listingWindowStart:
+            return False
+        since = pytz.utc.localize(listingWindowStart - Sync._listingTZSlack)
+
+        for conn in serviceConnections:
+            svc = conn.Service
+            if svc.RequiresExtendedAuthorizationDetails and not getattr(conn, "ExtendedAuthorization", None):
+                extAuthDetails = cachedb.extendedAuthDetails.find_one({"ID": conn._id})
+                if not extAuthDetails:
+                    return False
+                conn.ExtendedAuthorization = extAuthDetails["ExtendedAuthorization"]
+            try:
+                if svc.HasNewActivities(conn, since):
+                    return False
+            except Exception:
+                logger.exception("Preflight check failed for " + svc.ID)  # the sync proper can deal with it
+                return False
+
+        logger.info("Nothing new for " + str(user["_id"]) + " since " + str(listingWindowStart) + ", skipping sync")
+        db.connections.update({"_id": {"$in": [x._id for x in serviceConnections]}}, {"$set": {"ListingCursor": preflightStart}}, multi=True)
+        return True
+
+    def _heartbeat(lease, heartbeat_callback, step):
+        # Getting to the next step counts as progress, so the lease is renewed - and if it ran out in the meantime and another worker's claimed the user, this one stops.
+        if heartbeat_callback:
+            heartbeat_callback(step)
+        if not lease.Renew():
+            raise SynchronizationConcurrencyException
 
     def PerformUserSync(user, exhaustive=False, null_next_sync_on_unlock=False, heartbeat_callback=None):
         # And thus begins the monolithic sync function that's a pain to test.
@@ -248,20 +468,27 @@ class Sync:
             return  # nothing's going anywhere anyways
 
         # mark this user as in-progress
-        db.users.update({"_id": user["_id"], "SynchronizationWorker": None}, {"$set": {"SynchronizationWorker": os.getpid(), "SynchronizationHost": socket.gethostname(), "SynchronizationProgress": 0, "SynchronizationStartTime": datetime.utcnow()}})
+        db.users.update({"_id": user["_id"], "SynchronizationWorker": None}, {"$set": {"SynchronizationWorker": os.getpid(), "SynchronizationHost": socket.gethostname(), "SynchronizationProgress": 0, "SynchronizationStartTime": datetime.utcnow(), "SynchronizationLeaseExpiry": SyncScheduler.LeaseExpiry()}})
         lockCheck = db.users.find_one({"_id": user["_id"], "SynchronizationWorker": os.getpid(), "SynchronizationHost": socket.gethostname()})
         if lockCheck is None:
             raise SynchronizationConcurrencyException  # failed to get lock
 
+        lease = SyncLease(user["_id"])
+
+        _syncContext.UserID = user["_id"]
         logging_file_handler = logging.handlers.RotatingFileHandler(USER_SYNC_LOGS + str(user["_id"]) + ".log", maxBytes=5242880, backupCount=1)
         logging_file_handler.setFormatter(logging.Formatter(Sync._logFormat, Sync._logDateFormat))
+        logging_file_handler.addFilter(_UserSyncLogFilter(user["_id"]))
         _global_logger.addHandler(logging_file_handler)
 
         logger.info("Beginning sync for " + str(user["_id"]) + "(exhaustive: " + str(exhaustive) + ")")
+        bookkeeping = SyncBookkeeping(user["_id"])
+        uploadedActivities = 0  # what the scheduler goes by - failed and excluded attempts say nothing about how often they record things
         try:
             serviceConnections = [ServiceRecord(x) for x in db.connections.find({"_id": {"$in": connectedServiceIds}})]
             allExtendedAuthDetails = list(cachedb.extendedAuthDetails.find({"ID": {"$in": connectedServiceIds}}))
             activities = []
+            listConnections = []
 
             excludedServices = []
 
@@ -287,15 +514,14 @@ class Sync:
 
                 # If we're not going to be doing anything anyways, stop now
                 if len(serviceConnections) - len(excludedServices) <= 1:
-                    activities = []
+                    listConnections = []
                     break
 
-                if heartbeat_callback:
-                    heartbeat_callback(SyncStep.List)
+                Sync._heartbeat(lease, heartbeat_callback, SyncStep.List)
 
                 # Bail out as appropriate for the entire account (tempSyncErrors contains only blocking errors at this point)
                 if [x for x in tempSyncErrors[conn._id] if x["Scope"] == ServiceExceptionScope.Account]:
-                    activities = [] # Kinda meh, I'll make it better when I break this into seperate functions, whenever that happens...
+                    listConnections = [] # Kinda meh, I'll make it better when I break this into seperate functions, whenever that happens...
                     break
 
                 # ...and for this specific service
@@ -317,20 +543,41 @@ class Sync:
                         # the connection never gets saved in full again, so we can sub these in here at no risk
                         conn.ExtendedAuthorization = extAuthDetails[0]
 
-                try:
-                    logger.info("\tRetrieving list from " + svc.ID)
-                    svcActivities, svcExclusions = svc.DownloadActivityList(conn, exhaustive)
-                except (ServiceException, ServiceWarning) as e:
-                    tempSyncErrors[conn._id].append(_packServiceException(SyncStep.List, e))
-                    excludedServices.append(conn)
-                    if not issubclass(e.__class__, ServiceWarning):
-                        continue
-                except Exception as e:
-                    tempSyncErrors[conn._id].append({"Step": SyncStep.List, "Message": _formatExc()})
+                listConnections.append(conn)
+
+            # The lists are retrieved all at once, then merged in the original connection order so the results don't depend on which service answered first.
+            listingStart = datetime.utcnow()
+            listingWindowStart = Sync._listingWindowStart(listConnections, exhaustive)
+            if listingWindowStart:
+                logger.info("Listing activities since " + str(listingWindowStart))
+            listResults = Sync._downloadActivityLists(listConnections, exhaustive, user["_id"], since=pytz.utc.localize(listingWindowStart - Sync._listingTZSlack) if listingWindowStart else None)
+            Sync._heartbeat(lease, heartbeat_callback, SyncStep.List)  # that can take a while
+            listedConnections = []
+            for conn, (svcActivities, svcExclusions, listError) in zip(listConnections, listResults):
+                if listError:
+                    tempSyncErrors[conn._id].append(listError)
                     excludedServices.append(conn)
                     continue
+                listedConnections.append(conn)
                 Sync._accumulateExclusions(conn, svcExclusions, tempSyncExclusions)
-                Sync._accumulateActivities(svc, svcActivities, activities)
+                Sync._accumulateActivities(conn.Service, svcActivities, activities)
+
+            lateActivityCount = 0
+            if listingWindowStart:
+                # Only now that copies from every service have been merged, so each activity is either in or out everywhere.
+                # The window goes by start time, since that's all most services can list by - so anything uploaded more than ListingCursorOverlap after it was recorded falls outside it.
+                # We can't tell those from the ones that were synchronized long ago until they're checked against the connections, so that's done here - and any that do need to go somewhere are counted, so the next sync is exhaustive and picks them up.
+                # (They can't just go through this sync - the services that only listed the window wouldn't have turned up their copies, if they have them.)
+                outsideWindow = [x for x in activities if Sync._startsBefore(x, listingWindowStart)]
+                activities = [x for x in activities if not Sync._startsBefore(x, listingWindowStart)]
+                lateActivityCount = len([x for x in outsideWindow if Sync._isLate(x, serviceConnections, excludedServices, tempSyncExclusions, user)])
+                if lateActivityCount:
+                    logger.info("%d activities from before the listing window still need synchronizing - leaving them for an exhaustive sync" % lateActivityCount)
+                del outsideWindow
+
+            # Failed lists can leave us with nowhere to send anything.
+            if len(serviceConnections) - len(excludedServices) <= 1:
+                activities = []
 
             origins = list(db.activity_origins.find({"ActivityUID": {"$in": [x.UID for x in activities]}}))
             activitiesWithOrigins = [x["ActivityUID"] for x in origins]
@@ -346,7 +593,7 @@ class Sync:
                         # we can log the origin of this activity
                         if activity.UID not in activitiesWithOrigins:  # No need to hammer the database updating these when they haven't changed
                             logger.info("\t\t Updating db with origin for proceeding activity")
-                            db.activity_origins.insert({"ActivityUID": activity.UID, "Origin": {"Service": activity.UploadedTo[0]["Connection"].Service.ID, "ExternalID": activity.UploadedTo[0]["Connection"].ExternalID}})
+                            bookkeeping.RecordOrigin(activity.UID, {"Service": activity.UploadedTo[0]["Connection"].Service.ID, "ExternalID": activity.UploadedTo[0]["Connection"].ExternalID})
                         activity.Origin = activity.UploadedTo[0]["Connection"]
                 else:
                     if activity.UID in activitiesWithOrigins:
@@ -360,164 +607,153 @@ class Sync:
 
             totalActivities = len(activities)
             processedActivities = 0
-            for activity in activities:
+            # Downloads for the next few activities run while the current one is being uploaded - all the bookkeeping still happens here, in order.
+            activityQueue = collections.deque(activities)
+            del activities
+            pendingDownloads = collections.deque()
+            with ThreadPoolExecutor(max_workers=Sync.DownloadPrefetchDepth) as downloadPool, ThreadPoolExecutor(max_workers=len(serviceConnections)) as uploadPool:
+                while activityQueue or pendingDownloads:
+                    while activityQueue and len(pendingDownloads) < Sync.DownloadPrefetchDepth:
+                        activity = activityQueue.popleft()
+
+                        # Locally mark this activity as present on the appropriate services.
+                        # These needs to happen regardless of whether the activity is going to be synchronized.
+                        #   Before, I had moved this under all the eligibility/recipient checks, but that could cause persistent duplicate activities when the user had already manually uploaded the same activity to multiple sites.
+                        updateServicesWithExistingActivity = False
+                        for serviceWithExistingActivityUploadRecord in activity.UploadedTo:
+                            serviceWithExistingActivity = serviceWithExistingActivityUploadRecord["Connection"]
+                            if not hasattr(serviceWithExistingActivity, "SynchronizedActivities") or activity.UID not in serviceWithExistingActivity.SynchronizedActivities:
+                                updateServicesWithExistingActivity = True
+                                break
+                        if updateServicesWithExistingActivity:
+                            bookkeeping.RecordSynchronizedActivity([x["Connection"]._id for x in activity.UploadedTo], activity.UID)
+
+                        # We don't always know if the activity is private before it's downloaded, but we can check anyways since it saves a lot of time.
+                        if activity.Private:
+                            logger.info("\t %s is private and restricted from sync (pre-download)" % activity.UID)  # Sync exclusion instead?
+                            del activity
+                            continue
 
-                # Locally mark this activity as present on the appropriate services.
-                # These needs to happen regardless of whether the activity is going to be synchronized.
-                #   Before, I had moved this under all the eligibility/recipient checks, but that could cause persistent duplicate activities when the user had already manually uploaded the same activity to multiple sites.
-                updateServicesWithExistingActivity = False
-                for serviceWithExistingActivityUploadRecord in activity.UploadedTo:
-                    serviceWithExistingActivity = serviceWithExistingActivityUploadRecord["Connection"]
-                    if not hasattr(serviceWithExistingActivity, "SynchronizedActivities") or activity.UID not in serviceWithExistingActivity.SynchronizedActivities:
-                        updateServicesWithExistingActivity = True
-                        break
-                if updateServicesWithExistingActivity:
-                    db.connections.update({"_id": {"$in": [x["Connection"]._id for x in activity.UploadedTo]}},
-                                          {"$addToSet": {"SynchronizedActivities": activity.UID}},
-                                          multi=True)
-
-                # We don't always know if the activity is private before it's downloaded, but we can check anyways since it saves a lot of time.
-                if activity.Private:
-                    logger.info("\t %s is private and restricted from sync (pre-download)" % activity.UID)  # Sync exclusion instead?
-                    del activity
-                    continue
+                        # recipientServices are services that don't already have this activity
+                        recipientServices = Sync._determineRecipientServices(activity, serviceConnections)
+                        if len(recipientServices) == 0:
+                            totalActivities -= 1  # doesn't count
+                            del activity
+                            continue
 
-                # recipientServices are services that don't already have this activity
-                recipientServices = Sync._determineRecipientServices(activity, serviceConnections)
-                if len(recipientServices) == 0:
-                    totalActivities -= 1  # doesn't count
-                    del activity
-                    continue
+                        # eligibleServices are services that are permitted to receive this activity - taking into account flow exceptions, excluded services, unfufilled configuration requirements, etc.
+                        eligibleServices = Sync._determineEligibleRecipientServices(activity=activity, recipientServices=recipientServices, excludedServices=excludedServices, user=user)
 
-                # eligibleServices are services that are permitted to receive this activity - taking into account flow exceptions, excluded services, unfufilled configuration requirements, etc.
-                eligibleServices = Sync._determineEligibleRecipientServices(activity=activity, recipientServices=recipientServices, excludedServices=excludedServices, user=user)
+                        if not len(eligibleServices):
+                            logger.info("\t %s has no eligible destinations" % activity.UID)
+                            totalActivities -= 1  # Again, doesn't really count.
+                            del activity
+                            continue
 
-                if not len(eligibleServices):
-                    logger.info("\t %s has no eligible destinations" % activity.UID)
-                    totalActivities -= 1  # Again, doesn't really count.
-                    del activity
-                    continue
+                        pendingDownloads.append((activity, recipientServices, eligibleServices, downloadPool.submit(Sync._downloadActivity, activity, list(excludedServices), tempSyncExclusions, user["_id"])))
 
-                if heartbeat_callback:
-                    heartbeat_callback(SyncStep.Download)
+                    if not pendingDownloads:
+                        continue
 
+                    activity, recipientServices, eligibleServices, downloadResult = pendingDownloads.popleft()
 
+                    Sync._heartbeat(lease, heartbeat_callback, SyncStep.Download)
 
-                if totalActivities <= 0:
-                    syncProgress = 1
-                else:
-                    syncProgress = max(0, min(1, processedActivities / totalActivities))
-                # This is after the above exit point since it's the most frequent case - want to avoid DB churn
-                db.users.update({"_id": user["_id"]}, {"$set": {"SynchronizationProgress": syncProgress}})
-
-                # The second most important line of logging in the application...
-                logger.info("\tActivity " + str(activity.UID) + " to " + str([x.Service.ID for x in recipientServices]))
-
-                # Download the full activity record
-                act = None
-                for dlSvcUploadRec in activity.UploadedTo:
-                    dlSvcRecord = dlSvcUploadRec["Connection"]  # I guess in the future we could smartly choose which for >1
-                    dlSvc = dlSvcRecord.Service
-                    logger.info("\t from " + dlSvc.ID)
-                    if activity.UID in tempSyncExclusions[dlSvcRecord._id]:
-                        logger.info("\t\t has activity exclusion logged")
-                        continue
-                    if dlSvcRecord in excludedServices:
-                        logger.info("\t\t service became excluded after listing") # Because otherwise we'd never have been trying to download from it in the first place.
-                        continue
+                    if totalActivities <= 0:
+                        syncProgress = 1
+                    else:
+                        syncProgress = max(0, min(1, processedActivities / totalActivities))
+                    # This is after the above exit point since it's the most frequent case - want to avoid DB churn
+                    bookkeeping.RecordProgress(syncProgress)
 
-                    workingCopy = copy.copy(activity)  # we can hope
-                    try:
-                        workingCopy = dlSvc.DownloadActivity(dlSvcRecord, workingCopy)
-                    except (ServiceException, ServiceWarning) as e:
-                        tempSyncErrors[conn._id].append(_packServiceException(SyncStep.Download, e))
-                        if e.Block and e.Scope == ServiceExceptionScope.Service: # I can't imagine why the same would happen at the account level, so there's no behaviour to immediately abort the sync in that case.
-                            excludedServices.append(dlSvcRecord)
-                        if not issubclass(e.__class__, ServiceWarning):
-                            continue
-                    except APIExcludeActivity as e:
-                        logger.info("\t\t excluded by service")
-                        e.Activity = workingCopy
-                        Sync._accumulateExclusions(dlSvcRecord, e, tempSyncExclusions)
-                        continue
-                    except Exception as e:
-                        tempSyncErrors[dlSvcRecord._id].append({"Step": SyncStep.Download, "Message": _formatExc()})
-                        continue
-                    if workingCopy.Private and not dlSvcRecord.GetConfiguration()["sync_private"]:
-                        logger.info("\t\t is private and restricted from sync")  # Sync exclusion instead?
-                        continue
-                    try:
-                        workingCopy.CheckSanity()
-                    except:
-                        logger.info("\t\t failed sanity check")
-                        Sync._accumulateExclusions(dlSvcRecord, APIExcludeActivity("Sanity check failed " + _formatExc(), activity=workingCopy), tempSyncExclusions)
+                    # The second most important line of logging in the application...
+                    logger.info("\tActivity " + str(activity.UID) + " to " + str([x.Service.ID for x in recipientServices]))
+
+                    # Download the full activity record
+                    act, dlSvc, outcome = downloadResult.result()
+                    Sync._applyOutcome(outcome, tempSyncErrors, tempSyncExclusions, excludedServices)
+
+                    if act is None:  # couldn't download it from anywhere, or the places that had it said it was broken
+                        processedActivities += 1  # we tried
+                        del act
+                        del activity
                         continue
-                    else:
-                        act = workingCopy
-                        break  # succesfully got the activity + passed sanity checks, can stop now
 
-                if act is None:  # couldn't download it from anywhere, or the places that had it said it was broken
-                    processedActivities += 1  # we tried
+                    # Log metadata
+                    startLoc = act.GetFirstWaypointWithLocation()
+                    bookkeeping.RecordLocationType(startLoc, act.StartTime, act.Type)
+
+                    # Something may have been excluded since the eligibility check - it happened before the download was queued.
+                    eligibleServices = [x for x in eligibleServices if x not in excludedServices]
+
+                    Sync._heartbeat(lease, heartbeat_callback, SyncStep.Upload)
+                    uploadResults = [(destinationSvcRecord, uploadPool.submit(Sync._uploadActivity, destinationSvcRecord, Sync._uploadCopy(act), user["_id"])) for destinationSvcRecord in eligibleServices]
+                    anyUploaded = False
+                    for destinationSvcRecord, uploadResult in uploadResults:
+                        destSvc = destinationSvcRecord.Service
+                        uploaded, outcome = uploadResult.result()
+                        Sync._applyOutcome(outcome, tempSyncErrors, tempSyncExclusions, excludedServices)
+                        if not uploaded:
+                            continue
+                        anyUploaded = True
+                        # flag as successful - only now that the upload has gone through
+                        bookkeeping.RecordSynchronizedActivity([destinationSvcRecord._id], activity.UID)
+                        bookkeeping.RecordSyncStats(activity.UID, destSvc.ID, dlSvc.ID, activity.Distance)
                     del act
                     del activity
-                    continue
 
-                # Log metadata
-                startLoc = act.GetFirstWaypointWithLocation()
-                db.act_metadata_loctype.update({"Latitude": startLoc.Latitude, "Longitude": startLoc.Longitude}, {"Latitude": startLoc.Latitude, "Longitude": startLoc.Longitude, "StartTime": act.StartTime, "Type": act.Type}, upsert=True)
-
-                for destinationSvcRecord in eligibleServices:
-                    if heartbeat_callback:
-                        heartbeat_callback(SyncStep.Upload)
-                    destSvc = destinationSvcRecord.Service
-                    try:
-                        logger.info("\t\tUploading to " + destSvc.ID)
-                        destSvc.UploadActivity(destinationSvcRecord, act)
-                    except (ServiceException, ServiceWarning) as e:
-                        tempSyncErrors[destinationSvcRecord._id].append(_packServiceException(SyncStep.Upload, e))
-                        if e.Block and e.Scope == ServiceExceptionScope.Service: # Similarly, no behaviour to immediately abort the sync if an account-level exception is raised
-                            excludedServices.append(destinationSvcRecord)
-                        if not issubclass(e.__class__, ServiceWarning):
-                            continue
-                    except Exception as e:
-                        tempSyncErrors[destinationSvcRecord._id].append({"Step": SyncStep.Upload, "Message": _formatExc()})
-                        continue
-                    # flag as successful
-                    db.connections.update({"_id": destinationSvcRecord._id},
-                                          {"$addToSet": {"SynchronizedActivities": activity.UID}})
+                    processedActivities += 1
+                    if anyUploaded:
+                        uploadedActivities += 1
 
-                    db.sync_stats.update({"ActivityID": activity.UID}, {"$addToSet": {"DestinationServices": destSvc.ID, "SourceServices": dlSvc.ID}, "$set": {"Distance": activity.Distance, "Timestamp": datetime.utcnow()}}, upsert=True)
-                del act
-                del activity
-
-                processedActivities += 1
+            bookkeeping.Flush()
+            for conn in serviceConnections:
+                conn.CompactSynchronizedActivities()
 
             nonblockingSyncErrorsCount = 0
             blockingSyncErrorsCount = 0
             syncExclusionCount = 0
+            # Running into a rate limit isn't worth an exhaustive sync - instead, the cursors stay where they were, so the next regular sync covers this one's ground again.
+            # (Unless this was the exhaustive sync, in which case the next one has to be too.)
+            deferred = len([x for conn in serviceConnections for x in tempSyncErrors[conn._id] if x.get("Deferred")]) > 0
             for conn in serviceConnections:
-                db.connections.update({"_id": conn._id}, {"$set": {"SyncErrors": tempSyncErrors[conn._id], "ExcludedActivities": tempSyncExclusions[conn._id]}})
-                nonblockingSyncErrorsCount += len([x for x in tempSyncErrors[conn._id] if "Block" not in x or not x["Block"]])
+                connUpdate = {"SyncErrors": tempSyncErrors[conn._id], "ExcludedActivities": tempSyncExclusions[conn._id]}
+                if deferred:
+                    if exhaustive:
+                        connUpdate["ListingCursor"] = None
+                elif conn in listedConnections:
+                    connUpdate["ListingCursor"] = listingStart  # any errors will make the next sync exhaustive anyways
+                db.connections.update({"_id": conn._id}, {"$set": connUpdate})
+                nonblockingSyncErrorsCount += len([x for x in tempSyncErrors[conn._id] if ("Block" not in x or not x["Block"]) and not x.get("Deferred")])
                 blockingSyncErrorsCount += len([x for x in tempSyncErrors[conn._id] if "Block" in x and x["Block"]])
                 syncExclusionCount += len(tempSyncExclusions[conn._id].items())
 
             # clear non-persisted extended auth details
             cachedb.extendedAuthDetails.remove({"ID": {"$in": connectedServiceIds}})
             # unlock the row
-            update_values = {"$unset": {"SynchronizationWorker": None, "SynchronizationHost": None, "SynchronizationProgress": None}, "$set": {"NonblockingSyncErrorCount": nonblockingSyncErrorsCount, "BlockingSyncErrorCount": blockingSyncErrorsCount, "SyncExclusionCount": syncExclusionCount}}
+            update_values = {"$unset": {"SynchronizationWorker": None, "SynchronizationHost": None, "SynchronizationProgress": None, "SynchronizationLeaseExpiry": None}, "$set": {"NonblockingSyncErrorCount": nonblockingSyncErrorsCount, "BlockingSyncErrorCount": blockingSyncErrorsCount, "SyncExclusionCount": syncExclusionCount, "LateActivityCount": lateActivityCount}}
             if null_next_sync_on_unlock:
                 # Sometimes another worker would pick this record in the timespan between this update and the one in PerformGlobalSync that sets the true next sync time.
                 # Hence, an option to unset the NextSynchronization in the same operation that releases the lock on the row.
                 update_values["$unset"]["NextSynchronization"] = None
             db.users.update({"_id": user["_id"], "SynchronizationWorker": os.getpid(), "SynchronizationHost": socket.gethostname()}, update_values)
+        except SynchronizationConcurrencyException:
+            logger.warning("Lost the lease on " + str(user["_id"]) + " to another worker, abandoning sync")
+            raise  # they'll finish it - and release it
         except:
             # oops.
             logger.exception("Core sync exception")
         else:
             logger.info("Finished sync for " + str(user["_id"]))
         finally:
+            try:
+                bookkeeping.Flush()  # Whatever did get done before an exception should still be recorded
+            except:
+                logger.exception("Could not flush sync bookkeeping")
             _global_logger.removeHandler(logging_file_handler)
             logging_file_handler.close()
+            _syncContext.UserID = None
+        return uploadedActivities
 
 class SynchronizationConcurrencyException(Exception):
     pass
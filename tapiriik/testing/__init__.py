@@ -1,3 +1,10 @@
 from .sync import *
 from .interchange import *
 from .gpx import *
+from .tcx import *
+from .tz import *
+from .ratelimit import *
+from .render_cache import *
+from .download_cache import *
+from .streams import *
+from .dropbox import *
@@ -0,0 +1,126 @@
+from tapiriik.testing.testtools import TapiriikTestCase
+from tapiriik.database import cachedb
+from tapiriik.services.download_cache import ActivityDownloadCache
+from tapiriik.services.service_base import ServiceBase
+from tapiriik.services.api import APIException, APIExcludeActivity
+from tapiriik.services.interchange import Activity
+from tapiriik.services import Endomondo, Strava
+from datetime import datetime, timedelta
+import os
+
+
+class DownloadCacheTests(TapiriikTestCase):
+    def setUp(self):
+        cachedb.download_cache.remove({})
+
+    def test_revisions(self):
+        ''' ensures that cached payloads are only handed out for the same account and revision '''
+        cache = ActivityDownloadCache()
+        cache.Store("svc", "owner", 1, b"payload", revision="a")
+        self.assertEqual(cache.Get("svc", "owner", 1, revision="a"), b"payload")
+        self.assertEqual(cache.Get("svc", "other", 1, revision="a"), None)
+        self.assertEqual(cache.Get("svc", "owner", 1, revision="b"), None)
+
+        cache.Store("svc", "owner", 1, b"newer", revision="b")
+        self.assertEqual(cache.Get("svc", "owner", 1, revision="a"), None)
+        self.assertEqual(cache.Get("svc", "owner", 1, revision="b"), b"newer")
+        self.assertEqual(cachedb.download_cache.find().count(), 1)
+        self.assertEqual(cache.Stats(), {"Hits": 2, "Misses": 3})
+
+        cache.Remove("svc", "owner")
+        self.assertEqual(cache.Get("svc", "owner", 1, revision="b"), None)
+
+    def test_eviction(self):
+        ''' ensures that expired entries are dropped, then the least recently used, until the rest fit '''
+        cache = ActivityDownloadCache(size=1000, ttl=3600)
+        cache.EvictionInterval = 1000
+        payload = os.urandom(600)  # doesn't compress
+        for x in range(4):
+            cache.Store("svc", "owner", x, payload)
+        cachedb.download_cache.update({"ActivityID": "0"}, {"$set": {"Stored": datetime.utcnow() - timedelta(hours=2)}})
+        self.assertEqual(cache.Get("svc", "owner", 0), None)
+        cache.Get("svc", "owner", 1)
+
+        cache.Evict()
+        self.assertEqual(cachedb.download_cache.find().count(), 1)
+        self.assertEqual(cache.Get("svc", "owner", 1), payload)
+
+    def test_ttl_from_store(self):
+        ''' ensures that entries expire a TTL after they were stored, however often they're used '''
+        cache = ActivityDownloadCache(ttl=3600)
+        cache.Store("svc", "owner", 1, b"payload")
+        cachedb.download_cache.update({"ActivityID": "1"}, {"$set": {"Stored": datetime.utcnow() - timedelta(minutes=59)}})
+        self.assertEqual(cache.Get("svc", "owner", 1), b"payload")
+        cachedb.download_cache.update({"ActivityID": "1"}, {"$set": {"Stored": datetime.utcnow() - timedelta(minutes=61)}})
+        self.assertEqual(cache.Get("svc", "owner", 1), None)
+
+    def test_cached_download(self):
+        ''' ensures that only payloads that parse are cached, and that ones that stop parsing are discarded '''
+        class CachingService(ServiceBase):
+            ID = "svc"
+        class Record:
+            ExternalID = "owner"
+        svc = CachingService()
+        downloads = []
+
+        def download():
+            downloads.append(1)
+            return b"live"
+
+        def parse(payload):
+            if payload == b"live":
+                raise APIExcludeActivity("Not complete", permanent=False)
+            return payload.decode("utf-8")
+
+        for attempt in range(2):
+            self.assertRaises(APIExcludeActivity, svc.CachedDownload, Record(), 1, download, parse)
+        self.assertEqual(len(downloads), 2)
+        self.assertEqual(cachedb.download_cache.find().count(), 0)
+
+        self.assertEqual(svc.CachedDownload(Record(), 1, lambda: b"done", parse), "done")
+        self.assertEqual(svc.CachedDownload(Record(), 1, download, parse), "done")
+        self.assertEqual(len(downloads), 2)
+
+        self.assertRaises(APIExcludeActivity, svc.CachedDownload, Record(), 1, download, lambda payload: parse(b"live"))
+        self.assertEqual(cachedb.download_cache.find().count(), 0)
+
+    def test_error_payloads(self):
+        ''' ensures that errors and partial tracks that come back as a 200 aren't cached '''
+        class Response:
+            status_code = 200
+            def __init__(self, text):
+                self.text = text
+                self.content = text.encode("utf-8")
+        class Session:
+            def __init__(self, text):
+                self.Text = text
+            def get(self, url, **kwargs):
+                return Response(self.Text)
+        class Record:
+            ExternalID = "owner"
+            Authorization = {"AuthToken": "token", "OAuthToken": "token"}
+        record = Record()
+        track = "OK\n1;2013-06-01 10:00:00 UTC;W;Name;Run;0;2013-06-01 10:00:00 UTC;60.00;1.0;50;;;;;\n2013-06-01 10:00:00 UTC;2;45.0;-75.0;;;100;120\n"
+
+        for text, error in [("ERROR", APIException), (track[:-10], APIExcludeActivity), (track.split("\n2013")[0], APIExcludeActivity)]:
+            Endomondo._httpSession = Session(text)
+            try:
+                self.assertRaises(error, Endomondo._downloadRawTrackRecord, record, 1)
+            finally:
+                del Endomondo._httpSession
+        self.assertEqual(cachedb.download_cache.find().count(), 0)
+        Endomondo._httpSession = Session(track)
+        try:
+            self.assertEqual(Endomondo._downloadRawTrackRecord(record, 1), track)
+        finally:
+            del Endomondo._httpSession
+        self.assertEqual(cachedb.download_cache.find().count(), 1)
+
+        act = Activity(startTime=datetime(2013, 6, 1))
+        act.UploadedTo = [{"Connection": record, "ActivityID": 1}]
+        Strava._httpSession = Session('{"message": "Record Not Found", "errors": []}')
+        try:
+            self.assertRaises(APIException, Strava.DownloadActivity, record, act)
+        finally:
+            del Strava._httpSession
+        self.assertEqual(cachedb.download_cache.find({"Service": Strava.ID}).count(), 0)
@@ -0,0 +1,116 @@
+from tapiriik.testing.testtools import TapiriikTestCase
+from tapiriik.database import cachedb
+from tapiriik.services import Dropbox
+from tapiriik.services.Dropbox.dropbox import _DropboxStructure
+from tapiriik.services.download_cache import DownloadCache
+from tapiriik.services.service_record import ServiceRecord
+from dropbox import rest
+from datetime import datetime, timedelta
+import tapiriik.database.tz
+import pytz
+import io
+
+
+class MockDropboxClient:
+    """ Serves metadata() from a {folder path: [file/folder paths]} dict, counting the calls - every folder is unchanged if asked with a hash """
+    def __init__(self, tree, unchanged=False):
+        self.Tree = tree
+        self.Unchanged = unchanged
+        self.MetadataCalls = []
+        self.Deltas = []
+        self.Files = {}
+
+    def metadata(self, path, hash=None):
+        self.MetadataCalls.append(path)
+        if hash and self.Unchanged:
+            raise rest.ErrorResponse(304)
+        if path not in self.Tree:
+            raise rest.ErrorResponse(404)
+        return {"path": path, "hash": "h", "contents": [{"path": x, "is_dir": x in self.Tree, "rev": "1"} for x in self.Tree[path]]}
+
+    def delta(self, cursor, path_prefix=None):
+        return self.Deltas.pop(0)
+
+    def get_file(self, path, rev=None):
+        return io.BytesIO(self.Files[path])
+
+
+class DropboxTests(TapiriikTestCase):
+    def setUp(self):
+        self.tree = {"/": ["/a", "/b", "/root.gpx"], "/a": ["/a/deep", "/a/run.tcx", "/a/notes.txt"], "/a/deep": ["/a/deep/ride.gpx"], "/b": []}
+
+    def test_crawl(self):
+        ''' ensures that the crawl visits each folder once, and keeps the structure in step with what's there '''
+        dbcl = MockDropboxClient(self.tree)
+        structure = _DropboxStructure([])
+        Dropbox._folderRecurse(structure, dbcl, "/")
+        self.assertEqual(sorted(dbcl.MetadataCalls), sorted(self.tree.keys()))
+        self.assertEqual([x["Path"] for x in structure.Files("/A")], ["/a/run.tcx"])
+
+        dbcl = MockDropboxClient(self.tree, unchanged=True)
+        structure = _DropboxStructure(structure.Records())
+        Dropbox._folderRecurse(structure, dbcl, "/")
+        self.assertEqual(sorted(dbcl.MetadataCalls), sorted(self.tree.keys()))  # once each, not once per ancestor
+
+        del self.tree["/a/deep"]
+        self.tree["/a"] = ["/a/run.tcx"]
+        dbcl = MockDropboxClient(self.tree)
+        Dropbox._folderRecurse(structure, dbcl, "/")
+        self.assertEqual(sorted(x["Path"] for x in structure.Records()), ["/", "/a", "/b"])
+
+    def test_delta(self):
+        ''' ensures that delta listings bring the structure up to date, starting over when told to '''
+        dbcl = MockDropboxClient({})
+        dbcl.Deltas = [{"reset": True, "cursor": "c1", "has_more": True, "entries": [["/a", {"path": "/A", "is_dir": True}], ["/a/run.gpx", {"path": "/A/run.gpx", "is_dir": False, "rev": "1"}]]},
+                       {"reset": False, "cursor": "c2", "has_more": False, "entries": [["/a/b/ride.tcx", {"path": "/A/b/ride.tcx", "is_dir": False, "rev": "1"}], ["/a/notes.txt", {"path": "/A/notes.txt", "is_dir": False, "rev": "1"}]]}]
+        cache = {"Structure": [{"Path": "/stale", "Files": []}], "DeltaCursor": "c0"}
+        Dropbox._listDelta(cache, dbcl, "/", False)
+        self.assertEqual(cache["DeltaCursor"], "c2")
+        structure = _DropboxStructure(cache["Structure"])
+        self.assertEqual(sorted(x["Path"] for x in structure.Records()), ["/A", "/A/b"])
+        self.assertEqual([x["Path"] for x in structure.GetFolder("/a")["Files"]], ["/A/run.gpx"])
+
+        dbcl.Deltas = [{"reset": False, "cursor": "c3", "has_more": False, "entries": [["/a/run.gpx", None], ["/a/b", None], ["/a/run.tcx", {"path": "/A/run.tcx", "is_dir": False, "rev": "2"}]]}]
+        Dropbox._listDelta(cache, dbcl, "/", False)
+        structure = _DropboxStructure(cache["Structure"])
+        self.assertEqual([x["Path"] for x in structure.Records()], ["/A"])
+        self.assertEqual(structure.GetFolder("/a")["Files"], [{"Path": "/A/run.tcx", "Rev": "2"}])
+
+    def test_files(self):
+        ''' ensures that a folder's files are replaced and removed by path, whatever the case, and come out in the records '''
+        structure = _DropboxStructure([{"Path": "/a", "Files": [{"Path": "/a/1.gpx", "Rev": "1"}, {"Path": "/a/2.gpx", "Rev": "1"}]}])
+        structure.PutFile({"Path": "/A/1.GPX", "Rev": "2"})
+        structure.RemovePath("/a/2.Gpx")
+        structure.PutFile({"Path": "/b/3.gpx", "Rev": "1"})
+        self.assertEqual(structure.Files("/a"), [{"Path": "/A/1.GPX", "Rev": "2"}])
+        self.assertEqual(dict((x["Path"], x["Files"]) for x in structure.Records()), {"/a": [{"Path": "/A/1.GPX", "Rev": "2"}], "/b": [{"Path": "/b/3.gpx", "Rev": "1"}]})
+
+    def test_list_new_file(self):
+        ''' ensures that a new GPX file is listed from just its first trackpoint, with its start time in the local TZ '''
+        dbcl = MockDropboxClient({})
+        dbcl.Files["/run.gpx"] = b"""<?xml version="1.0" encoding="UTF-8"?>
+<gpx xmlns="http://www.topografix.com/GPX/1/1" creator="test">
+  <trk><trkseg>
+    <trkpt lat="45.0" lon="-75.0"><time>2013-06-01T10:00:00Z</time></trkpt>
+    <trkpt lat="45.001" lon="-75.0"><time>2013-06-01T10:00:10Z</time></trkpt>
+  </trkseg></trk>
+</gpx>"""
+        dbcl.Deltas = [{"reset": True, "cursor": "c1", "has_more": False, "entries": [["/run.gpx", {"path": "/run.gpx", "is_dir": False, "rev": "1"}]]}]
+        record = ServiceRecord({"Service": "dropbox", "_id": "dropboxtest", "ExternalID": "dropboxtest", "Authorization": {"Full": False}})
+        cachedb.dropbox_cache.remove({"ExternalID": record.ExternalID})
+        DownloadCache.Remove(Dropbox.ID, record.ExternalID)
+
+        realLookup = tapiriik.database.tz.TZLookup
+        tapiriik.database.tz.TZLookup = lambda lat, lng: "America/Toronto"
+        Dropbox._getClient = lambda svcRec: dbcl
+        try:
+            activities, exclusions = Dropbox.DownloadActivityList(record)
+        finally:
+            del Dropbox._getClient
+            tapiriik.database.tz.TZLookup = realLookup
+
+        self.assertEqual(exclusions, [])
+        self.assertEqual(len(activities), 1)
+        self.assertEqual(activities[0].StartTime, datetime(2013, 6, 1, 10, 0, 0, tzinfo=pytz.utc))
+        self.assertEqual(activities[0].StartTime.utcoffset(), timedelta(hours=-4))
+        self.assertEqual(activities[0].EndTime, None)
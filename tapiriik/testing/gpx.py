@@ -1,5 +1,7 @@
 from tapiriik.testing.testtools import TestTools, TapiriikTestCase
 from tapiriik.services.gpx import GPXIO
+from datetime import datetime
+import pytz
 
 
 class GPXTests(TapiriikTestCase):
@@ -19,3 +21,38 @@ class GPXTests(TapiriikTestCase):
         act.Distance = act2.Distance = None  # same here
 
         self.assertActivitiesEqual(act2, act)
+
+    def test_minimum_waypoints(self):
+        ''' ensures that a partial parse agrees with the full one on the activity's identity '''
+
+        svcA, other = TestTools.create_mock_services()
+        act = TestTools.create_random_activity(svcA, tz=True)
+
+        mid = GPXIO.Dump(act)
+
+        full = GPXIO.Parse(mid)
+        partial = GPXIO.Parse(mid, minimumWaypoints=True)
+
+        self.assertEqual(len(partial.Waypoints), 1)
+        self.assertEqual(partial.Waypoints[0], full.Waypoints[0])
+        self.assertEqual(partial.StartTime, full.StartTime)
+        self.assertEqual(partial.UID, full.UID)
+        self.assertEqual(partial.EndTime, None)
+
+    def test_naive_timestamps_utc(self):
+        ''' ensures that trackpoint times without an offset are read as UTC '''
+
+        gpx = b"""<?xml version="1.0" encoding="UTF-8"?>
+<gpx xmlns="http://www.topografix.com/GPX/1/1" creator="test">
+  <trk><trkseg>
+    <trkpt lat="45.0" lon="-75.0"><time>2013-06-01T10:00:00</time></trkpt>
+    <trkpt lat="45.001" lon="-75.0"><time>2013-06-01T10:00:10.5</time></trkpt>
+    <trkpt lat="45.002" lon="-75.0"><time>2013-06-01T12:00:20+02:00</time></trkpt>
+  </trkseg></trk>
+</gpx>"""
+
+        act = GPXIO.Parse(gpx)
+
+        self.assertEqual(act.StartTime, datetime(2013, 6, 1, 10, 0, 0, tzinfo=pytz.utc))
+        self.assertEqual(act.Waypoints[1].Timestamp, datetime(2013, 6, 1, 10, 0, 10, 500000, tzinfo=pytz.utc))
+        self.assertEqual(act.EndTime, datetime(2013, 6, 1, 10, 0, 20, tzinfo=pytz.utc))
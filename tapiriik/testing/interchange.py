@@ -4,11 +4,12 @@ from tapiriik.testing.testtools import TestTools, TapiriikTestCase
 
 from tapiriik.sync import Sync
 from tapiriik.services import Service
-from tapiriik.services.interchange import Activity, ActivityType, Waypoint, WaypointType
+from tapiriik.services.interchange import Activity, ActivityType, Waypoint, WaypointType, Location
 from tapiriik.sync import Sync
 
 from datetime import datetime, timedelta
 import random
+import copy
 
 
 class InterchangeTests(TapiriikTestCase):
@@ -48,6 +49,32 @@ class InterchangeTests(TapiriikTestCase):
         eSvc._populateActivityFromTrackData(act, record)
         self.assertEqual(oldWaypoints, act.Waypoints)
 
+    def test_compact_waypoints(self):
+        ''' ensures that swapping in array-backed waypoints doesn't change anything about the activity '''
+        svcA, svcB = TestTools.create_mock_services()
+        svcA.SupportsHR = svcA.SupportsCadence = svcA.SupportsTemp = svcA.SupportsPower = svcA.SupportsCalories = True
+        act = TestTools.create_random_activity(svcA, tz=True)
+        act.Waypoints[1].HR = 150
+        act.Waypoints[2].Location = None
+        original = copy.deepcopy(act)
+
+        act.CompactWaypoints()
+
+        self.assertActivitiesEqual(act, original)
+        self.assertEqual(act.Waypoints[1].HR, 150)
+        self.assertTrue(type(act.Waypoints[1].HR) is int)
+        self.assertEqual(act.Waypoints[2].Location, None)
+        self.assertEqual(act.GetDistance(), original.GetDistance())
+        self.assertEqual(act.Waypoints.index(act.Waypoints[3]), 3)
+
+        # Changes to the waypoints should stick
+        act.Waypoints[3].Location.Altitude = None
+        act.Waypoints[3].Timestamp = act.Waypoints[3].Timestamp.replace(tzinfo=None)
+        act.Waypoints.append(Waypoint(timestamp=act.EndTime, ptType=WaypointType.End))
+        self.assertEqual(act.Waypoints[3].Location.Altitude, None)
+        self.assertEqual(act.Waypoints[3].Timestamp.tzinfo, None)
+        self.assertEqual(act.Waypoints[-1], Waypoint(timestamp=act.EndTime, ptType=WaypointType.End))
+
     def test_duration_calculation(self):
         ''' ensures that true-duration calculation is being reasonable '''
         act = TestTools.create_blank_activity()
@@ -123,6 +150,41 @@ class InterchangeTests(TapiriikTestCase):
                          Waypoint(timestamp=act.StartTime + timedelta(seconds=30))]
         self.assertEqual(act.GetDuration(), timedelta(seconds=26))
 
+    def test_cumulative_stats(self):
+        ''' ensures that the precomputed per-range stats come out as walking the waypoints of each range did '''
+        act = TestTools.create_blank_activity()
+        act.EndTime = act.StartTime + timedelta(seconds=210)
+        act.Waypoints = [Waypoint(timestamp=act.StartTime, location=Location(45, -75, 100)),
+                         Waypoint(timestamp=act.StartTime + timedelta(seconds=5), location=Location(45.001, -75, None)),
+                         Waypoint(timestamp=act.StartTime + timedelta(seconds=10), location=Location(45.002, -75.001, 102), ptType=WaypointType.Lap),
+                         Waypoint(timestamp=act.StartTime + timedelta(seconds=15), ptType=WaypointType.Pause),
+                         Waypoint(timestamp=act.StartTime + timedelta(seconds=20), location=Location(45.003, -75.001, 104), ptType=WaypointType.Resume),
+                         Waypoint(timestamp=act.StartTime + timedelta(seconds=25)),
+                         Waypoint(timestamp=act.StartTime + timedelta(seconds=30), location=Location(45.004, -75.002, None)),
+                         Waypoint(timestamp=act.StartTime + timedelta(seconds=40), location=Location(45.005, -75.002, 101)),
+                         Waypoint(timestamp=act.StartTime + timedelta(seconds=200), location=Location(45.006, -75.003, 99)),
+                         Waypoint(timestamp=act.StartTime + timedelta(seconds=210), location=Location(45.007, -75.003, 98), ptType=WaypointType.End)]
+        # From each waypoint, the distance (m) and duration (s) to it and every one after it
+        expected = [([0, 111.1318, 247.406, 247.406, 247.406, 247.406, 383.664, 494.8364, 494.8364, 494.8364], [0, 5, 10, 15, 15, 20, 25, 35, 35, 45]),
+                    ([0, 136.2596, 136.2596, 136.2596, 136.2596, 272.5176, 383.6899, 383.6899, 383.6899], [0, 5, 10, 10, 15, 20, 30, 30, 40]),  # no altitude to start from
+                    ([0, 0, 0, 0, 136.258, 247.4304, 247.4304, 247.4304], [0, 5, 5, 10, 15, 25, 25, 35]),
+                    ([0, 0, 0, 136.258, 247.4304, 247.4304, 247.4304], [0, 0, 5, 10, 20, 20, 30]),  # starting paused
+                    ([0, 0, 136.258, 247.4304, 247.4304, 247.4304], [0, 5, 10, 20, 20, 30]),
+                    ([0, 0, 111.1318, 111.1318, 111.1318], [0, 5, 15, 15, 25]),
+                    ([0, 111.1318, 111.1318, 111.1318], [0, 10, 10, 20]),  # ...unlike from the resume, where there was one to hold
+                    ([0, 0, 0], [0, 0, 10]),  # implicit pause
+                    ([0, 111.1364], [0, 10]),
+                    ([0], [0])]
+        stats = act.GetCumulativeStats()
+        for start, (distances, durations) in enumerate(expected):
+            for end, (distance, duration) in enumerate(zip(distances, durations), start):
+                self.assertAlmostEqual(stats.GetDistance(start, end), distance, places=3)
+                self.assertEqual(stats.GetDuration(start, end), timedelta(seconds=duration))
+        self.assertAlmostEqual(stats.GetDistance(), 494.8364, places=3)
+        self.assertEqual(stats.GetDuration(), timedelta(seconds=45))
+        self.assertAlmostEqual(act.GetDistance(act.Waypoints[4], act.Waypoints[7]), 247.4304, places=3)
+        self.assertEqual(act.GetDuration(act.Waypoints[4], act.Waypoints[7]), timedelta(seconds=20))
+
     def test_activity_specificity_resolution(self):
         # Mountain biking is more specific than just cycling
         self.assertEqual(ActivityType.PickMostSpecific([ActivityType.Cycling, ActivityType.MountainBiking]), ActivityType.MountainBiking)
@@ -0,0 +1,49 @@
+from tapiriik.testing.testtools import TapiriikTestCase
+from tapiriik.database import cachedb
+from tapiriik.services.api import APIDeferral
+from tapiriik.services.ratelimit import RateLimit, RateLimiter, MemoryRateLimitStore, MongoRateLimitStore
+from datetime import timedelta
+
+
+class RateLimitTests(TapiriikTestCase):
+    def setUp(self):
+        self.limits = [RateLimit(100, timedelta(seconds=90), burst=10), RateLimit(1000, timedelta(days=1), burst=500)]  # 1 request/s, then a bit over 0.005/s
+
+    def _exercise_store(self, store):
+        for x in range(10):
+            self.assertEqual(store.Consume("svc", self.limits, 1000), 0)
+        self.assertAlmostEqual(store.Consume("svc", self.limits, 1000), 1)  # the burst is spent
+        self.assertEqual(store.Consume("other", self.limits, 1000), 0)  # ...but only for that key
+        self.assertEqual(store.Consume("svc", self.limits, 1001), 0)
+
+        store.Drain("svc", self.limits, 2000)
+        self.assertAlmostEqual(store.Consume("svc", self.limits, 2000), 86400 / 500)  # the daily bucket's empty too now
+
+    def test_memory_store(self):
+        self._exercise_store(MemoryRateLimitStore())
+
+    def test_mongo_store(self):
+        cachedb.rate_limits.remove({"_id": {"$in": ["svc", "other"]}})
+        self._exercise_store(MongoRateLimitStore())
+
+    def test_window_limit(self):
+        ''' ensures that no window of the limit's period ever sees more than its requests, even starting from a full bucket '''
+        store = MemoryRateLimitStore()
+        limits = [self.limits[0]]
+        taken = [t for t in range(0, 1000) if store.Consume("svc", limits, t / 10) == 0]
+        for start in range(0, 1000 - 900):
+            self.assertLessEqual(len([t for t in taken if start <= t < start + 900]), 100)
+
+    def test_limiter_defers(self):
+        limiter = RateLimiter("svc", [RateLimit(2, timedelta(days=1), burst=1)], store=MemoryRateLimitStore())
+        limiter.Acquire()
+        self.assertRaises(APIDeferral, limiter.Acquire)
+        limiter.Acquire(account="someone")  # accounts have their own buckets
+
+    def test_limit_validation(self):
+        ''' ensures that limits the bucket could never refill under are refused '''
+        self.assertRaises(ValueError, RateLimit, 1, timedelta(seconds=1))
+        self.assertRaises(ValueError, RateLimit, 10, timedelta(seconds=1), burst=10)
+        self.assertRaises(ValueError, RateLimit, 10, timedelta(seconds=1), burst=0)
+        self.assertRaises(ValueError, RateLimit, 10, timedelta(0))
+        self.assertEqual(RateLimit(2, timedelta(seconds=1)).Burst, 1)
@@ -0,0 +1,44 @@
+from tapiriik.testing.testtools import TestTools, TapiriikTestCase
+from tapiriik.services.render_cache import ActivityRenderCache
+from tapiriik.services.tcx import TCXIO
+import tempfile
+import shutil
+
+
+class RenderCacheTests(TapiriikTestCase):
+    def setUp(self):
+        svcA, other = TestTools.create_mock_services()
+        self.act = TestTools.create_random_activity(svcA, tz=True)
+
+    def test_render_once(self):
+        ''' ensures that an activity is only rendered again once it's changed '''
+        cache = ActivityRenderCache()
+        first = cache.Render(self.act, "tcx")
+        self.assertEqual(first, TCXIO.DumpBytes(self.act, prettyPrint=False))
+        self.assertEqual(cache.Render(self.act, "tcx"), first)
+        cache.Render(self.act, "gpx")
+        self.assertEqual((cache.Hits, cache.Misses), (1, 2))
+
+        self.act.Waypoints[1].HR = 200
+        self.assertNotEqual(cache.Render(self.act, "tcx"), first)
+        self.assertEqual(cache.Misses, 3)
+
+        self.act.PrerenderedFormats["tcx"] = b"original"
+        self.assertEqual(cache.Render(self.act, "tcx"), b"original")
+
+    def test_spill(self):
+        ''' ensures that renders evicted from memory are picked back up from disk, within its bounds '''
+        path = tempfile.mkdtemp()
+        try:
+            cache = ActivityRenderCache(size=1, path=path, diskSize=10 ** 7)
+            first = cache.Render(self.act, "tcx")
+            cache.Render(self.act, "gpx")
+            self.assertEqual(cache.Render(self.act, "tcx"), first)
+            self.assertEqual((cache.DiskHits, cache.Misses), (1, 2))
+
+            cache = ActivityRenderCache(size=1, path=path, diskSize=1)
+            cache.Render(self.act, "tcx")
+            cache.Render(self.act, "gpx")
+            self.assertEqual(cache.Stats()["DiskSize"], 0)
+        finally:
+            shutil.rmtree(path)
@@ -0,0 +1,58 @@
+from tapiriik.testing.testtools import TapiriikTestCase, TestTools
+from tapiriik.services.streams import StreamAligner, StreamPolicy
+from tapiriik.services.interchange import Activity
+from tapiriik.services import RunKeeper, SportTracks
+from datetime import datetime
+
+
+class StreamAlignmentTests(TapiriikTestCase):
+    def test_exact(self):
+        ''' ensures that only samples with the same timestamp are matched by default, the first of any duplicates winning '''
+        samples = [(3, "c"), (0, "a"), (1, "b"), (1, "dup")]
+        self.assertEqual(StreamAligner.Align([0, 1, 2, 3], samples), ["a", "b", None, "c"])
+        self.assertEqual(StreamAligner.Align([3, 0], samples), ["c", "a"])  # the primary stream needn't be in order either
+        self.assertEqual(StreamAligner.Align([0, 1], []), [None, None])
+
+    def test_tolerance(self):
+        ''' ensures that the nearest sample within the tolerance is matched, the earlier of two equally close '''
+        samples = [(0, "a"), (2, "b"), (10, "c")]
+        self.assertEqual(StreamAligner.Align([0.4, 1, 1.6, 5, 8.5], samples, tolerance=1), ["a", "a", "b", None, None])
+        self.assertEqual(StreamAligner.Align([7], samples, tolerance=5), ["c"])
+
+    def test_policies(self):
+        ''' ensures that each policy resamples the streams as it should, in one call '''
+        samples = {"hr": [(0, 100), (10, 200), (40, 150)], "cad": [(5, 80)]}
+        timestamps = [0, 4, 5, 6, 25, 50]
+        self.assertEqual(StreamAligner.AlignStreams(timestamps, samples, tolerance=None), {"hr": [100, 100, 100, 200, 200, 150], "cad": [80, 80, 80, 80, 80, 80]})
+        self.assertEqual(StreamAligner.AlignStreams(timestamps, samples, policy=StreamPolicy.Previous, tolerance=None), {"hr": [100, 100, 100, 100, 200, 150], "cad": [None, None, 80, 80, 80, 80]})
+        self.assertEqual(StreamAligner.AlignStreams(timestamps, samples, policy=StreamPolicy.Previous, tolerance=10), {"hr": [100, 100, 100, 100, None, 150], "cad": [None, None, 80, 80, None, None]})
+        self.assertEqual(StreamAligner.AlignStreams(timestamps, samples, policy=StreamPolicy.Linear, tolerance=None), {"hr": [100, 140, 150, 160, 175, None], "cad": [None, None, 80, None, None, None]})
+        self.assertEqual(StreamAligner.Align(timestamps, samples["hr"], policy=StreamPolicy.Linear, tolerance=10), [100, 140, 150, 160, None, None])
+
+    def test_interleaved(self):
+        self.assertEqual(StreamAligner.Interleaved([0, "a", 5, "b"]), [(0, "a"), (5, "b")])
+
+    def test_runkeeper_waypoints(self):
+        ''' ensures that RunKeeper's HR and calorie streams end up on the right waypoints '''
+        path = [{"timestamp": t, "latitude": 1, "longitude": 2, "altitude": 3, "type": "gps"} for t in range(0, 2000)]
+        rawData = {"path": path, "heart_rate": [{"timestamp": t, "heart_rate": 100 + t % 50} for t in range(0, 2000, 2)], "calories": [{"timestamp": 1999, "calories": 50}]}
+        act = Activity(startTime=datetime(2013, 1, 1))
+        RunKeeper._populateActivityWaypoints(rawData, act)
+        self.assertEqual([wp.HR for wp in act.Waypoints[:4]], [100, None, 102, None])
+        self.assertEqual(act.Waypoints[1999].Calories, 50)
+        self.assertEqual(len([wp for wp in act.Waypoints if wp.Calories is not None]), 1)
+
+    def test_sporttracks_waypoints(self):
+        ''' ensures that SportTracks' streams are matched to the nearest sample, however many samples there are between locations '''
+        # The walk this replaced only ever stepped one sample along per location, so it fell further behind a denser stream with each point - here it gave 100, 101, 102.
+        rawData = {"location": [0, [1, 2], 10, [1, 2], 20, [1, 2]], "heartrate": [x for t in range(0, 21) for x in (t, 100 + t)], "elevation": [0, 5, 14, 6]}
+        record = TestTools.create_mock_svc_record(SportTracks)
+        act = Activity(startTime=datetime(2013, 1, 1))
+        act.UploadedTo = [{"Connection": record, "ActivityURI": "activity"}]
+        SportTracks.CachedDownload = lambda *args: rawData
+        try:
+            SportTracks.DownloadActivity(record, act)
+        finally:
+            del SportTracks.CachedDownload
+        self.assertEqual([wp.HR for wp in act.Waypoints], [100, 110, 120])
+        self.assertEqual([wp.Location.Altitude for wp in act.Waypoints], [5, 6, 6])
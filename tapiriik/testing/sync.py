@@ -1,9 +1,13 @@
 from tapiriik.testing.testtools import TestTools, TapiriikTestCase
 
-from tapiriik.sync import Sync
+from tapiriik.sync import Sync, SyncStep, SynchronizationConcurrencyException
+from tapiriik.sync.bookkeeping import SyncBookkeeping
+from tapiriik.sync.scheduler import SyncScheduler, SyncPriority, SyncLease
+from tapiriik.database import db
 from tapiriik.services import Service
-from tapiriik.services.api import APIExcludeActivity
+from tapiriik.services.api import APIExcludeActivity, APIDeferral
 from tapiriik.services.interchange import Activity, ActivityType
+from tapiriik.services.service_record import ServiceRecord
 from tapiriik.auth import User
 
 from datetime import datetime, timedelta, tzinfo
@@ -277,6 +281,45 @@ class SyncTests(TapiriikTestCase):
 
         self.assertEqual(len(activities), 2)
 
+    def test_activity_deduplicate_first_match(self):
+        ''' ensure that an activity matching several others is merged into the one that was listed first '''
+        svcA, svcB = TestTools.create_mock_services()
+        actLate = TestTools.create_blank_activity(svcA)
+        actLate.StartTime = datetime(2013, 8, 1, 10, 4)
+        actEarly = TestTools.create_blank_activity(svcA)
+        actEarly.StartTime = datetime(2013, 8, 1, 10, 0)
+        actB = TestTools.create_blank_activity(svcB)
+        actB.StartTime = datetime(2013, 8, 1, 10, 2)
+        for act in [actLate, actEarly, actB]:
+            act.CalculateUID()
+
+        activities = []
+        Sync._accumulateActivities(Service.FromID("mockA"), [copy.deepcopy(actLate), copy.deepcopy(actEarly)], activities)
+        Sync._accumulateActivities(Service.FromID("mockB"), [copy.deepcopy(actB)], activities)
+
+        self.assertEqual(len(activities), 2)
+        self.assertEqual(activities[0].UIDs, [actLate.UID, actB.UID])
+        self.assertEqual(activities[1].UIDs, [actEarly.UID])
+
+    def test_activity_deduplicate_after_merge(self):
+        ''' ensure that activities are still matched against the start time of an activity after it was changed by a merge '''
+        svcA, svcB = TestTools.create_mock_services()
+        actNaive = TestTools.create_blank_activity(svcB)
+        actNaive.StartTime = datetime(2013, 8, 1, 10, 0)
+        actAware = TestTools.create_blank_activity(svcA)
+        actAware.StartTime = pytz.timezone("America/Iqaluit").localize(datetime(2013, 8, 1, 10, 0))
+        actUTC = TestTools.create_blank_activity(svcA)
+        actUTC.StartTime = pytz.utc.localize(datetime(2013, 8, 1, 14, 1))  # Only a minute off, once the naive activity adopts the TZ
+        for act in [actNaive, actAware, actUTC]:
+            act.CalculateUID()
+
+        activities = []
+        Sync._accumulateActivities(Service.FromID("mockB"), [copy.deepcopy(actNaive)], activities)
+        Sync._accumulateActivities(Service.FromID("mockA"), [copy.deepcopy(actAware), copy.deepcopy(actUTC)], activities)
+
+        self.assertEqual(len(activities), 1)
+        self.assertEqual(activities[0].UIDs, [actNaive.UID, actAware.UID, actUTC.UID])
+
     def test_activity_coalesce(self):
         ''' ensure that activity data is getting coalesced by _accumulateActivities '''
         svcA, svcB = TestTools.create_mock_services()
@@ -501,4 +544,248 @@ class SyncTests(TapiriikTestCase):
 
         eligible = Sync._determineEligibleRecipientServices(activity=act, recipientServices=recipientServices, excludedServices=excludedServices, user=user)
         self.assertTrue(recA in eligible)
-        self.assertTrue(recB in eligible)
\ No newline at end of file
+        self.assertTrue(recB in eligible)
+
+    def test_upload_copy(self):
+        ''' ensures that each destination's upload can rewrite the activity's times without the others seeing it '''
+        act = TestTools.create_random_activity(TestTools.create_mock_service("mockA"), tz=pytz.utc)
+        act.CompactWaypoints()
+        dupe = Sync._uploadCopy(act)
+        dupe.TZ = pytz.timezone("America/Toronto")
+        dupe.AdjustTZ()
+        self.assertEqual(dupe.Waypoints[0].Timestamp, act.Waypoints[0].Timestamp)
+        self.assertEqual(act.StartTime.tzinfo, pytz.utc)
+        self.assertEqual(act.Waypoints[0].Timestamp.tzinfo, pytz.utc)
+        self.assertNotEqual(dupe.Waypoints[0].Timestamp.tzinfo, pytz.utc)
+
+    def test_listing_window(self):
+        ''' ensures that regular syncs only look back as far as the oldest listing cursor allows, and exhaustive ones (or ones with a never-listed connection) look at everything '''
+        recA = TestTools.create_mock_svc_record(TestTools.create_mock_service("mockA"))
+        recB = TestTools.create_mock_svc_record(TestTools.create_mock_service("mockB"))
+        recA.ListingCursor = datetime(2013, 10, 20, 12)
+        self.assertEqual(Sync._listingWindowStart([recA, recB], exhaustive=False), None)
+
+        recB.ListingCursor = datetime(2013, 10, 21, 12)
+        self.assertEqual(Sync._listingWindowStart([recA, recB], exhaustive=False), datetime(2013, 10, 20, 12) - Sync.ListingCursorOverlap)
+        self.assertEqual(Sync._listingWindowStart([recA, recB], exhaustive=True), None)
+
+        act = TestTools.create_blank_activity()
+        act.StartTime = pytz.timezone("America/Toronto").localize(datetime(2013, 10, 20, 9))  # 13:00 UTC
+        self.assertFalse(Sync._startsBefore(act, datetime(2013, 10, 20, 12)))
+        self.assertTrue(Sync._startsBefore(act, datetime(2013, 10, 20, 14)))
+        act.StartTime = datetime(2013, 10, 20, 9)
+        self.assertTrue(Sync._startsBefore(act, datetime(2013, 10, 20, 12)))
+
+    def test_late_activity(self):
+        ''' ensures that activities from before the listing window are only counted as late if they still need to go somewhere '''
+        user = TestTools.create_mock_user()
+        svcA, svcB = TestTools.create_mock_services()
+        recA = TestTools.create_mock_svc_record(svcA)
+        recB = TestTools.create_mock_svc_record(svcB)
+        recB._id = recA._id + "b"
+        act = TestTools.create_blank_activity(svcA, ActivityType.Rowing, record=recA)
+        act.UIDs = [act.UID]
+        exclusions = {recA._id: {}, recB._id: {}}
+        self.assertTrue(Sync._isLate(act, [recA, recB], [], exclusions, user))
+        self.assertFalse(Sync._isLate(act, [recA, recB], [recB], exclusions, user))
+
+        exclusions[recA._id][act.UID] = {"Permanent": True}
+        self.assertFalse(Sync._isLate(act, [recA, recB], [], exclusions, user))
+
+        exclusions[recA._id] = {}
+        recB.SynchronizedActivities = [act.UID]
+        self.assertFalse(Sync._isLate(act, [recA, recB], [], exclusions, user))
+
+    def test_preflight(self):
+        ''' ensures that a regular sync is only skipped when every service says there's nothing new, and that the cursors move on when it is '''
+        svcA, svcB = TestTools.create_mock_services()
+        cursor = datetime.utcnow().replace(microsecond=0) - timedelta(hours=1)  # mongo only keeps milliseconds
+        connA = db.connections.insert({"Service": "mockA", "ListingCursor": cursor})
+        connB = db.connections.insert({"Service": "mockB"})
+        user = {"_id": "preflight", "ConnectedServices": [{"Service": "mockA", "ID": connA}, {"Service": "mockB", "ID": connB}]}
+        checks = []
+        svcA.HasNewActivities = svcB.HasNewActivities = lambda rec, since: checks.append(since) or False
+
+        self.assertFalse(Sync._preflight(user))  # mockB's never been listed
+        self.assertEqual(checks, [])
+
+        db.connections.update({"_id": connB}, {"$set": {"ListingCursor": cursor, "SyncErrors": [{"Step": "list"}]}})
+        self.assertFalse(Sync._preflight(user))
+        self.assertEqual(checks, [])
+
+        db.connections.update({"_id": connB}, {"$set": {"SyncErrors": []}})
+        self.assertTrue(Sync._preflight(user))
+        self.assertEqual(checks, [pytz.utc.localize(cursor - Sync.ListingCursorOverlap - Sync._listingTZSlack)] * 2)
+        self.assertGreater(db.connections.find_one({"_id": connA})["ListingCursor"], cursor)
+
+        svcB.HasNewActivities = lambda rec, since: True
+        self.assertFalse(Sync._preflight(user))
+
+    def test_deferral(self):
+        ''' ensures that running into a rate limit leaves the work for the next regular sync, rather than making it exhaustive '''
+        svcA, svcB = TestTools.create_mock_services()
+        cursor = datetime.utcnow().replace(microsecond=0) - timedelta(hours=1)
+        connA = db.connections.insert({"Service": "mockA", "ListingCursor": cursor})
+        connB = db.connections.insert({"Service": "mockB", "ListingCursor": cursor})
+        db.users.insert({"_id": "deferral", "ConnectedServices": [{"Service": "mockA", "ID": connA}, {"Service": "mockB", "ID": connB}]})
+
+        def throttled(rec, exhaustive, since=None):
+            raise APIDeferral("Rate limit reached for mockA")
+        svcA.DownloadActivityList = throttled
+        svcB.DownloadActivityList = lambda rec, exhaustive, since=None: ([], [])
+        Sync.PerformUserSync(db.users.find_one({"_id": "deferral"}))
+
+        user = db.users.find_one({"_id": "deferral"})
+        self.assertEqual(user["NonblockingSyncErrorCount"], 0)
+        self.assertTrue(db.connections.find_one({"_id": connA})["SyncErrors"][0]["Deferred"])
+        # ...and the next sync goes over the same ground
+        self.assertEqual(db.connections.find_one({"_id": connA})["ListingCursor"], cursor)
+        self.assertEqual(db.connections.find_one({"_id": connB})["ListingCursor"], cursor)
+
+        syncs = []
+        realSync = Sync.PerformUserSync
+        Sync.PerformUserSync = lambda user, exhaustive=False, **kwargs: syncs.append(exhaustive)
+        try:
+            Sync._performScheduledUserSync(user)
+        finally:
+            Sync.PerformUserSync = realSync
+        self.assertEqual(syncs, [False])
+
+        # If the exhaustive sync is the one that's held up, though, the next one has to finish the job.
+        Sync.PerformUserSync(db.users.find_one({"_id": "deferral"}), exhaustive=True)
+        self.assertIsNone(Sync._listingWindowStart([ServiceRecord(db.connections.find_one({"_id": connA})), ServiceRecord(db.connections.find_one({"_id": connB}))], exhaustive=False))
+
+    def test_scheduler_claim(self):
+        ''' ensures that due users are claimed once each, interactive requests first, and that abandoned claims expire '''
+        db.users.remove({})
+        now = datetime.utcnow()
+        early = db.users.insert({"NextSynchronization": now - timedelta(hours=2)})
+        late = db.users.insert({"NextSynchronization": now - timedelta(hours=1)})
+        db.users.insert({"NextSynchronization": now + timedelta(hours=1)})
+        SyncScheduler.Schedule({"_id": late})
+
+        self.assertEqual(SyncScheduler.Claim()["_id"], late)
+        self.assertEqual(SyncScheduler.Claim()["_id"], early)
+        self.assertEqual(SyncScheduler.Claim(), None)
+
+        db.users.update({"_id": early}, {"$set": {"SynchronizationLeaseExpiry": now - timedelta(seconds=1)}})
+        self.assertEqual(SyncScheduler.Claim()["_id"], early)
+
+        SyncScheduler.Release({"_id": late}, now + timedelta(hours=1))
+        released = db.users.find_one({"_id": late})
+        self.assertTrue("SynchronizationWorker" not in released and "SynchronizationLeaseExpiry" not in released)
+        self.assertEqual(released["SynchronizationPriority"], SyncPriority.Scheduled)
+        self.assertEqual(SyncScheduler.Claim(), None)
+
+    def test_global_sync_slots(self):
+        ''' ensures that the global sync keeps every thread busy while users are due, stopping at the limit '''
+        import threading
+        import time
+        db.users.remove({})
+        for x in range(5):
+            db.users.insert({"NextSynchronization": datetime.utcnow()})
+        started = []
+        synced = []
+        inFlight = [0, 0]  # current, most
+        lock = threading.Lock()
+
+        def fakeSync(user, heartbeat_callback=None):
+            with lock:
+                started.append(user["_id"])
+                inFlight[0] += 1
+                inFlight[1] = max(inFlight)
+            time.sleep(0.3 if user["_id"] == started[0] else 0.05)  # the first one holds its thread while the other works through the rest
+            with lock:
+                inFlight[0] -= 1
+                synced.append(user["_id"])
+
+        realSync = Sync._performScheduledUserSync
+        Sync._performScheduledUserSync = fakeSync
+        try:
+            self.assertEqual(Sync.PerformGlobalSync(concurrency=2, limit=4), 4)
+            self.assertEqual(inFlight[1], 2)
+            self.assertEqual(synced[-1], started[0])  # i.e. nobody waited on it
+            self.assertEqual(Sync.PerformGlobalSync(concurrency=2), 1)
+            self.assertEqual(Sync.PerformGlobalSync(concurrency=2), 0)
+        finally:
+            Sync._performScheduledUserSync = realSync
+        self.assertEqual(len(set(synced)), 5)
+
+    def test_scheduler_lease(self):
+        ''' ensures that a sync can keep hold of its user, until another worker's claimed them '''
+        db.users.remove({})
+        now = datetime.utcnow()
+        userId = db.users.insert({"NextSynchronization": now})
+        SyncScheduler.Claim()
+        db.users.update({"_id": userId}, {"$set": {"SynchronizationLeaseExpiry": now}})
+        lease = SyncLease(userId)
+        self.assertTrue(lease.Renew(force=True))
+        self.assertTrue(db.users.find_one({"_id": userId})["SynchronizationLeaseExpiry"] > now + SyncScheduler.LeaseDuration / 2)
+
+        db.users.update({"_id": userId}, {"$set": {"SynchronizationWorker": -1}})
+        self.assertTrue(lease.Renew())  # too soon to bother checking
+        self.assertFalse(lease.Renew(force=True))
+        lease._lastRenewal -= SyncLease.RenewalInterval
+        self.assertRaises(SynchronizationConcurrencyException, Sync._heartbeat, lease, None, SyncStep.Upload)
+
+    def test_sync_cadence(self):
+        ''' ensures that sync intervals follow how often the user records activities, within the configured bounds '''
+        from tapiriik.settings import SYNC_INTERVAL_MIN, SYNC_INTERVAL_MAX
+        standard = timedelta(hours=1)
+        self.assertEqual(SyncScheduler.SyncInterval(SyncScheduler.UpdateCadence({}, 5), standard), standard)  # no history to go on
+
+        def simulate(activitiesPerDay, days=30):
+            user = {}
+            for day in range(days):
+                user["SyncCadence"] = SyncScheduler.UpdateCadence(user, activitiesPerDay)
+                user["LastSynchronization"] = datetime.utcnow() - timedelta(days=1)
+            return SyncScheduler.SyncInterval(user["SyncCadence"], standard)
+
+        self.assertAlmostEqual(simulate(1).total_seconds(), standard.total_seconds(), delta=60)
+        self.assertGreater(simulate(0.25), standard)
+        self.assertLess(simulate(3), standard)
+        self.assertEqual(simulate(0), timedelta(seconds=SYNC_INTERVAL_MAX))
+        self.assertEqual(simulate(100), timedelta(seconds=SYNC_INTERVAL_MIN))
+
+    def test_bookkeeping_write_behind(self):
+        ''' ensures that per-activity bookkeeping is held back until it's flushed, then written in full '''
+        connId = db.connections.insert({"Service": "mockA", "SynchronizedActivities": ["existing"]})
+        db.sync_stats.remove({"ActivityID": "uploaded"})
+
+        bookkeeping = SyncBookkeeping("user")
+        bookkeeping.RecordSynchronizedActivity([connId], "uploaded")
+        bookkeeping.RecordSyncStats("uploaded", "mockA", "mockB", 1000)
+        bookkeeping.RecordSyncStats("uploaded", "mockC", "mockB", 1000)
+        self.assertEqual(db.connections.find_one({"_id": connId})["SynchronizedActivities"], ["existing"])
+        self.assertEqual(db.sync_stats.find_one({"ActivityID": "uploaded"}), None)
+
+        bookkeeping.Flush()
+        self.assertEqual(db.connections.find_one({"_id": connId})["SynchronizedActivities"], ["existing", "uploaded"])
+        stats = db.sync_stats.find_one({"ActivityID": "uploaded"})
+        self.assertEqual(sorted(stats["DestinationServices"]), ["mockA", "mockC"])
+        self.assertEqual(stats["SourceServices"], ["mockB"])
+
+        bookkeeping.Flush()  # nothing left to write
+        self.assertEqual(db.connections.find_one({"_id": connId})["SynchronizedActivities"], ["existing", "uploaded"])
+
+    def test_synchronized_activities_compaction(self):
+        ''' ensures that synced activity UIDs are folded into the packed digests without losing any, and that anything that isn't an MD5 is left in the array '''
+        uidA, uidB, uidC = "0" * 32, "f" * 32, "0123456789abcdef0123456789abcdef"
+        connId = db.connections.insert({"Service": "mockA", "SynchronizedActivities": [uidB, "legacy"]})
+        rec = ServiceRecord(db.connections.find_one({"_id": connId}))
+        self.assertEqual(rec.SynchronizedActivities, set([uidB, "legacy"]))
+
+        rec.CompactSynchronizedActivities()
+        dbRec = db.connections.find_one({"_id": connId})
+        self.assertEqual(dbRec["SynchronizedActivities"], ["legacy"])
+        self.assertEqual(len(dbRec["SynchronizedActivityDigests"]), 16)
+
+        db.connections.update({"_id": connId}, {"$addToSet": {"SynchronizedActivities": {"$each": [uidC, uidA]}}})
+        rec.CompactSynchronizedActivities()
+        dbRec = db.connections.find_one({"_id": connId})
+        self.assertEqual(dbRec["SynchronizedActivities"], ["legacy"])
+        self.assertEqual(len(dbRec["SynchronizedActivityDigests"]), 48)
+
+        rec = ServiceRecord(dbRec)
+        self.assertEqual(rec.SynchronizedActivities, set([uidA, uidB, uidC, "legacy"]))
+        self.assertFalse(hasattr(ServiceRecord({"Service": "mockA"}), "SynchronizedActivities"))
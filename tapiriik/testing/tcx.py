@@ -0,0 +1,35 @@
+from tapiriik.testing.testtools import TestTools, TapiriikTestCase
+from tapiriik.services.tcx import TCXIO
+
+
+class TCXTests(TapiriikTestCase):
+    def test_minimum_waypoints(self):
+        ''' ensures that the header-only parse agrees with the full one '''
+
+        svcA, other = TestTools.create_mock_services()
+        act = TestTools.create_random_activity(svcA, tz=True)
+
+        mid = TCXIO.Dump(act)
+
+        full = TCXIO.Parse(bytes(mid, "UTF-8"))
+        partial = TCXIO.Parse(bytes(mid, "UTF-8"), minimumWaypoints=True)
+
+        self.assertEqual(len(partial.Waypoints), 1)
+        self.assertEqual(partial.Waypoints[0], full.Waypoints[0])
+        self.assertEqual(partial.StartTime, full.StartTime)
+        self.assertEqual(partial.EndTime, full.EndTime)
+        self.assertEqual(partial.Type, full.Type)
+        self.assertEqual(partial.UID, full.UID)
+
+    def test_dump_bytes(self):
+        ''' ensures that the compact output holds the same activity as the pretty-printed one '''
+
+        svcA, other = TestTools.create_mock_services()
+        svcA.SupportsHR = svcA.SupportsCadence = svcA.SupportsPower = True
+        act = TestTools.create_random_activity(svcA, tz=True)
+
+        pretty = TCXIO.Dump(act)
+        compact = TCXIO.DumpBytes(act, prettyPrint=False)
+
+        self.assertTrue(len(compact) < len(pretty))
+        self.assertActivitiesEqual(TCXIO.Parse(compact), TCXIO.Parse(bytes(pretty, "UTF-8")))
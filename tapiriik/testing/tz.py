@@ -0,0 +1,87 @@
+from tapiriik.testing.testtools import TapiriikTestCase
+from tapiriik.database import cachedb
+from tapiriik.database.tz import TZIndex, TZLookupCache
+import tapiriik.database.tz
+import tempfile
+import os
+
+
+class TZIndexTests(TapiriikTestCase):
+    def setUp(self):
+        polygons = [
+            ("America/Toronto", [[(-80, 43), (-74, 43), (-74, 46), (-80, 46), (-80, 43)], [(-77, 44), (-76, 44), (-76, 45), (-77, 45), (-77, 44)]]),  # with a hole
+            ("America/Winnipeg", [[(-102, 49), (-95, 49), (-95, 52), (-102, 52)]]),  # not closed
+            ("Europe/London", [[(-5.5, 50), (1.5, 50), (1.5, 55.75), (-5.5, 55.75), (-5.5, 50)]]),
+            ("Africa/Lagos", [[(10.1000037, 10.1000037), (10.3000037, 10.1000037), (10.3000037, 10.3000037), (10.1000037, 10.3000037)]]),  # a corner on the diagonal to the cell's reference point
+            ("Africa/Ndjamena", [[(12.3000037, 10.3000037), (12.4000037, 10.1000037), (12.5000037, 10.3000037)]])  # likewise, but only touching it
+        ]
+        handle, self.path = tempfile.mkstemp()
+        os.close(handle)
+        TZIndex.Build(polygons, self.path, cellsPerDegree=1)
+        self.index = TZIndex.Load(self.path)
+
+    def tearDown(self):
+        del self.index
+        os.remove(self.path)
+
+    def test_inside(self):
+        self.assertEqual(self.index.Lookup(43.65, -79.38), "America/Toronto")
+        self.assertEqual(self.index.Lookup(49.9, -97.14), "America/Winnipeg")
+        self.assertEqual(self.index.Lookup(51.5, -0.12), "Europe/London")
+        self.assertEqual(self.index.Lookup(55.7, 0), "Europe/London")  # next to an edge on a grid line
+
+    def test_hole(self):
+        self.assertEqual(self.index.Lookup(44.5, -76.5, maxDistance=0), None)
+        self.assertEqual(self.index.Lookup(44.5, -76.5), "America/Toronto")  # within 200km of the boundary
+
+    def test_nearest(self):
+        self.assertEqual(self.index.Lookup(49.5, 2.5), "Europe/London")
+        self.assertEqual(self.index.Lookup(49.5, 2.5, maxDistance=50000), None)
+        self.assertEqual(self.index.Lookup(0, 0), None)
+
+    def test_vertex(self):
+        self.assertEqual(self.index.Lookup(10.2000037, 10.2000037, maxDistance=0), "Africa/Lagos")
+        self.assertEqual(self.index.Lookup(10.2000037, 12.2000037, maxDistance=0), None)
+        self.assertEqual(self.index.Lookup(10.2000037, 12.4000037, maxDistance=0), "Africa/Ndjamena")
+
+
+class TZLookupCacheTests(TapiriikTestCase):
+    def setUp(self):
+        cachedb.tz_cache.remove({})
+        self.lookups = []
+        self._realLookup = tapiriik.database.tz.TZLookup
+        def lookup(lat, lng):
+            self.lookups.append((lat, lng))
+            return "America/Toronto"
+        tapiriik.database.tz.TZLookup = lookup
+
+    def tearDown(self):
+        tapiriik.database.tz.TZLookup = self._realLookup
+
+    def test_nearby_points(self):
+        cache = TZLookupCache(size=10)
+        self.assertEqual(cache.Lookup(43.65001, -79.38001), "America/Toronto")
+        self.assertEqual(cache.Lookup(43.65002, -79.38003), "America/Toronto")
+        self.assertEqual(len(self.lookups), 1)
+        self.assertEqual(cache.Stats(), {"Hits": 1, "DBHits": 0, "Misses": 1, "Size": 1})
+
+    def test_persisted(self):
+        TZLookupCache(size=10).Lookup(43.65, -79.38)
+        cache = TZLookupCache(size=10)
+        self.assertEqual(cache.Lookup(43.65, -79.38), "America/Toronto")
+        self.assertEqual(len(self.lookups), 1)
+        self.assertEqual(cache.DBHits, 1)
+
+    def test_evicted(self):
+        cache = TZLookupCache(size=1)
+        cache.Lookup(43.65, -79.38)
+        cache.Lookup(45.42, -75.69)
+        cache.Lookup(43.65, -79.38)
+        self.assertEqual(cache.Stats(), {"Hits": 0, "DBHits": 1, "Misses": 2, "Size": 1})
+
+    def test_legacy_entries(self):
+        ''' ensures that entries from before the cache went by cell are cleared out '''
+        cachedb.tz_cache.insert({"TZ": "Europe/London", "Latitude": 51.5, "Longitude": -0.12})
+        TZLookupCache(size=10).Lookup(43.65, -79.38)
+        self.assertEqual(cachedb.tz_cache.find({"Latitude": {"$exists": True}}).count(), 0)
+        self.assertEqual(cachedb.tz_cache.find().count(), 1)
@@ -128,7 +128,7 @@ def diag_user(req, user):
     elif "svc_clearacts" in req.POST:
         from tapiriik.services import Service
         from tapiriik.auth import User
-        db.connections.update({"_id": ObjectId(req.POST["id"])}, {"$unset": {"SynchronizedActivities": 1}})
+        db.connections.update({"_id": ObjectId(req.POST["id"])}, {"$unset": {"SynchronizedActivities": 1, "SynchronizedActivityDigests": 1}})
         Sync.SetNextSyncIsExhaustive(userRec, True)
         delta = True
 
@@ -1,32 +1,53 @@
-# This file isn't called in normal operation, just to update the TZ boundary DB.
+# This file isn't called in normal operation, just to update the TZ boundary DB and the in-memory TZ index snapshot (TZ_INDEX_PATH).
 # Should be called with `tz_world.*` files from http://efele.net/maps/tz/world/ in the working directory.
 # Requires pyshp and shapely for py3k (from https://github.com/mwtoews/shapely/tree/py3)
+# Run with --index-only to rebuild just the snapshot from the boundaries already in the DB.
 
-import shapefile
-from shapely.geometry import Polygon, mapping
+import sys
 import pymongo
 from tapiriik.database import tzdb
+from tapiriik.database.tz import TZIndex
+from tapiriik.settings import TZ_INDEX_PATH
 
-print("Dropping boundaries collection")
-tzdb.drop_collection("boundaries")
-
-print("Setting up index")
-tzdb.boundaries.ensure_index([("Boundary", pymongo.GEOSPHERE)])
-
-print("Reading shapefile")
-records = []
-sf = shapefile.Reader("tz_world.shp")
-shapeRecs = sf.shapeRecords()
-
-ct = 0
-total = len(shapeRecs)
-for shape in shapeRecs:
-	tzid = shape.record[0]
-	print("%3d%% %s" % (round(ct * 100 / total), tzid))
-	ct += 1
-	polygon = Polygon(list(shape.shape.points))
-	if not polygon.is_valid:
-		polygon = polygon.buffer(0) # Resolves issues with most self-intersecting geometry
-		assert polygon.is_valid
-	record = {"TZID": tzid, "Boundary": mapping(polygon)}
-	tzdb.boundaries.insert(record) # Would be bulk insert, but that makes it a pain to debug geometry issues
+def index_polygons(tzid, boundary):
+	# GeoJSON-style Polygon/MultiPolygon -> (TZID, rings) for TZIndex.Build
+	if boundary["type"] == "Polygon":
+		return [(tzid, boundary["coordinates"])]
+	return [(tzid, polygon) for polygon in boundary["coordinates"]]
+
+index = []
+if "--index-only" in sys.argv:
+	print("Reading boundaries")
+	for record in tzdb.boundaries.find():
+		index += index_polygons(record["TZID"], record["Boundary"])
+else:
+	import shapefile
+	from shapely.geometry import Polygon, mapping
+
+	print("Dropping boundaries collection")
+	tzdb.drop_collection("boundaries")
+
+	print("Setting up index")
+	tzdb.boundaries.ensure_index([("Boundary", pymongo.GEOSPHERE)])
+
+	print("Reading shapefile")
+	records = []
+	sf = shapefile.Reader("tz_world.shp")
+	shapeRecs = sf.shapeRecords()
+
+	ct = 0
+	total = len(shapeRecs)
+	for shape in shapeRecs:
+		tzid = shape.record[0]
+		print("%3d%% %s" % (round(ct * 100 / total), tzid))
+		ct += 1
+		polygon = Polygon(list(shape.shape.points))
+		if not polygon.is_valid:
+			polygon = polygon.buffer(0) # Resolves issues with most self-intersecting geometry
+			assert polygon.is_valid
+		record = {"TZID": tzid, "Boundary": mapping(polygon)}
+		tzdb.boundaries.insert(record) # Would be bulk insert, but that makes it a pain to debug geometry issues
+		index += index_polygons(tzid, record["Boundary"])
+
+print("Writing index snapshot to %s" % TZ_INDEX_PATH)
+TZIndex.Build(index, TZ_INDEX_PATH)